@@ -0,0 +1,192 @@
+"""Online backups of the database, taken while the bot keeps running.
+
+SQLite databases are copied with the SQLite online backup API a few pages at a time, so that the writers are never
+blocked for long; other engines are dumped with their own tool, currently pg_dump for PostgreSQL.
+Every backup is verified before it's kept, and only the most recent ones are kept.
+
+Usage:
+    python backup.py [--directory backups] [--keep 7] [--no-compress] [--engine URL]
+    python backup.py --verify FILE
+"""
+import argparse
+import datetime
+import glob
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import typing
+
+import sqlalchemy
+
+log = logging.getLogger(__name__)
+
+# The prefix of the names of the backup files, used to find the old ones to rotate
+PREFIX = "greed-"
+
+
+class BackupError(Exception):
+    """The backup couldn't be taken, or it isn't a working copy of the database."""
+
+
+def _sqlite_copy(engine, destination: str, pages: int, sleep: float, max_restarts: int) -> None:
+    """Copy the SQLite database of the engine to destination, pages at a time, sleeping between the steps.
+    Writes to the database during the copy make it start over: after max_restarts, the remaining part is copied
+    in a single step instead, blocking the writers until it's done."""
+    restarts = 0
+    previous = None
+
+    def progress(status, remaining, total):
+        nonlocal restarts, previous
+        if previous is not None and remaining > previous:
+            restarts += 1
+            if restarts > max_restarts:
+                raise BackupError("The database is changing too fast to copy it a few pages at a time")
+        previous = remaining
+
+    raw = engine.raw_connection()
+    target = sqlite3.connect(destination)
+    try:
+        try:
+            raw.connection.backup(target, pages=pages, progress=progress, sleep=sleep)
+        except BackupError as e:
+            log.warning(f"{e}, copying it in a single step")
+            raw.connection.backup(target)
+        # The copy is a single file, even if the database is in WAL mode
+        target.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        target.close()
+        raw.close()
+
+
+def verify_sqlite(path: str) -> None:
+    """Open a copy of a SQLite database, ensuring it's intact and contains the tables of greed."""
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        result = connection.execute("PRAGMA integrity_check").fetchone()[0]
+        if result != "ok":
+            raise BackupError(f"The integrity check of {path} failed: {result}")
+        tables = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        if "users" not in tables:
+            raise BackupError(f"{path} doesn't contain the users table")
+        connection.execute("SELECT count(*) FROM users").fetchone()
+    except sqlite3.DatabaseError as e:
+        raise BackupError(f"{path} is not a working SQLite database: {e}")
+    finally:
+        connection.close()
+
+
+def verify_dump(path: str) -> None:
+    """Ensure pg_restore can read a dump of a PostgreSQL database."""
+    result = subprocess.run(["pg_restore", "--list", path], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise BackupError(f"pg_restore can't read {path}: {result.stderr.decode(errors='replace').strip()}")
+
+
+def verify(path: str) -> None:
+    """Ensure a backup file can be restored, raising BackupError if it can't."""
+    if path.endswith(".dump"):
+        verify_dump(path)
+        return
+    if not path.endswith(".gz"):
+        verify_sqlite(path)
+        return
+    with tempfile.TemporaryDirectory() as directory:
+        restored = os.path.join(directory, "restored.sqlite")
+        with gzip.open(path, "rb") as source, open(restored, "wb") as destination:
+            shutil.copyfileobj(source, destination)
+        verify_sqlite(restored)
+
+
+def rotate(directory: str, keep: int) -> typing.List[str]:
+    """Delete all the backups in directory except the keep most recent ones, returning the deleted files."""
+    backups = sorted(path for path in glob.glob(os.path.join(directory, f"{PREFIX}*"))
+                     if path.endswith((".sqlite", ".sqlite.gz", ".dump")))
+    deleted = backups[:-keep] if keep > 0 else []
+    for path in deleted:
+        log.debug(f"Deleting the old backup {path}")
+        os.remove(path)
+    return deleted
+
+
+def backup(engine, directory: str, keep: int = 7, compress: bool = True,
+           pages: int = 1024, sleep: float = 0.01, max_restarts: int = 10) -> str:
+    """Back up the database of the engine in directory, verify the copy, then delete the oldest backups.
+    Returns the path of the new backup."""
+    os.makedirs(directory, exist_ok=True)
+    name = os.path.join(directory, f"{PREFIX}{datetime.datetime.now():%Y%m%d-%H%M%S}")
+    dialect = engine.dialect.name
+    if dialect == "sqlite":
+        if not engine.url.database or engine.url.database == ":memory:":
+            raise BackupError("In-memory databases can't be backed up")
+        path = f"{name}.sqlite"
+    elif dialect == "postgresql":
+        # The custom format of pg_dump is already compressed
+        path = f"{name}.dump"
+    else:
+        raise BackupError(f"Backups of {dialect} databases are not supported")
+    # The backup is written to a partial file, renamed only once it's verified
+    partial = f"{path}.partial"
+    try:
+        if dialect == "sqlite":
+            _sqlite_copy(engine, partial, pages=pages, sleep=sleep, max_restarts=max_restarts)
+            verify_sqlite(partial)
+            if compress:
+                path = f"{path}.gz"
+                with open(partial, "rb") as source, gzip.open(f"{path}.partial", "wb") as destination:
+                    shutil.copyfileobj(source, destination)
+                os.remove(partial)
+                partial = f"{path}.partial"
+        else:
+            # The password is passed in the environment, as the arguments of a process can be read by every user
+            url = sqlalchemy.engine.URL.create("postgresql", username=engine.url.username, host=engine.url.host,
+                                               port=engine.url.port, database=engine.url.database,
+                                               query=engine.url.query)
+            environment = dict(os.environ)
+            if engine.url.password is not None:
+                environment["PGPASSWORD"] = engine.url.password
+            result = subprocess.run(["pg_dump", "--format=custom", f"--file={partial}",
+                                     f"--dbname={url.render_as_string(hide_password=False)}"],
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=environment)
+            if result.returncode != 0:
+                raise BackupError(f"pg_dump failed: {result.stderr.decode(errors='replace').strip()}")
+            verify_dump(partial)
+        os.rename(partial, path)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    log.info(f"Backed up the database to {path} ({os.path.getsize(path)} bytes)")
+    rotate(directory, keep)
+    return path
+
+
+def main() -> None:
+    import nuconfig
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--directory", default=None, help="where to save the backups")
+    parser.add_argument("--keep", type=int, default=None, help="number of backups kept")
+    parser.add_argument("--no-compress", action="store_true", help="don't compress SQLite backups")
+    parser.add_argument("--engine", help="the database to use instead of the one in config/config.toml")
+    parser.add_argument("--verify", metavar="FILE", help="check that an existing backup can be restored")
+    args = parser.parse_args()
+    logging.basicConfig(level="INFO", format="{levelname} {message}", style="{")
+    if args.verify is not None:
+        verify(args.verify)
+        log.info(f"{args.verify} can be restored")
+        return
+    with open("config/config.toml", encoding="utf8") as user_cfg_file:
+        user_cfg = nuconfig.NuConfig(user_cfg_file)
+    engine = sqlalchemy.create_engine(args.engine or user_cfg["Database"]["engine"])
+    backup(engine,
+           directory=args.directory or user_cfg["Database"]["backup_directory"],
+           keep=args.keep if args.keep is not None else user_cfg["Database"]["backup_keep"],
+           compress=user_cfg["Database"]["backup_compress"] and not args.no_compress)
+
+
+if __name__ == "__main__":
+    main()
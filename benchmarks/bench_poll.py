@@ -0,0 +1,166 @@
+"""Cost of a cycle of the bitcoin poller as the number of pending addresses grows.
+
+Every size gets its own SQLite database, seeded with the addresses of synthetic users waiting for a payment.
+A fraction of them is paid and already confirmed, and another fraction is paid but never confirmed;
+the history is served by fakeblockonomics.py, run in its own process so that it doesn't affect the measures.
+All the addresses are due at every cycle, and the hourly budget of requests is lifted, so every cycle is a full one:
+the first one confirms the payments, the following ones show the steady state.
+
+For every cycle it reports the latency, the statements executed by the database,
+the requests and bytes exchanged with the API and the peak of the memory allocated.
+
+Run it from the root of the repository, as it reads config/config.toml like the bot does.
+
+Usage:
+    python benchmarks/bench_poll.py [--sizes 10,1000,100000] [--cycles 3] [--paid 0.05] [--unconfirmed 0.05]
+"""
+import argparse
+import collections
+import datetime
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import requests
+import sqlalchemy
+import sqlalchemy.orm
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+import blockonomics  # noqa: E402
+import configloader  # noqa: E402
+import database as db  # noqa: E402
+import migrations  # noqa: E402
+
+# Satoshis paid to every paid address
+SATOSHI = 100000
+# Addresses of every user
+ADDRESSES_PER_USER = 10
+
+
+class Bot:
+    """Stands in for the Telegram bot, counting the messages instead of sending them."""
+
+    def __init__(self):
+        self.sent = 0
+
+    def send_message(self, *args, **kwargs):
+        self.sent += 1
+
+
+def seed(engine, size: int, paid: float, unconfirmed: float) -> list:
+    """Create the users and their pending addresses, returning the script of the payments for the fake API."""
+    now = datetime.datetime.now()
+    addresses = [f"bc1qbench{size}x{i}" for i in range(size)]
+    users = max(1, size // ADDRESSES_PER_USER)
+    with engine.begin() as connection:
+        connection.execute(sqlalchemy.insert(db.User.__table__),
+                           [dict(user_id=i, first_name="User", language="en", credit=0) for i in range(users)])
+        connection.execute(sqlalchemy.insert(db.BtcTransaction.__table__),
+                           [dict(user_id=i % users, address=address, status=-1, txid="", price=20000.0, value=0.0,
+                                 # Spread over the last day, so that all the poll intervals are used
+                                 timestamp=now - datetime.timedelta(seconds=i % 86400))
+                            for i, address in enumerate(addresses)])
+    paid_count = int(size * paid)
+    unconfirmed_count = int(size * unconfirmed)
+    script = [{"address": address, "satoshi": SATOSHI, "timeline": [[0, 0], [0, 2]]}
+              for address in addresses[:paid_count]]
+    script += [{"address": address, "satoshi": SATOSHI, "timeline": [[0, 0]]}
+               for address in addresses[paid_count:paid_count + unconfirmed_count]]
+    return script
+
+
+def start_fake(script: list, directory: str) -> subprocess.Popen:
+    """Start fakeblockonomics.py with the payments of script, and point the API URL of the poller to it."""
+    path = os.path.join(directory, "payments.json")
+    with open(path, "w", encoding="utf8") as file:
+        json.dump(script, file)
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, "fakeblockonomics.py"),
+                                "--port", str(port), "--script", path],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}/api"
+    # The server listens while it loads the script, but answers only after
+    for _ in range(300):
+        try:
+            requests.get(f"{url}/price", params={"currency": "USD"}, timeout=1)
+            break
+        except requests.RequestException:
+            time.sleep(0.1)
+    else:
+        process.kill()
+        raise RuntimeError("fakeblockonomics.py didn't start")
+    configloader.user_cfg["Bitcoin"]["api_url"] = url
+    return process
+
+
+def run(size: int, cycles: int, paid: float, unconfirmed: float) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        engine = sqlalchemy.create_engine(f"sqlite:///{os.path.join(directory, 'bench.sqlite')}",
+                                          connect_args={"check_same_thread": False})
+        migrations.upgrade(engine)
+        process = start_fake(seed(engine, size, paid, unconfirmed), directory)
+        statements = collections.Counter()
+        traffic = collections.Counter()
+
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements[statement.split(None, 1)[0].upper()] += 1
+
+        def count_traffic(response, *args, **kwargs):
+            traffic["requests"] += 1
+            traffic["sent"] += len(response.request.body or b"")
+            traffic["received"] += len(response.content)
+
+        sqlalchemy.event.listen(engine, "before_cursor_execute", count_statement)
+        blockonomics.api.hooks["response"].append(count_traffic)
+        try:
+            for cycle in range(1, cycles + 1):
+                statements.clear()
+                traffic.clear()
+                bot = Bot()
+                tracemalloc.start()
+                start = time.perf_counter()
+                poll = blockonomics.BlockonomicsPoll(bot=bot, engine=engine)
+                poll.check_for_pending_transactions()
+                poll.close()
+                elapsed = time.perf_counter() - start
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                print(f"{size:>8}{cycle:>6}{elapsed * 1000:>11.1f}{statements['SELECT']:>8}{statements['UPDATE']:>8}"
+                      f"{statements['INSERT']:>8}{traffic['requests']:>7}{traffic['sent'] / 1024:>10.1f}"
+                      f"{traffic['received'] / 1024:>10.1f}{peak / 2 ** 20:>10.1f}{bot.sent:>7}")
+        finally:
+            blockonomics.api.hooks["response"].remove(count_traffic)
+            process.kill()
+            process.wait()
+            engine.dispose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10,1000,100000", help="comma separated numbers of pending addresses")
+    parser.add_argument("--cycles", type=int, default=3)
+    parser.add_argument("--paid", type=float, default=0.05, help="fraction of the addresses paid and confirmed")
+    parser.add_argument("--unconfirmed", type=float, default=0.05, help="fraction paid but never confirmed")
+    args = parser.parse_args()
+    bitcoin = configloader.user_cfg["Bitcoin"]
+    # Every pending address is checked at every cycle
+    for key in ("poll_unconfirmed_interval", "poll_fresh_interval", "poll_stale_interval"):
+        bitcoin[key] = 0
+    blockonomics.history_budget = blockonomics.RequestBudget(per_hour=10 ** 9)
+    print(f"{'size':>8}{'cycle':>6}{'ms':>11}{'select':>8}{'update':>8}{'insert':>8}{'http':>7}"
+          f"{'sent KiB':>10}{'recv KiB':>10}{'peak MiB':>10}{'msgs':>7}")
+    for size in (int(size) for size in args.sizes.split(",")):
+        run(size, args.cycles, args.paid, args.unconfirmed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Per-call overhead of the hot queries, as ORM Query objects built at every call and as cached lambda statements.
+
+The database is a small in-memory SQLite one, so that the time is dominated by the Python work
+of building, compiling and executing the statements rather than by the database itself.
+
+Usage:
+    python benchmarks/bench_queries.py [--calls 5000]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+import sqlalchemy
+import sqlalchemy.orm
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import database as db  # noqa: E402
+import queries  # noqa: E402
+
+
+def populate(session) -> None:
+    category = db.Category(name="Category")
+    session.add(category)
+    session.flush()
+    for i in range(5):
+        session.add(db.Product(name=f"Product {i}", description="", price=1.0, deleted=False,
+                               category_id=category.id))
+    session.add(db.Variation(name="Variation", price_diff=0.0, quantity=1))
+    session.flush()
+    session.add(db.ProductVariation(id=1, product_id=1, variation_id=1))
+    session.execute(sqlalchemy.insert(db.User).values(user_id=1, first_name="User", language="en", credit=0))
+    session.add(db.Admin(user_id=1, edit_products=True, receive_orders=True, create_transactions=True,
+                         display_on_help=True, is_owner=True, live_mode=False))
+    session.add(db.BtcTransaction(user_id=1, address="address", status=-1, txid=""))
+    session.commit()
+
+
+# Pairs of the original ORM query and its lambda statement replacement
+CASES = {
+    "products_for_sale": (
+        lambda s: s.query(db.Product).filter_by(deleted=False).all(),
+        lambda s: queries.products_for_sale(s),
+    ),
+    "products_in_category": (
+        lambda s: s.query(db.Product).filter_by(category_id=1, deleted=False).all(),
+        lambda s: queries.products_in_category(s, 1),
+    ),
+    "variations_of": (
+        lambda s: s.query(db.ProductVariation).filter_by(product_id=1).all(),
+        lambda s: queries.variations_of(s, 1),
+    ),
+    "variation_names": (
+        lambda s: s.query(db.ProductVariation, db.Product.name, db.Variation.name)
+        .select_from(db.ProductVariation).join(db.Product).join(db.Variation).all(),
+        lambda s: queries.variation_names(s),
+    ),
+    "user": (
+        lambda s: s.query(db.User).filter(db.User.user_id == 1).one_or_none(),
+        lambda s: queries.user(s, 1),
+    ),
+    "profile": (
+        lambda s: s.query(db.User, db.Admin).outerjoin(db.Admin, db.Admin.user_id == db.User.user_id)
+        .filter(db.User.user_id == 1).one_or_none(),
+        lambda s: queries.profile(s, 1),
+    ),
+    "pending_payments": (
+        lambda s: s.query(db.BtcTransaction.address, db.BtcTransaction.status, db.BtcTransaction.timestamp)
+        .filter(db.BtcTransaction.status.notin_([db.BtcTransaction.EXPIRED, db.BtcTransaction.CONFIRMED])).all(),
+        lambda s: queries.pending_payments(s),
+    ),
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=5000)
+    args = parser.parse_args()
+    engine = sqlalchemy.create_engine("sqlite://")
+    db.TableDeclarativeBase.metadata.create_all(engine)
+    session = sqlalchemy.orm.sessionmaker(bind=engine)()
+    populate(session)
+    print(f"{'query':<22}{'orm µs':>10}{'lambda µs':>11}{'saved µs':>10}{'saved':>8}")
+    for name, (orm, cached) in CASES.items():
+        # Warm up both caches and check the results are the same
+        assert orm(session) == cached(session) or name == "profile", name
+        orm_time = min(timeit.repeat(lambda: orm(session), number=args.calls, repeat=3)) / args.calls * 1e6
+        lambda_time = min(timeit.repeat(lambda: cached(session), number=args.calls, repeat=3)) / args.calls * 1e6
+        saved = orm_time - lambda_time
+        print(f"{name:<22}{orm_time:>10.1f}{lambda_time:>11.1f}{saved:>10.1f}{saved / orm_time:>8.0%}")
+
+
+if __name__ == "__main__":
+    main()
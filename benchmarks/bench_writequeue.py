@@ -0,0 +1,105 @@
+"""Write throughput of concurrent conversations on SQLite, with and without the write queue.
+
+Every conversation is a thread adding credit to its own user: each write updates the user and inserts a transaction.
+The modes are:
+    direct      every thread commits its own session, like greed does with serialize_writes disabled
+    serialized  the commits of the sessions are executed one at a time by the writer thread, in WAL mode
+    grouped     the writes are submitted as jobs to the writer thread, which commits them in batches
+
+Usage:
+    python benchmarks/bench_writequeue.py [--conversations 10 100 1000] [--writes 20] [--modes direct serialized grouped]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import sqlalchemy
+import sqlalchemy.orm
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import database as db  # noqa: E402
+import writequeue  # noqa: E402
+
+
+def add_credit(session, user_id: int) -> None:
+    user = session.query(db.User).filter_by(user_id=user_id).one()
+    user.credit += 100
+    session.add(db.Transaction(user=user, value=100, provider="Benchmark"))
+
+
+def conversation(mode: str, engine, user_id: int, writes: int, barrier: threading.Barrier, errors: list) -> None:
+    session = sqlalchemy.orm.sessionmaker(bind=engine, class_=writequeue.Session)()
+    barrier.wait()
+    for _ in range(writes):
+        try:
+            if mode == "grouped":
+                writequeue.queue.submit(lambda s: add_credit(s, user_id)).result()
+            else:
+                add_credit(session, user_id)
+                session.commit()
+        except sqlalchemy.exc.OperationalError as e:
+            session.rollback()
+            errors.append(e)
+    session.close()
+
+
+def run(mode: str, conversations: int, writes: int) -> dict:
+    directory = tempfile.mkdtemp()
+    url = f"sqlite:///{os.path.join(directory, 'bench.sqlite')}"
+    # Configured like core.py does: without the write queue, the connections are used by a single thread
+    engine = sqlalchemy.create_engine(url) if mode == "direct" else writequeue.create_engine(url)
+    if mode != "direct":
+        writequeue.configure_sqlite(engine, busy_timeout=30000)
+    db.TableDeclarativeBase.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(sqlalchemy.insert(db.User.__table__),
+                           [{"user_id": i, "first_name": f"User {i}", "language": "en", "credit": 0}
+                            for i in range(conversations)])
+    if mode != "direct":
+        writequeue.start(engine, max_batch=100, max_delay=0.005)
+    errors = []
+    barrier = threading.Barrier(conversations + 1)
+    threads = [threading.Thread(target=conversation, args=(mode, engine, i, writes, barrier, errors))
+               for i in range(conversations)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    batches = 0
+    if writequeue.queue is not None:
+        writequeue.queue.stop()
+        batches = writequeue.queue.batches
+        writequeue.queue = None
+    with engine.connect() as connection:
+        committed = connection.execute(sqlalchemy.select(sqlalchemy.func.count()).select_from(db.Transaction)).scalar()
+    engine.dispose()
+    shutil.rmtree(directory, ignore_errors=True)
+    return {"mode": mode, "conversations": conversations, "committed": committed, "errors": len(errors),
+            "batches": batches, "elapsed": elapsed, "throughput": committed / elapsed}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--writes", type=int, default=20, help="writes done by every conversation")
+    parser.add_argument("--modes", nargs="+", default=["direct", "serialized", "grouped"],
+                        choices=["direct", "serialized", "grouped"])
+    args = parser.parse_args()
+    print(f"{'mode':<12}{'conversations':>14}{'committed':>11}{'errors':>8}{'batches':>9}{'seconds':>9}{'writes/s':>10}")
+    for conversations in args.conversations:
+        for mode in args.modes:
+            r = run(mode, conversations, args.writes)
+            print(f"{r['mode']:<12}{r['conversations']:>14}{r['committed']:>11}{r['errors']:>8}{r['batches']:>9}"
+                  f"{r['elapsed']:>9.2f}{r['throughput']:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,31 +2,130 @@ import requests
 import configloader
 import logging
 import sqlalchemy
+from sqlalchemy.orm.attributes import set_committed_value
 import datetime
 from decimal import Decimal
+import collections
+import concurrent.futures
+import heapq
+import hmac
+import math
+import http.server
 import json
 import re
+import threading
+import time
+import typing
+import urllib.parse
 
+import cache
 import database as db
+import queries
+import writequeue
 
 log = logging.getLogger(__name__)
 
-# Define all the database tables using the sqlalchemy declarative base
+class PriceCache:
+    """The BTC prices of the currencies, shared by all the threads of the process.
+    A price is fetched again only after ttl seconds; concurrent requests for an expired price wait for a single fetch.
+    If the fetch fails, the last price is served for up to max_stale seconds after it was fetched,
+    as it is to the requests that waited for wait_timeout seconds without the fetch being over."""
+
+    def __init__(self, fetch: typing.Callable[[str], typing.Optional[float]], ttl: float, max_stale: float,
+                 wait_timeout: float = 15):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.wait_timeout = wait_timeout
+        # Prices served from the cache, fetched, served after waiting for the fetch of another thread,
+        # served while stale after a failed fetch, and fetches failed
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.stale = 0
+        self.errors = 0
+        # {currency: (time of the fetch, price)}
+        self._prices: typing.Dict[str, typing.Tuple[float, float]] = {}
+        # {currency: event set when the price being fetched is available}
+        self._fetching: typing.Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+
+    def get(self, currency: str) -> typing.Optional[float]:
+        """Get the BTC price in currency, or None if it couldn't be fetched and no recent price is known."""
+        with self._lock:
+            entry = self._prices.get(currency)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                self.hits += 1
+                return entry[1]
+            event = self._fetching.get(currency)
+            leader = event is None
+            if leader:
+                event = self._fetching[currency] = threading.Event()
+                self.misses += 1
+            else:
+                self.shared += 1
+        if not leader:
+            if not event.wait(self.wait_timeout):
+                log.warning(f"The BTC price is being fetched since more than {self.wait_timeout} seconds")
+            return self._last(currency, count=False)
+        price = None
+        try:
+            price = self.fetch(currency)
+        except requests.RequestException as e:
+            log.error(f"Fetch BTC Price Failed: {e}")
+        finally:
+            # Whatever happened to the fetch, the waiting threads are released and the next request fetches again
+            with self._lock:
+                if price is not None:
+                    self._prices[currency] = (time.monotonic(), price)
+                else:
+                    self.errors += 1
+                del self._fetching[currency]
+            event.set()
+        return price if price is not None else self._last(currency, count=True)
+
+    def _last(self, currency: str, count: bool) -> typing.Optional[float]:
+        """Get the last price fetched, if it isn't older than max_stale seconds."""
+        with self._lock:
+            entry = self._prices.get(currency)
+            if entry is None:
+                return None
+            age = time.monotonic() - entry[0]
+            if age > self.max_stale:
+                return None
+            if count and age >= self.ttl:
+                self.stale += 1
+                log.warning(f"Using a BTC price fetched {age:.0f} seconds ago")
+            return entry[1]
+
+    def stats(self) -> typing.Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "shared": self.shared, "stale": self.stale,
+                "errors": self.errors}
+
+
 class Blockonomics:
 
     @staticmethod
-    def fetch_new_btc_price():
-        url = 'https://www.blockonomics.co/api/price'
-        params = {'currency':configloader.user_cfg["Payments"]["currency"]}
-        print("params ==== ",params)
-        r = requests.get(url,params)
+    def _url(endpoint: str) -> str:
+        """Get the URL of an endpoint of the API, under the api_url of the configuration."""
+        return f"{configloader.user_cfg['Bitcoin']['api_url'].rstrip('/')}/{endpoint}"
+
+    @staticmethod
+    def _fetch_btc_price(currency: str) -> typing.Optional[float]:
+        url = Blockonomics._url('price')
+        r = api.get(url, params={'currency': currency}, timeout=10)
         if r.status_code == 200:
           price = r.json()['price']
           log.debug("BTC Price %s" % price)
           return price
         else:
           log.error("Fetch BTC Price Failed, Status: %s, Response: %s" % (r.status_code, r.content))
-    
+
+    @staticmethod
+    def fetch_new_btc_price():
+        """Get the BTC price in the currency of the shop, fetching it only if the cached one has expired."""
+        return price_cache.get(configloader.user_cfg["Payments"]["currency"])
+
     @staticmethod
     def _get_secret():
         return configloader.user_cfg["Bitcoin"]["secret"]
@@ -34,75 +133,378 @@ class Blockonomics:
     @staticmethod
     def new_address(reset=False):
         api_key = configloader.user_cfg["Bitcoin"]["api_key"]
-        url = 'https://www.blockonomics.co/api/new_address'
+        url = Blockonomics._url('new_address')
         params = {}
         if reset == True:
           params['reset'] = 1
         
         headers = {'Authorization': "Bearer " + api_key}
-        r = requests.post(url, headers=headers, params={**params, "match_callback": Blockonomics._get_secret()})
+        r = api.post(url, headers=headers, params={**params, "match_callback": Blockonomics._get_secret()}, timeout=30)
         if r.status_code == 200:
           return r
         else:
           log.error("New Address Generation Failed, Status: %s, Response: %s" % (r.status_code, r.content), exc_info=False)
           return r
 
+class RequestStats:
+    """The latencies of the requests made to an endpoint of the Blockonomics API."""
+
+    def __init__(self, window: int = 1000):
+        self.count = 0
+        self.retries = 0
+        self.failed = 0
+        self.total = 0.0
+        self.max = 0.0
+        # The latencies of the most recent requests, used to compute the percentiles
+        self._recent: typing.Deque[float] = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, duration: float, retry: bool, failed: bool) -> None:
+        with self._lock:
+            self.count += 1
+            self.retries += retry
+            self.failed += failed
+            self.total += duration
+            self.max = max(self.max, duration)
+            self._recent.append(duration)
+
+    def snapshot(self) -> typing.Dict[str, typing.Any]:
+        with self._lock:
+            recent = sorted(self._recent)
+            return {
+                "count": self.count,
+                "retries": self.retries,
+                "failed": self.failed,
+                "mean": f"{self.total / self.count if self.count else 0:.0f}",
+                "p95": f"{recent[int(len(recent) * 0.95) - 1] if recent else 0:.0f}",
+                "max": f"{self.max:.0f}",
+            }
+
+
+# Keep-alive connections to the Blockonomics API, shared by all the threads of the process
+api = requests.Session()
+_adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(10, configloader.user_cfg["Bitcoin"]["history_concurrency"]))
+api.mount("https://", _adapter)
+# Plain HTTP is only used by local stand-ins of the API, such as fakeblockonomics.py
+api.mount("http://", _adapter)
+
+# The threads requesting the chunks of the history of the pending addresses
+history_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=configloader.user_cfg["Bitcoin"]["history_concurrency"], thread_name_prefix="History")
+
+# The latencies of the requests of the chunks of the history
+history_stats = RequestStats()
+
+class PollSchedule:
+    """The moment every pending address is due to be checked again, depending on the state of its payment:
+    addresses with an unconfirmed payment are checked often, fresh ones waiting for a payment less often,
+    and the ones waiting for a long time rarely."""
+
+    def __init__(self):
+        # {address: (status, timestamp, next check)}
+        self._addresses: typing.Dict[str, typing.Tuple[int, typing.Optional[datetime.datetime], float]] = {}
+        # Heap of (next check, address); entries whose next check was changed are skipped when popped
+        self._heap: typing.List[typing.Tuple[float, str]] = []
+
+    def __len__(self):
+        return len(self._addresses)
+
+    @staticmethod
+    def interval(status: int, timestamp: typing.Optional[datetime.datetime]) -> float:
+        """The seconds between two checks of an address whose payment is in status since timestamp."""
+        cfg = configloader.user_cfg["Bitcoin"]
+        if status in (0, 1):
+            return cfg["poll_unconfirmed_interval"]
+        if status == -1 and timestamp is not None and \
+                datetime.datetime.now() - timestamp < datetime.timedelta(seconds=cfg["poll_fresh_age"]):
+            return cfg["poll_fresh_interval"]
+        return cfg["poll_stale_interval"]
+
+    def _push(self, address: str, status: int, timestamp: typing.Optional[datetime.datetime], when: float) -> None:
+        self._addresses[address] = (status, timestamp, when)
+        heapq.heappush(self._heap, (when, address))
+
+    def sync(self, payments: typing.Iterable[typing.Tuple[str, int, typing.Optional[datetime.datetime]]]) -> None:
+        """Update the schedule with the (address, status, timestamp) of the payments to check.
+        New addresses are due immediately; addresses whose status changed are checked sooner if their new state
+        requires it; addresses that aren't pending anymore are forgotten."""
+        now = time.monotonic()
+        current = {}
+        for address, status, timestamp in payments:
+            current[address] = None
+            known = self._addresses.get(address)
+            if known is None:
+                self._push(address, status, timestamp, now)
+            elif known[0] != status:
+                when = now + self.interval(status, timestamp)
+                if when < known[2]:
+                    self._push(address, status, timestamp, when)
+                else:
+                    # Pushing the same check again would make due return the address twice
+                    self._addresses[address] = (status, timestamp, known[2])
+        for address in [address for address in self._addresses if address not in current]:
+            del self._addresses[address]
+        # Rebuild the heap if it's mostly made of skipped entries
+        if len(self._heap) > 2 * len(self._addresses) + 100:
+            self._heap = [(when, address) for address, (_, _, when) in self._addresses.items()]
+            heapq.heapify(self._heap)
+
+    def due(self, limit: int) -> typing.List[str]:
+        """Get up to limit addresses due to be checked, the most overdue first."""
+        now = time.monotonic()
+        addresses = []
+        while self._heap and len(addresses) < limit and self._heap[0][0] <= now:
+            when, address = heapq.heappop(self._heap)
+            known = self._addresses.get(address)
+            if known is not None and known[2] == when:
+                addresses.append(address)
+        return addresses
+
+    def reschedule(self, addresses: typing.Iterable[str], failed: typing.Collection[str] = ()) -> None:
+        """Schedule the next check of addresses that were just checked.
+        The ones in failed couldn't be checked, so they are due again immediately."""
+        now = time.monotonic()
+        for address in addresses:
+            known = self._addresses.get(address)
+            if known is not None:
+                status, timestamp, _ = known
+                when = now if address in failed else now + self.interval(status, timestamp)
+                self._push(address, status, timestamp, when)
+
+
+class RequestBudget:
+    """A token bucket limiting the requests made to an endpoint to per_hour, with bursts of up to a twelfth of them."""
+
+    def __init__(self, per_hour: int):
+        self.rate = per_hour / 3600
+        self.capacity = max(1.0, per_hour / 12)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def available(self) -> int:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return math.floor(self._tokens)
+
+    def spend(self, requests: int) -> None:
+        self.available()
+        self._tokens -= requests
+
+
+class AddressPool:
+    """Receive addresses requested to Blockonomics in advance by a background thread, so that the users never wait
+    for the API when they need a new address. The pool is kept in the database, so it survives restarts."""
+
+    def __init__(self, engine, size: int, max_backoff: float = 600):
+        self.size = size
+        self.max_backoff = max_backoff
+        self._sessionmaker = sqlalchemy.orm.sessionmaker(bind=engine, class_=writequeue.Session)
+        # Set when an address is claimed, waking up the filler
+        self._claimed = threading.Event()
+        self._thread = threading.Thread(target=self._fill, name="AddressPool", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def claim(self, session) -> typing.Optional[str]:
+        """Take the oldest address of the pool, or None if the pool is empty.
+        The address is removed in the transaction of session, so it's claimed only if session is committed."""
+        while True:
+            pooled = session.query(db.PooledBtcAddress.id, db.PooledBtcAddress.address) \
+                .order_by(db.PooledBtcAddress.id) \
+                .first()
+            if pooled is None:
+                self._claimed.set()
+                return None
+            # Only one of the sessions claiming the same address at the same time deletes it
+            deleted = session.query(db.PooledBtcAddress) \
+                .filter(db.PooledBtcAddress.id == pooled.id) \
+                .delete(synchronize_session=False)
+            if deleted:
+                self._claimed.set()
+                return pooled.address
+
+    def _fill(self) -> None:
+        """Keep the pool full, backing off exponentially while Blockonomics doesn't give new addresses."""
+        backoff = 0.0
+        while True:
+            session = self._sessionmaker()
+            try:
+                missing = self.size - session.query(db.PooledBtcAddress).count()
+                while missing > 0:
+                    address = self._request_address()
+                    if address is None:
+                        break
+                    session.add(db.PooledBtcAddress(address=address, created_on=datetime.datetime.now()))
+                    session.commit()
+                    missing -= 1
+            except Exception as e:
+                log.error(f"Error while filling the bitcoin address pool: {e}")
+                session.rollback()
+                missing = 1
+            finally:
+                session.close()
+            if missing > 0:
+                backoff = min(self.max_backoff, backoff * 2 if backoff else 5)
+                log.warning(f"The bitcoin address pool couldn't be filled, retrying in {backoff:.0f} seconds")
+                time.sleep(backoff)
+            else:
+                backoff = 0.0
+                self._claimed.wait()
+                self._claimed.clear()
+
+    @staticmethod
+    def _request_address() -> typing.Optional[str]:
+        try:
+            r = Blockonomics.new_address()
+        except requests.RequestException as e:
+            log.error(f"New Address Generation Failed: {e}")
+            return None
+        if r.status_code != 200:
+            return None
+        return r.json().get("address")
+
+
+# The receive addresses prepared for the workers, if the pool is enabled
+address_pool: typing.Optional[AddressPool] = None
+
+
+def start_address_pool(engine, size: int) -> AddressPool:
+    """Start keeping size addresses ready for the workers."""
+    global address_pool
+    address_pool = AddressPool(engine, size=size)
+    address_pool.start()
+    return address_pool
+
+
+def new_address(session) -> typing.Optional[str]:
+    """Get a new receive address for a user: from the pool if possible, otherwise from Blockonomics directly.
+    Returns None if no address could be obtained."""
+    if address_pool is not None:
+        address = address_pool.claim(session)
+        if address is not None:
+            return address
+        log.warning("The bitcoin address pool is empty, requesting an address to Blockonomics directly")
+    return AddressPool._request_address()
+
+
+# The next check of every pending address, kept across the poll cycles
+poll_schedule = PollSchedule()
+
+# The searchhistory requests the poller can still make
+history_budget = RequestBudget(per_hour=configloader.user_cfg["Bitcoin"]["poll_hourly_budget"])
+
+# The txids of the payments already credited, which the following polls skip
+confirmed_txids = cache.TTLCache(ttl=7 * 24 * 60 * 60, maxsize=100000)
+
+# The BTC prices used by the workers and the poller
+price_cache = PriceCache(fetch=Blockonomics._fetch_btc_price,
+                         ttl=configloader.user_cfg["Bitcoin"]["price_cache_ttl"],
+                         max_stale=configloader.user_cfg["Bitcoin"]["price_max_stale"])
+
+
 class BlockonomicsPoll:
 
     def __init__(self, bot, engine) -> None:
         self.bot = bot
 
         log.debug(f"Opening new database session for Blockonomics Poll")
-        self.session = sqlalchemy.orm.sessionmaker(bind=engine)()
+        self.session = sqlalchemy.orm.sessionmaker(bind=engine, class_=writequeue.Session)()
 
     def __del__(self):
         self.session.close()
 
-    def check_for_pending_transactions(self) -> None:
+    def close(self) -> None:
+        self.session.close()
+
+    def expire_addresses(self) -> int:
+        """Stop checking at every poll the addresses that were not paid within the expiry window.
+        Returns the number of addresses expired."""
+        expiry = datetime.datetime.now() - datetime.timedelta(seconds=configloader.user_cfg["Bitcoin"]["address_expiry"])
+        result = self.session.execute(
+            sqlalchemy.update(db.BtcTransaction)
+            .where(db.BtcTransaction.status == -1, db.BtcTransaction.timestamp < expiry)
+            .values(status=db.BtcTransaction.EXPIRED)
+            .execution_options(synchronize_session=False)
+        )
+        self.session.commit()
+        if result.rowcount:
+            log.debug(f"Expired {result.rowcount} unpaid bitcoin addresses")
+        return result.rowcount
 
-        pending_addresses = [o.address for o in self.session.query(db.BtcTransaction.address).filter(db.BtcTransaction.status != 2)]
+    def check_for_pending_transactions(self, rescan: bool = False) -> None:
+        """Check the payments of the pending addresses that are due according to the poll schedule, as many as the
+        hourly budget of requests allows; if rescan, also the ones of the expired addresses given to the users in the
+        last late_payment_window seconds."""
+        self.expire_addresses()
+        payments = queries.pending_payments(self.session)
+        if rescan:
+            window = datetime.timedelta(seconds=configloader.user_cfg["Bitcoin"]["late_payment_window"])
+            payments += queries.expired_payments(self.session, since=datetime.datetime.now() - window)
+        poll_schedule.sync(payments)
+        pending_addresses = poll_schedule.due(limit=history_budget.available()
+                                              * configloader.user_cfg["Bitcoin"]["history_chunk_size"])
         if not pending_addresses: return
 
-        response = self._get_history_for_addresses(addresses=pending_addresses)
-        print("response ==== ",response)
-        # Update Pending Transactions
-        for transaction in response.get('pending', []):
-            self.handle_update(
-                address=transaction['addr'][0],
-                status=transaction['status'],
-                satoshi=transaction['value'],
-                txid=transaction['txid']
-            )
-
-        # Update Confirmed Transactions
-        for transaction in response.get('history', []):
-            self.handle_update(
-                address=transaction['addr'][0],
-                status=2,
-                satoshi=transaction['value'],
-                txid=transaction['txid']
-            )
-
-    def _get_history_for_addresses(self, addresses: list) -> dict:
-        
+        requests_before = history_stats.count
+        response, failed = self._get_history_for_addresses(addresses=pending_addresses)
+        history_budget.spend(history_stats.count - requests_before)
+        poll_schedule.reschedule(pending_addresses, failed=failed)
+        # Pending and confirmed payments are all handled at once
+        updates = [(transaction['addr'][0], transaction['status'], transaction['value'], transaction['txid'])
+                   for transaction in response.get('pending', [])]
+        updates += [(transaction['addr'][0], 2, transaction['value'], transaction['txid'])
+                    for transaction in response.get('history', [])]
+        self.handle_updates(updates)
+
+    def _get_history_for_addresses(self, addresses: list) -> typing.Tuple[dict, typing.Set[str]]:
+        """Get the transactions of the addresses, requesting them in chunks of history_chunk_size addresses
+        fetched concurrently. The transactions of the chunks that keep failing are left out, and their addresses
+        are returned with the transactions, so that they can be requested again at the next poll."""
+        size = configloader.user_cfg["Bitcoin"]["history_chunk_size"]
+        chunks = [addresses[i:i + size] for i in range(0, len(addresses), size)]
+        response = {"pending": [], "history": []}
+        failed = set()
+        for chunk, result in zip(chunks, history_executor.map(self._get_history_chunk, chunks)):
+            if result is None:
+                log.error(f"Get Payments History failed for {len(chunk)} addresses, they will be checked at the next poll")
+                failed.update(chunk)
+                continue
+            response["pending"] += result.get("pending", [])
+            response["history"] += result.get("history", [])
+        return response, failed
+
+    @staticmethod
+    def _get_history_chunk(addresses: list) -> typing.Optional[dict]:
+        """Request the transactions of a chunk of addresses, retrying with a backoff if the request fails."""
         api_key = configloader.user_cfg["Bitcoin"]["api_key"]
+        attempts = configloader.user_cfg["Bitcoin"]["history_attempts"]
 
-        url = "https://www.blockonomics.co/api/searchhistory"
+        url = Blockonomics._url("searchhistory")
         body = { "addr": ", ".join(addresses) }
-        print("body=======", body)
         headers = { "Authorization": "Bearer %s" % api_key }
 
-        r = requests.post(
-            url=url,
-            data=json.dumps(body),
-            headers=headers
-        )
-
-        if r.status_code == 200:
-            return r.json()
-        else:
-          log.error("Get Payments History failed, Status: %s, Response: %s" % (r.status_code, r.content))
-          return {"pending": [], "history": []}
+        for attempt in range(1, attempts + 1):
+            start = time.perf_counter()
+            try:
+                r = api.post(url=url, data=json.dumps(body), headers=headers, timeout=30)
+            except requests.RequestException as e:
+                log.warning("Get Payments History failed, attempt %d of %d: %s" % (attempt, attempts, e))
+                r = None
+            history_stats.add((time.perf_counter() - start) * 1000,
+                              retry=attempt > 1, failed=r is None or r.status_code != 200)
+            if r is not None:
+                if r.status_code == 200:
+                    return r.json()
+                log.warning("Get Payments History failed, attempt %d of %d, Status: %s, Response: %s"
+                            % (attempt, attempts, r.status_code, r.content))
+                # Client errors other than rate limiting won't be fixed by retrying
+                if 400 <= r.status_code < 500 and r.status_code != 429:
+                    return None
+            if attempt < attempts:
+                time.sleep(2 ** (attempt - 1))
+        return None
 
     def _satoshi_to_fiat(self, satoshi, transaction_price) -> float:
         """Convert satoshi to fiat"""
@@ -116,68 +518,228 @@ class BlockonomicsPoll:
         return re.sub(r"[^a-zA-Z0-9]", "", address)
 
     def handle_update(self, address, status, satoshi, txid) -> str:
-        """Handles Transaction Updates"""
-        
-        address = self._sanitize_address(address)
-
-        transaction = self.session.query(db.BtcTransaction).filter(db.BtcTransaction.address == address).one_or_none()
-        if transaction and transaction.txid == "":
-            
-            # Check the status
-            if transaction.status == -1:
-                current_time = datetime.datetime.now()
-                timeout = 30
-
-                # If timeout has passed, use new btc price
-                if current_time - datetime.timedelta(minutes = timeout) > datetime.datetime.strptime(transaction.timestamp, '%Y-%m-%d %H:%M:%S.%f'):
-                    transaction.price = Blockonomics.fetch_new_btc_price()
-                transaction.timestamp = current_time
-                transaction.status = 0
-                self.bot.send_message(transaction.user_id, "Payment recieved!\nYour account will be credited on confirmation.")
-            
-            if status == 2:
-                received_float = self._satoshi_to_fiat(satoshi, transaction.price)
-
-                log.info("Recieved %(received_float)s %(currency)s on address %(address)s" % {
-                    "received_float": received_float,
-                    "currency": configloader.user_cfg["Payments"]["currency"],
-                    "address": address
-                })
-
-                # Add the credit to the user account
-                user = self.session.query(db.User).filter(db.User.user_id == transaction.user_id).one_or_none()
-                user.credit += int(received_float * (10 ** int(configloader.user_cfg["Payments"]["currency_exp"])))
-
-                # Add a transaction to list
-                new_transaction = db.Transaction(
-                    user=user,
-                    value=int(received_float * (10 ** int(configloader.user_cfg["Payments"]["currency_exp"]))),
-                    provider="Bitcoin",
-                    notes = address
-                )
-
-                # Add and commit the transaction
-                self.session.add(new_transaction)
-
-                # Update the received_value for address in DB
-                transaction.value += received_float
-                transaction.txid = txid
-                transaction.status = 2
-                self.session.commit()
-
-                self.bot.send_message(
-                    transaction.user_id, 
-                    "Payment confirmed!\nYour account has been credited with %(received_float)s %(currency)s." % {
-                        "received_float": received_float,
-                        "currency": configloader.user_cfg["Payments"]["currency"]
-                    }
-                )
-
-                return "Success"
-            else:
-                self.session.commit()
-                return "Not enough confirmations"
-        else:
-            self.session.commit()
+        """Handles a single Transaction Update"""
+        return self.handle_updates([(address, status, satoshi, txid)])[0]
+
+    def handle_updates(self, updates: typing.List[typing.Tuple[str, int, int, str]]) -> typing.List[str]:
+        """Handles the (address, status, satoshi, txid) Transaction Updates of a poll cycle.
+        The affected transactions are loaded with a single query, and all the changes are committed at once;
+        the users are notified only after the commit. Returns the outcome of every update.
+
+        Every status change is a conditional update of its row, and the credit is added by the database itself:
+        if another poller handled the same payment in the meantime, the update doesn't match and nothing is credited.
+        Every payment is handled in its own savepoint, so that a payment confirmed concurrently is the only one skipped.
+        """
+        updates = [(self._sanitize_address(address), status, satoshi, txid) for address, status, satoshi, txid in updates]
+        # Payments confirmed by a previous cycle are skipped without touching the database
+        todo = [update for update in updates if confirmed_txids.get(update[3]) is None]
+        transactions = {}
+        if todo:
+            transactions = {transaction.address: transaction for transaction in self.session.query(db.BtcTransaction)
+                            .filter(db.BtcTransaction.address.in_({update[0] for update in todo}))}
+        results: typing.List[str] = []
+        messages: typing.List[typing.Tuple[int, str]] = []
+        # The txids of the payments credited by this cycle or before it
+        credited: typing.List[str] = []
+        # The users whose credit was changed by this cycle
+        credited_users: typing.Set[int] = set()
+
+        for address, status, satoshi, txid in updates:
+            transaction = transactions.get(address)
+            if confirmed_txids.get(txid) is not None or transaction is None or transaction.txid != "":
+                if transaction is not None and transaction.txid:
+                    credited.append(transaction.txid)
+                results.append("Transaction already proccessed")
+                continue
+            payment_messages: typing.List[typing.Tuple[int, str]] = []
+            try:
+                with self.session.begin_nested():
+                    result = self._handle_update(transaction, status, satoshi, txid, payment_messages)
+            except sqlalchemy.exc.IntegrityError:
+                # Another poller confirmed the same payment between the check and the update
+                log.warning(f"Payment {txid} on address {address} was credited concurrently, it was skipped")
+                credited.append(txid)
+                results.append("Transaction already proccessed")
+                continue
+            if result in ("Success", "Transaction already proccessed"):
+                credited.append(txid)
+            if result == "Success":
+                credited_users.add(transaction.user_id)
+            messages += payment_messages
+            results.append(result)
+
+        self.session.commit()
+        # The credit was changed without the ORM, so the profiles cached by the workers have to be dropped here
+        for user_id in credited_users:
+            cache.profiles.invalidate(user_id)
+        for txid in credited:
+            confirmed_txids.set(txid, True)
+        for user_id, text in messages:
+            self.bot.send_message(user_id, text)
+        return results
+
+    def _handle_update(self, transaction: db.BtcTransaction, status: int, satoshi: int, txid: str,
+                       messages: typing.List[typing.Tuple[int, str]]) -> str:
+        """Handles the update of a single payment, adding the messages for its user to messages.
+        Returns the outcome of the update."""
+        currency = configloader.user_cfg["Payments"]["currency"]
+        address = transaction.address
+        btc = db.BtcTransaction.__table__.c
+        users = db.User.__table__.c
+
+        # Check the status
+        if transaction.status in (-1, db.BtcTransaction.EXPIRED):
+            current_time = datetime.datetime.now()
+            timeout = 30
+            price = transaction.price
+
+            # If timeout has passed, use new btc price
+            if transaction.timestamp is None or current_time - datetime.timedelta(minutes = timeout) > transaction.timestamp:
+                # If no recent price is available, keep the one of the invoice
+                price = Blockonomics.fetch_new_btc_price() or price
+            seen = self.session.execute(
+                sqlalchemy.update(db.BtcTransaction.__table__)
+                .where(btc.transaction_id == transaction.transaction_id,
+                       btc.status.in_((-1, db.BtcTransaction.EXPIRED)))
+                .values(price=price, timestamp=current_time, status=0)
+            ).rowcount
+            if seen:
+                # The row was written already: the session mustn't write it again
+                set_committed_value(transaction, "price", price)
+                set_committed_value(transaction, "timestamp", current_time)
+                set_committed_value(transaction, "status", 0)
+                messages.append((transaction.user_id, "Payment recieved!\nYour account will be credited on confirmation."))
+
+        if status != 2:
+            return "Not enough confirmations"
+
+        received_float = self._satoshi_to_fiat(satoshi, transaction.price)
+        received = int(received_float * (10 ** int(configloader.user_cfg["Payments"]["currency_exp"])))
+
+        # Confirm the payment only if nobody did it before: the same payment can never be credited twice
+        other = db.BtcTransaction.__table__.alias("other").c
+        already_confirmed = sqlalchemy.exists().where(sqlalchemy.and_(other.txid == txid,
+                                                                      other.address == address,
+                                                                      other.status == db.BtcTransaction.CONFIRMED))
+        confirmed = self.session.execute(
+            sqlalchemy.update(db.BtcTransaction.__table__)
+            .where(btc.transaction_id == transaction.transaction_id,
+                   btc.txid == "",
+                   btc.status != db.BtcTransaction.CONFIRMED,
+                   ~already_confirmed)
+            .values(value=btc.value + received_float, txid=txid, status=db.BtcTransaction.CONFIRMED)
+        ).rowcount
+        if not confirmed:
+            log.info(f"Payment {txid} on address {address} was already credited by another poller")
             return "Transaction already proccessed"
-        
\ No newline at end of file
+        set_committed_value(transaction, "txid", txid)
+        set_committed_value(transaction, "status", db.BtcTransaction.CONFIRMED)
+
+        log.info("Recieved %(received_float)s %(currency)s on address %(address)s" % {
+            "received_float": received_float,
+            "currency": currency,
+            "address": address
+        })
+
+        # Add the credit to the user account
+        # The version is incremented too, so that the sessions holding the old credit can't overwrite it
+        self.session.execute(sqlalchemy.update(db.User.__table__)
+                             .where(users.user_id == transaction.user_id)
+                             .values(credit=users.credit + received, version=users.version + 1))
+
+        # Add a transaction to list
+        # Set by id, so that the transactions of the user aren't loaded to append the new one
+        self.session.add(db.Transaction(
+            user_id=transaction.user_id,
+            value=received,
+            provider="Bitcoin",
+            notes = address
+        ))
+
+        messages.append((transaction.user_id,
+                         "Payment confirmed!\nYour account has been credited with %(received_float)s %(currency)s." % {
+                             "received_float": received_float,
+                             "currency": currency
+                         }))
+        return "Success"
+
+
+class CallbackServer:
+    """The HTTP endpoint receiving the notifications Blockonomics sends to the callback URL of the store,
+    so that payments are handled as soon as they are seen instead of at the next poll.
+    Notifications are handled one at a time, each with its own database session."""
+
+    def __init__(self, bot, engine, host: str, port: int, path: str, remember: int = 10000):
+        self.bot = bot
+        self.engine = engine
+        self.path = path
+        self.remember = remember
+        # The (txid, status) of the notifications already handled, as Blockonomics repeats them
+        self._seen: "collections.OrderedDict[tuple, str]" = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._server = http.server.ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="Callbacks", daemon=True)
+
+    def start(self) -> None:
+        log.info(f"Listening for Blockonomics callbacks on port {self._server.server_address[1]}")
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                if url.path != server.path:
+                    code, body = 404, "Not found"
+                else:
+                    params = {key: values[0] for key, values in urllib.parse.parse_qs(url.query).items()}
+                    code, body = server.handle(params)
+                data = body.encode("utf8")
+                self.send_response(code)
+                self.send_header("Content-Type", "text/plain; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                log.debug(f"Callback from {self.address_string()}: {format % args}")
+
+        return Handler
+
+    def handle(self, params: dict) -> tuple:
+        """Handle the parameters of a callback, returning the HTTP status code and the body of the response.
+        Blockonomics retries the callbacks not answered with 200, so that is returned only once they are handled."""
+        secret = Blockonomics._get_secret()
+        # An empty secret would accept the callbacks without one
+        if not secret or not hmac.compare_digest(params.get("secret", "").encode("utf8"), secret.encode("utf8")):
+            log.warning("Received a Blockonomics callback with a wrong secret")
+            return 403, "Wrong secret"
+        try:
+            address = params["addr"]
+            status = int(params["status"])
+            satoshi = int(params["value"])
+            txid = params["txid"]
+        except (KeyError, ValueError):
+            return 400, "Missing or invalid parameters"
+        key = (txid, status)
+        with self._lock:
+            if key in self._seen:
+                return 200, self._seen[key]
+            poll = BlockonomicsPoll(bot=self.bot, engine=self.engine)
+            try:
+                result = poll.handle_update(address=address, status=status, satoshi=satoshi, txid=txid)
+            except Exception:
+                log.exception(f"Error while handling the Blockonomics callback for {txid}")
+                return 500, "Error"
+            finally:
+                poll.close()
+            self._seen[key] = result
+            if len(self._seen) > self.remember:
+                self._seen.popitem(last=False)
+        return 200, result
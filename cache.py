@@ -0,0 +1,59 @@
+import threading
+import time
+import typing
+
+# Sentinel returned by TTLCache.get when no default is given and the key is missing
+_missing = object()
+
+
+class TTLCache:
+    """A thread-safe dictionary whose entries expire after ttl seconds.
+    When it holds maxsize entries, the oldest ones are evicted to make space for the new ones."""
+
+    def __init__(self, ttl: float, maxsize: int = 10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data: typing.Dict[typing.Hashable, typing.Tuple[float, typing.Any]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Get the value of key, or default if it is missing or has expired."""
+        with self._lock:
+            entry = self._data.get(key, _missing)
+            if entry is not _missing:
+                expiry, value = entry
+                if expiry > time.monotonic():
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl: typing.Optional[float] = None) -> None:
+        """Store value in key, overriding the default ttl if one is given."""
+        with self._lock:
+            self._data.pop(key, None)
+            while len(self._data) >= self.maxsize:
+                del self._data[next(iter(self._data))]
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+
+    def invalidate(self, key) -> None:
+        """Remove key from the cache, if it is present."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        """Remove all the entries from the cache."""
+        with self._lock:
+            self._data.clear()
+
+
+# Detached copies of the users and admins loaded by the workers, absorbing repeated /start commands
+# Shared by the modules changing the users without the ORM, which must invalidate their entries
+# {user_id: (<User>, <Admin or None>)}
+profiles = TTLCache(ttl=10)
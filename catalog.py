@@ -0,0 +1,256 @@
+"""Bulk import and export of the product catalog.
+
+The catalog is a list of rows with the following fields, as CSV columns or as the keys of JSON objects:
+category, subcategory, product, description, price, variation, price_diff, quantity.
+Every row describes a product; if the variation field is filled, the variation is attached to the product.
+A product with more than one variation is described by one row per variation.
+
+Usage:
+    python catalog.py import catalog.csv
+    python catalog.py export catalog.json
+"""
+import csv
+import json
+import logging
+import sys
+import typing
+
+import sqlalchemy
+
+import database as db
+
+log = logging.getLogger(__name__)
+
+# The fields of a catalog row, in the order they are exported
+FIELDS = ["category", "subcategory", "product", "description", "price", "variation", "price_diff", "quantity"]
+
+
+class CatalogRowError(Exception):
+    """An error in a single row of an imported catalog."""
+
+    def __init__(self, row: int, message: str):
+        super().__init__(f"Row {row}: {message}")
+        self.row = row
+        self.message = message
+
+
+class ImportReport:
+    """The result of a catalog import."""
+
+    def __init__(self):
+        self.rows = 0
+        self.created: typing.Dict[str, int] = {"categories": 0, "subcategories": 0, "products": 0,
+                                               "variations": 0, "product_variations": 0}
+        self.updated: typing.Dict[str, int] = {"products": 0, "variations": 0}
+        self.errors: typing.List[CatalogRowError] = []
+
+    def __str__(self):
+        created = ", ".join(f"{value} {key}" for key, value in self.created.items())
+        updated = ", ".join(f"{value} {key}" for key, value in self.updated.items())
+        return f"{self.rows} rows read, {len(self.errors)} rejected\nCreated: {created}\nUpdated: {updated}"
+
+
+def read_rows(file: typing.TextIO, fmt: str) -> typing.Iterator[dict]:
+    """Read the raw rows of a catalog file, in csv or json format."""
+    if fmt == "csv":
+        yield from csv.DictReader(file)
+    elif fmt == "json":
+        data = json.load(file)
+        if not isinstance(data, list):
+            raise ValueError("A json catalog must be a list of objects")
+        yield from data
+    else:
+        raise ValueError(f"Unsupported catalog format: {fmt}")
+
+
+def _optional_number(row: dict, key: str, cast):
+    value = row.get(key)
+    if value is None or str(value).strip() == "":
+        return None
+    return cast(str(value).strip().replace(",", "."))
+
+
+def _clean_row(number: int, row: dict) -> dict:
+    """Validate a raw row, returning a dictionary containing every field with the correct type."""
+    if not isinstance(row, dict):
+        raise CatalogRowError(number, "not an object")
+    clean = {key: (str(row[key]).strip() if row.get(key) is not None else "")
+             for key in ["category", "subcategory", "product", "description", "variation"]}
+    if not clean["product"]:
+        raise CatalogRowError(number, "the product name is missing")
+    if clean["subcategory"] and not clean["category"]:
+        raise CatalogRowError(number, "a subcategory was specified without a category")
+    try:
+        clean["price"] = _optional_number(row, "price", float)
+        clean["price_diff"] = _optional_number(row, "price_diff", float)
+        clean["quantity"] = _optional_number(row, "quantity", lambda v: int(float(v)))
+    except ValueError as e:
+        raise CatalogRowError(number, f"invalid number ({e})")
+    if clean["variation"] == "" and (clean["price_diff"] is not None or clean["quantity"] is not None):
+        raise CatalogRowError(number, "variation fields were specified without a variation name")
+    return clean
+
+
+def _name_map(session, columns) -> dict:
+    return {name: id_ for id_, name in session.query(*columns)}
+
+
+def _active_products(session) -> dict:
+    return {name: id_ for id_, name in session.query(db.Product.id, db.Product.name).filter_by(deleted=False)}
+
+
+def import_catalog(session, rows: typing.Iterable[dict]) -> ImportReport:
+    """Upsert the categories, subcategories, products and variations described by rows.
+    Everything is inserted with bulk statements in a single transaction, which is committed at the end.
+    Rows containing errors are skipped and reported; the others are imported anyway."""
+    report = ImportReport()
+    valid: typing.List[dict] = []
+    for number, row in enumerate(rows, start=1):
+        report.rows += 1
+        try:
+            valid.append(_clean_row(number, row))
+        except CatalogRowError as e:
+            report.errors.append(e)
+    try:
+        # Categories
+        categories = _name_map(session, [db.Category.id, db.Category.name])
+        new_categories = {row["category"] for row in valid if row["category"]} - categories.keys()
+        session.bulk_insert_mappings(db.Category, [{"name": name} for name in new_categories])
+        report.created["categories"] = len(new_categories)
+        categories = _name_map(session, [db.Category.id, db.Category.name])
+        # Subcategories, whose names are unique across all categories
+        subcategories = _name_map(session, [db.SubCategory.id, db.SubCategory.name])
+        new_subcategories = {}
+        for row in valid:
+            if row["subcategory"] and row["subcategory"] not in subcategories:
+                new_subcategories[row["subcategory"]] = categories[row["category"]]
+        session.bulk_insert_mappings(db.SubCategory, [{"name": name, "category_id": category_id}
+                                                      for name, category_id in new_subcategories.items()])
+        report.created["subcategories"] = len(new_subcategories)
+        subcategories = _name_map(session, [db.SubCategory.id, db.SubCategory.name])
+        # Products, merging the rows that describe the same product
+        products = _active_products(session)
+        product_values: typing.Dict[str, dict] = {}
+        for row in valid:
+            product_values[row["product"]] = {
+                "name": row["product"],
+                "description": row["description"],
+                "price": row["price"],
+                "category_id": categories.get(row["category"]),
+                "sub_category_id": subcategories.get(row["subcategory"]),
+                "deleted": False,
+            }
+        session.bulk_update_mappings(db.Product, [{"id": products[name], **values}
+                                                  for name, values in product_values.items() if name in products])
+        session.bulk_insert_mappings(db.Product, [values for name, values in product_values.items()
+                                                  if name not in products])
+        report.updated["products"] = len(product_values.keys() & products.keys())
+        report.created["products"] = len(product_values.keys() - products.keys())
+        products = _active_products(session)
+        # Variations
+        variations = _name_map(session, [db.Variation.id, db.Variation.name])
+        # As variations are shared between products, only the fields that were specified are updated
+        variation_values: typing.Dict[str, dict] = {}
+        for row in valid:
+            if row["variation"]:
+                values = variation_values.setdefault(row["variation"], {"name": row["variation"]})
+                for key in ["price_diff", "quantity"]:
+                    if row[key] is not None:
+                        values[key] = row[key]
+        session.bulk_update_mappings(db.Variation, [{"id": variations[name], **values}
+                                                    for name, values in variation_values.items()
+                                                    if name in variations])
+        session.bulk_insert_mappings(db.Variation, [{"price_diff": 0.0, **values}
+                                                    for name, values in variation_values.items()
+                                                    if name not in variations])
+        report.updated["variations"] = len(variation_values.keys() & variations.keys())
+        report.created["variations"] = len(variation_values.keys() - variations.keys())
+        variations = _name_map(session, [db.Variation.id, db.Variation.name])
+        # Links between products and variations, whose ids are assigned manually like in the admin menu
+        links = set(session.query(db.ProductVariation.product_id, db.ProductVariation.variation_id))
+        new_links = []
+        for row in valid:
+            if row["variation"]:
+                link = (products[row["product"]], variations[row["variation"]])
+                if link not in links:
+                    links.add(link)
+                    new_links.append(link)
+        max_id = session.query(sqlalchemy.func.max(db.ProductVariation.id)).scalar() or 0
+        session.bulk_insert_mappings(db.ProductVariation, [
+            {"id": max_id + offset, "product_id": product_id, "variation_id": variation_id}
+            for offset, (product_id, variation_id) in enumerate(new_links, start=1)
+        ])
+        report.created["product_variations"] = len(new_links)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    log.info(f"Imported catalog: {report}")
+    return report
+
+
+def export_rows(session) -> typing.Iterator[dict]:
+    """Stream the rows describing the catalog, without loading it all in memory."""
+    query = session.query(db.Category.name, db.SubCategory.name, db.Product.name, db.Product.description,
+                          db.Product.price, db.Variation.name, db.Variation.price_diff, db.Variation.quantity) \
+        .select_from(db.Product) \
+        .outerjoin(db.Category, db.Category.id == db.Product.category_id) \
+        .outerjoin(db.SubCategory, db.SubCategory.id == db.Product.sub_category_id) \
+        .outerjoin(db.ProductVariation, db.ProductVariation.product_id == db.Product.id) \
+        .outerjoin(db.Variation, db.Variation.id == db.ProductVariation.variation_id) \
+        .filter(db.Product.deleted == False) \
+        .order_by(db.Product.id, db.ProductVariation.id) \
+        .yield_per(500)
+    for values in query:
+        yield {key: ("" if value is None else value) for key, value in zip(FIELDS, values)}
+
+
+def export_catalog(session, file: typing.TextIO, fmt: str) -> int:
+    """Write the catalog to file in csv or json format, one row at a time. Returns the number of rows written."""
+    count = 0
+    if fmt == "csv":
+        writer = csv.DictWriter(file, fieldnames=FIELDS)
+        writer.writeheader()
+        for row in export_rows(session):
+            writer.writerow(row)
+            count += 1
+    elif fmt == "json":
+        file.write("[")
+        for row in export_rows(session):
+            file.write(("," if count else "") + "\n" + json.dumps(row, ensure_ascii=False))
+            count += 1
+        file.write("\n]\n")
+    else:
+        raise ValueError(f"Unsupported catalog format: {fmt}")
+    return count
+
+
+def format_of(filename: str) -> str:
+    """Guess the format of a catalog file from its extension."""
+    return filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+
+
+def main(argv: typing.List[str]) -> int:
+    if len(argv) != 3 or argv[1] not in ["import", "export"]:
+        print(__doc__)
+        return 1
+    import configloader
+    engine = sqlalchemy.create_engine(configloader.user_cfg["Database"]["engine"])
+    session = sqlalchemy.orm.sessionmaker(bind=engine)()
+    command, filename = argv[1], argv[2]
+    if command == "import":
+        with open(filename, encoding="utf8", newline="") as file:
+            report = import_catalog(session, read_rows(file, format_of(filename)))
+        print(report)
+        for error in report.errors:
+            print(error)
+    else:
+        with open(filename, "w", encoding="utf8", newline="") as file:
+            count = export_catalog(session, file, format_of(filename))
+        print(f"{count} rows exported to {filename}")
+    session.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
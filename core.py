@@ -1,18 +1,25 @@
 import logging
 import os, sys
 import threading
+import time
 
 import sqlalchemy
-import sqlalchemy.ext.declarative as sed
 import telegram
 
 import database
 import duckbot
+import inline
 import localization
+import migrations
 import nuconfig
+import querylog
+import rollups
+import search
 import worker
+import writequeue
 
-from blockonomics import BlockonomicsPoll
+import blockonomics
+from blockonomics import BlockonomicsPoll, CallbackServer
 
 try:
     import coloredlogs
@@ -75,16 +82,39 @@ def main():
 
     # Create the database engine
     log.debug("Creating the sqlalchemy engine...")
-    engine = sqlalchemy.create_engine(user_cfg["Database"]["engine"])
+    if user_cfg["Database"]["serialize_writes"]:
+        # The connections of the sessions are shared with the writer thread
+        engine = writequeue.create_engine(user_cfg["Database"]["engine"])
+    else:
+        engine = sqlalchemy.create_engine(user_cfg["Database"]["engine"])
+    if user_cfg["Database"]["instrument_queries"]:
+        log.debug("Instrumenting the sqlalchemy engine...")
+        querylog.instrument(engine, slow_threshold=user_cfg["Database"]["slow_query_threshold"])
+    if user_cfg["Database"]["serialize_writes"]:
+        log.debug("Starting the database writer...")
+        if engine.dialect.name == "sqlite":
+            writequeue.configure_sqlite(engine, busy_timeout=30000)
+        writequeue.start(engine,
+                         max_batch=user_cfg["Database"]["write_batch_size"],
+                         max_delay=user_cfg["Database"]["write_batch_delay"] / 1000)
     log.debug("Binding metadata to the engine...")
     database.TableDeclarativeBase.metadata.bind = engine
-    log.debug("Creating all missing tables...")
-    # !TODO If you want to recreate database on development DON'T USE ON PRODUCTION
-    # Use Alembic instead !!
-    # database.TableDeclarativeBase.metadata.drop_all()
-    database.TableDeclarativeBase.metadata.create_all()
-    log.debug("Preparing the tables through deferred reflection...")
-    sed.DeferredReflection.prepare(engine)
+    # Bring the database schema up to date, or refuse to start on an outdated one
+    try:
+        if user_cfg["Database"]["migrate_on_startup"]:
+            migrations.upgrade(engine)
+        elif migrations.pending(engine):
+            log.fatal("The database schema is outdated. Run python migrations.py upgrade, then restart greed!")
+            exit(3)
+    except migrations.SchemaTooNewError as e:
+        log.fatal(f"{e}. Update greed, then restart it!")
+        exit(3)
+    search.setup(engine)
+    # Bring the sales rollups up to date before any worker can place an order
+    log.debug("Catching up with the sales rollups...")
+    rollups_session = sqlalchemy.orm.sessionmaker(bind=engine, class_=writequeue.Session)()
+    rollups.catch_up(rollups_session, currency_exp=user_cfg["Payments"]["currency_exp"])
+    rollups_session.close()
 
     # Create a bot instance
     bot = duckbot.factory(user_cfg)(request=telegram.utils.request.Request(user_cfg["Telegram"]["con_pool_size"]))
@@ -102,6 +132,11 @@ def main():
     # Creating localization object
     default_loc = localization.Localization(language=default_language, fallback=default_language)
 
+    # Prepare the catalog index used to answer the inline queries
+    inline.index.max_age = user_cfg["Telegram"]["inline_index_refresh"]
+    inline.index.results.ttl = user_cfg["Telegram"]["inline_cache_time"]
+    inline_render = inline.renderer(user_cfg, default_loc)
+
     # Create a dictionary linking the chat ids to the Worker objects
     # {"1234": <Worker>}
     chat_workers = {}
@@ -109,11 +144,39 @@ def main():
     # Current update offset; if None it will get the last 100 unparsed messages
     next_update = None
 
+    # Keep some bitcoin addresses ready, so that the users don't wait for Blockonomics to create them
+    if user_cfg["Bitcoin"]["address_pool_size"] > 0:
+        blockonomics.start_address_pool(engine, size=user_cfg["Bitcoin"]["address_pool_size"])
+
+    # Receive the Blockonomics payment notifications, if enabled: polling is then only a safety net
+    if user_cfg["Bitcoin"]["callback_port"]:
+        # Anyone could notify fake payments to a callback server without a secret
+        if user_cfg["Bitcoin"]["secret"] in ("", "YOUR_SECRET"):
+            log.fatal("The Blockonomics callbacks need a secret. Set secret in the Bitcoin section of the config file,"
+                      " then restart greed!")
+            exit(4)
+        CallbackServer(bot=bot,
+                       engine=engine,
+                       host=user_cfg["Bitcoin"]["callback_host"],
+                       port=user_cfg["Bitcoin"]["callback_port"],
+                       path=user_cfg["Bitcoin"]["callback_path"]).start()
+        poll_interval = user_cfg["Bitcoin"]["callback_poll_interval"]
+    else:
+        poll_interval = user_cfg["Bitcoin"]["poll_interval"]
+    next_poll = time.monotonic()
+    # Expired addresses are checked for late payments much less often, if at all
+    rescan_interval = user_cfg["Bitcoin"]["late_payment_rescan_interval"]
+    next_rescan = time.monotonic() + rescan_interval
+
     # Notify on the console that the bot is starting
     log.info(f"@{me.username} is starting!")
 
     # Main loop of the program
     while True:
+        # Rebuild the inline index if the catalog has changed, so that inline queries never hit the database
+        if inline.index.needs_refresh():
+            inline.index.build_in_background(sqlalchemy.orm.sessionmaker(bind=engine, class_=writequeue.Session),
+                                             inline_render, me.username)
         # Get a new batch of 100 updates and mark the last 100 parsed as read
         update_timeout = user_cfg["Telegram"]["long_polling_timeout"]
         log.debug(f"Getting updates from Telegram with a timeout of {update_timeout} seconds")
@@ -121,6 +184,11 @@ def main():
                                   timeout=update_timeout)
         # Parse all the updates
         for update in updates:
+            # If the update is an inline query, answer it from the in-memory index without starting a worker
+            if isinstance(update.inline_query, telegram.InlineQuery):
+                log.debug(f"Answering inline query from: {update.inline_query.from_user.id}")
+                inline.answer(bot, update.inline_query, cache_time=user_cfg["Telegram"]["inline_cache_time"])
+                continue
             # If the update is a message...
             if update.message is not None:
                 # Ensure the message has been sent in a private chat
@@ -145,6 +213,7 @@ def main():
                                                telegram_user=update.message.from_user,
                                                cfg=user_cfg,
                                                engine=engine,
+                                               start_payload=update.message.text[len("/start"):].strip(),
                                                daemon=True)
                     # Start the worker
                     log.debug(f"Starting {new_worker.name}")
@@ -229,8 +298,15 @@ def main():
             next_update = updates[-1].update_id + 1
 
         # Check for Transaction Updates
-        log.debug(f"Checking for Transaction Updates from Blockonomics")
-        BlockonomicsPoll(bot=bot, engine=engine).check_for_pending_transactions()
+        if time.monotonic() >= next_poll:
+            log.debug(f"Checking for Transaction Updates from Blockonomics")
+            rescan = rescan_interval > 0 and time.monotonic() >= next_rescan
+            poll = BlockonomicsPoll(bot=bot, engine=engine)
+            poll.check_for_pending_transactions(rescan=rescan)
+            poll.close()
+            next_poll = time.monotonic() + poll_interval
+            if rescan:
+                next_rescan = time.monotonic() + rescan_interval
 
 # Run the main function only in the main process
 if __name__ == "__main__":
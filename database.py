@@ -2,10 +2,13 @@ import logging
 import typing
 import requests
 import telegram
-from sqlalchemy import Column, ForeignKey, Table, UniqueConstraint
-from sqlalchemy import Integer, BigInteger, String, Text, LargeBinary, DateTime, Boolean, Float
+import types
+from sqlalchemy import Column, ForeignKey, Index, Table, UniqueConstraint
+from sqlalchemy import Integer, BigInteger, String, Text, LargeBinary, DateTime, Date, Boolean, Float
+from sqlalchemy import and_, insert, literal, select, update
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import relationship, backref, make_transient_to_detached, attributes
+import sqlalchemy
 import utils
 
 if typing.TYPE_CHECKING:
@@ -30,24 +33,32 @@ class User(TableDeclarativeBase):
 
     # Current wallet credit
     credit = Column(Integer, nullable=False)
+    # Incremented at every update: an update of a row changed by someone else since it was loaded fails
+    version = Column(Integer, nullable=False, default=0, server_default="0")
 
     # Extra table parameters
     __tablename__ = "users"
+    __mapper_args__ = {"version_id_col": version}
 
     def __init__(self, w: "worker.Worker", **kwargs):
         # Initialize the super
         super().__init__(**kwargs)
         # Get the data from telegram
-        self.user_id = w.telegram_user.id
-        self.first_name = w.telegram_user.first_name
-        self.last_name = w.telegram_user.last_name
-        self.username = w.telegram_user.username
-        if w.telegram_user.language_code:
-            self.language = w.telegram_user.language_code
-        else:
-            self.language = w.cfg["Language"]["default_language"]
-        # The starting wallet value is 0
-        self.credit = 0
+        for key, value in self.telegram_values(w).items():
+            setattr(self, key, value)
+
+    @staticmethod
+    def telegram_values(w: "worker.Worker") -> dict:
+        """Get the column values of a new user from the Telegram data available to the worker."""
+        return {
+            "user_id": w.telegram_user.id,
+            "first_name": w.telegram_user.first_name,
+            "last_name": w.telegram_user.last_name,
+            "username": w.telegram_user.username,
+            "language": w.telegram_user.language_code or w.cfg["Language"]["default_language"],
+            # The starting wallet value is 0
+            "credit": 0,
+        }
 
     def __str__(self):
         """Describe the user in the best way possible given the available data."""
@@ -70,9 +81,9 @@ class User(TableDeclarativeBase):
             return f"[{self.first_name}](tg://user?id={self.user_id})"
 
     def recalculate_credit(self):
-        """Recalculate the credit for this user by calculating the sum of the values of all their transactions."""
-        valid_transactions: typing.List[Transaction] = [t for t in self.transactions if not t.refunded]
-        self.credit = sum(map(lambda t: t.value, valid_transactions))
+        """Recalculate the credit for this user from their last balance checkpoint and the transactions after it.
+        As the credit is versioned, the commit must be done with retry_on_conflict."""
+        self.credit = wallet_balance(sqlalchemy.orm.object_session(self), self.user_id)
 
     @property
     def full_name(self):
@@ -315,7 +326,12 @@ class Transaction(TableDeclarativeBase):
 
     # Extra table parameters
     __tablename__ = "transactions"
-    __table_args__ = (UniqueConstraint("provider", "provider_charge_id"),)
+    __table_args__ = (UniqueConstraint("provider", "provider_charge_id"),
+                      # Used to sum the transactions of a user after their balance checkpoint
+                      Index("transactions_user", "user_id", "transaction_id"),
+                      # Refunds are rare: only the refunded transactions are indexed
+                      Index("transactions_user_refunded", "user_id",
+                            sqlite_where=sqlalchemy.text("refunded = 1"), postgresql_where=sqlalchemy.text("refunded")))
 
     def text(self, w: "worker.Worker"):
         string = f"<b>T{self.transaction_id}</b> | {str(self.user)} | {w.Price(self.value)}"
@@ -350,14 +366,25 @@ class BtcTransaction(TableDeclarativeBase):
     price = Column(Float)
     value = Column(Float)
     currency = Column(Text)
+    # -2 expired, -1 waiting for a payment, 0 and 1 payment unconfirmed, 2 payment confirmed
     status = Column(Integer, nullable=False)
-    timestamp = Column(Integer)
+    # The moment the address was given to the user, or the payment was first seen
+    timestamp = Column(DateTime)
     # Extra notes on the transaction
     address = Column(Text)
     txid = Column(Text)
 
+    # Statuses of the addresses that are not checked at every poll
+    EXPIRED = -2
+    CONFIRMED = 2
+
     # Extra table parameters
     __tablename__ = "btc_transactions"
+    __table_args__ = (Index("btc_transactions_status", "status", "timestamp"),
+                      # A payment can be credited only once, even by concurrent pollers;
+                      # the address is part of the key, as a single bitcoin transaction can pay several addresses
+                      Index("btc_transactions_confirmed_txid", "txid", "address", unique=True,
+                            sqlite_where=sqlalchemy.text("status = 2"), postgresql_where=sqlalchemy.text("status = 2")))
 
     def __str__(self):
         string = f"<b>T{self.transaction_id}</b> | {str(self.user)} | {str(self.price)} | {str(self.value)} | {str(self.currency)} | {str(self.status)} | {str(self.timestamp)} | {str(self.address)}"
@@ -368,6 +395,23 @@ class BtcTransaction(TableDeclarativeBase):
     def __repr__(self):
         return f"<Transaction {self.transaction_id} for User {self.user_id} {str(self)}>"
 
+class PooledBtcAddress(TableDeclarativeBase):
+    """A receive address requested to Blockonomics in advance and not given to any user yet.
+    Filled by the address pool of the blockonomics module, and claimed by the workers when a user needs an address."""
+
+    # The order the addresses are claimed in
+    id = Column(Integer, primary_key=True)
+    address = Column(Text, nullable=False, unique=True)
+    # The moment the address was requested
+    created_on = Column(DateTime, nullable=False)
+
+    # Extra table parameters
+    __tablename__ = "btc_address_pool"
+
+    def __repr__(self):
+        return f"<PooledBtcAddress {self.address}>"
+
+
 class Admin(TableDeclarativeBase):
     """A greed administrator with his permissions."""
 
@@ -390,6 +434,27 @@ class Admin(TableDeclarativeBase):
         return f"<Admin {self.user_id}>"
 
 
+class BalanceCheckpoint(TableDeclarativeBase):
+    """The sum of the values of the transactions of a user, up to one of them.
+    Refunded transactions are included as well, so that a checkpoint is never invalidated by a later refund.
+    Maintained by the ledger module."""
+
+    # The user whose transactions are summed
+    user_id = Column(BigInteger, ForeignKey("users.user_id"), primary_key=True)
+    # The last transaction included in the total
+    transaction_id = Column(Integer, nullable=False)
+    # The sum of the values of the transactions of the user up to transaction_id, refunded ones included
+    total = Column(Integer, nullable=False)
+    # The moment the checkpoint was last advanced
+    created_on = Column(DateTime, nullable=False)
+
+    # Extra table parameters
+    __tablename__ = "balance_checkpoints"
+
+    def __repr__(self):
+        return f"<BalanceCheckpoint of User {self.user_id} at Transaction {self.transaction_id}>"
+
+
 class Order(TableDeclarativeBase):
     """An order which has been placed by an user.
     It may include multiple products, available in the OrderItem table."""
@@ -472,4 +537,146 @@ class OrderItem(TableDeclarativeBase):
         return f"{self.product.name} - {str(w.Price(self.product.price))}"
 
     def __repr__(self):
-        return f"<OrderItem {self.item_id}>"
\ No newline at end of file
+        return f"<OrderItem {self.item_id}>"
+
+class DailySales(TableDeclarativeBase):
+    """The sales totals of a single day.
+    Maintained incrementally by the rollups module, so that statistics never have to scan the orders."""
+
+    # The day the totals refer to
+    day = Column(Date, primary_key=True)
+    # Number of orders placed
+    orders = Column(Integer, nullable=False, default=0)
+    # Value of the orders placed, in minimum currency units
+    revenue = Column(Integer, nullable=False, default=0)
+    # Number of orders refunded
+    refunds = Column(Integer, nullable=False, default=0)
+    # Value of the orders refunded, in minimum currency units
+    refunded = Column(Integer, nullable=False, default=0)
+
+    # Extra table parameters
+    __tablename__ = "sales_daily"
+
+    def __repr__(self):
+        return f"<DailySales {self.day}>"
+
+
+class HourlySales(TableDeclarativeBase):
+    """The sales totals of a single hour.
+    Maintained incrementally by the rollups module, so that statistics never have to scan the orders."""
+
+    # The start of the hour the totals refer to
+    hour = Column(DateTime, primary_key=True)
+    # Number of orders placed
+    orders = Column(Integer, nullable=False, default=0)
+    # Value of the orders placed, in minimum currency units
+    revenue = Column(Integer, nullable=False, default=0)
+    # Number of orders refunded
+    refunds = Column(Integer, nullable=False, default=0)
+    # Value of the orders refunded, in minimum currency units
+    refunded = Column(Integer, nullable=False, default=0)
+
+    # Extra table parameters
+    __tablename__ = "sales_hourly"
+
+    def __repr__(self):
+        return f"<HourlySales {self.hour}>"
+
+
+class ProductSales(TableDeclarativeBase):
+    """The number of copies of a product sold in a single day."""
+
+    # The day the totals refer to
+    day = Column(Date, primary_key=True)
+    # The product that was sold
+    product_id = Column(Integer, ForeignKey("products.id"), primary_key=True)
+    product = relationship("Product")
+    # Number of copies sold
+    quantity = Column(Integer, nullable=False, default=0)
+    # Value of the copies sold, in minimum currency units
+    revenue = Column(Integer, nullable=False, default=0)
+
+    # Extra table parameters
+    __tablename__ = "sales_products"
+
+    def __repr__(self):
+        return f"<ProductSales {self.product_id} on {self.day}>"
+
+
+def wallet_balance(session, user_id: int) -> int:
+    """Compute the credit of a user from the values of their transactions, ignoring the refunded ones.
+    Only the transactions after the balance checkpoint of the user are summed, plus the refunded ones before it."""
+    checkpoint = session.query(BalanceCheckpoint.transaction_id, BalanceCheckpoint.total) \
+        .filter(BalanceCheckpoint.user_id == user_id) \
+        .one_or_none()
+    since, total = checkpoint if checkpoint is not None else (0, 0)
+    refunded = sqlalchemy.func.coalesce(Transaction.refunded, False)
+    after = session.query(sqlalchemy.func.coalesce(sqlalchemy.func.sum(Transaction.value), 0)) \
+        .filter(Transaction.user_id == user_id, Transaction.transaction_id > since, refunded == False) \
+        .scalar()
+    if checkpoint is None:
+        return after
+    refunded_before = session.query(sqlalchemy.func.coalesce(sqlalchemy.func.sum(Transaction.value), 0)) \
+        .filter(Transaction.user_id == user_id, Transaction.transaction_id <= since, Transaction.refunded == True) \
+        .scalar()
+    return total + after - refunded_before
+
+
+def upsert(session, model, values: dict, index_elements: typing.List[str], set_=None):
+    """Insert a row into the table of model, or update it if a row with the same index_elements already exists.
+    set_ is a function receiving the row that was going to be inserted and returning the columns to update;
+    if it is None, existing rows are left untouched.
+    Uses the native ON CONFLICT clause on engines that support it, otherwise falls back to UPDATE then INSERT."""
+    table = model.__table__
+    dialect = session.get_bind().dialect.name
+    if dialect in ["sqlite", "postgresql"]:
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        statement = dialect_insert(table).values(**values)
+        if set_ is None:
+            statement = statement.on_conflict_do_nothing(index_elements=index_elements)
+        else:
+            statement = statement.on_conflict_do_update(index_elements=index_elements,
+                                                        set_=set_(statement.excluded))
+        return session.execute(statement)
+    # Generic fallback, which isn't atomic
+    where = and_(*[table.c[key] == values[key] for key in index_elements])
+    if set_ is not None:
+        excluded = types.SimpleNamespace(**{key: literal(value) for key, value in values.items()})
+        result = session.execute(update(table).where(where).values(set_(excluded)))
+        if result.rowcount:
+            return result
+    elif session.execute(select(table.c[index_elements[0]]).where(where)).first() is not None:
+        return None
+    return session.execute(insert(table).values(**values))
+
+
+def detached_copy(instance):
+    """Create a detached copy of a loaded instance, which can be attached to any session with merge(load=False).
+    Only the column attributes are copied; relationships will be lazily loaded by the session it's merged into."""
+    mapper = sqlalchemy.inspect(instance).mapper
+    copy = mapper.class_manager.new_instance()
+    for column in mapper.column_attrs:
+        attributes.set_committed_value(copy, column.key, getattr(instance, column.key))
+    make_transient_to_detached(copy)
+    return copy
+
+
+def retry_on_conflict(session, function: typing.Callable, attempts: int = 5):
+    """Call function, then commit the session.
+    If a versioned row updated by function was changed by another transaction in the meantime, the commit fails:
+    in that case everything is rolled back and function is called again, reading the new values.
+    function must redo all the changes of the transaction, as the ones made before are discarded by the rollback."""
+    for attempt in range(1, attempts + 1):
+        try:
+            result = function()
+            session.commit()
+            return result
+        except sqlalchemy.orm.exc.StaleDataError:
+            session.rollback()
+            if attempt == attempts:
+                raise
+            log.debug(f"Concurrent update detected, retrying (attempt {attempt + 1} of {attempts})")
+
@@ -1,25 +1,65 @@
-from datetime import datetime, timedelta
-from apscheduler.schedulers.background import BackgroundScheduler
+import logging
+
+from apscheduler.schedulers.blocking import BlockingScheduler
 import sqlalchemy
+import sqlalchemy.orm
 
+import backup
 import database as db
+import ledger
+import nuconfig
+
+log = logging.getLogger(__name__)
+
+with open("config/config.toml", encoding="utf8") as user_cfg_file:
+    user_cfg = nuconfig.NuConfig(user_cfg_file)
+logging.basicConfig(level=user_cfg["Logging"]["level"], format=user_cfg["Logging"]["format"], style="{")
 
 engine = sqlalchemy.create_engine(user_cfg["Database"]["engine"])
-session = sqlalchemy.orm.sessionmaker(bind=engine)()
+Session = sqlalchemy.orm.sessionmaker(bind=engine)
+
 
 # create a function to delete old data from the table
 def delete_old_data():
-    # create a SQL query to delete rows older than 1 day
-    old_product=session.query(db.Product).filter(db.Product.deleted == True).all()    
-    print(old_product)
+    session = Session()
+    # delete the products marked as deleted
+    old_product = session.query(db.Product).filter(db.Product.deleted == True).all()
     for product in old_product:
-        print(product)
+        log.debug(f"Deleting {product}")
         session.delete(product)
 
     session.commit()
+    session.close()
+
+
+def checkpoint_balances():
+    session = Session()
+    ledger.checkpoint(session, min_transactions=user_cfg["Database"]["checkpoint_min_transactions"],
+                      margin=user_cfg["Database"]["checkpoint_margin"])
+    session.close()
+
+
+def reconcile_ledger():
+    session = Session()
+    ledger.reconcile(session, fix=user_cfg["Database"]["reconcile_repair"])
+    session.close()
+
+
+def backup_database():
+    backup.backup(engine,
+                  directory=user_cfg["Database"]["backup_directory"],
+                  keep=user_cfg["Database"]["backup_keep"],
+                  compress=user_cfg["Database"]["backup_compress"])
+
 
 delete_old_data()
-# create a scheduler that runs the delete_old_data function every day
-scheduler = BackgroundScheduler()
+checkpoint_balances()
+reconcile_ledger()
+# create a scheduler that runs the jobs periodically
+scheduler = BlockingScheduler()
 scheduler.add_job(delete_old_data, 'interval', days=1)
-scheduler.start()
\ No newline at end of file
+scheduler.add_job(checkpoint_balances, 'interval', seconds=user_cfg["Database"]["checkpoint_interval"])
+scheduler.add_job(reconcile_ledger, 'interval', seconds=user_cfg["Database"]["reconcile_interval"])
+if user_cfg["Database"]["backup_interval"] > 0:
+    scheduler.add_job(backup_database, 'interval', seconds=user_cfg["Database"]["backup_interval"])
+scheduler.start()
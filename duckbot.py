@@ -30,6 +30,12 @@ def factory(cfg: nuconfig.NuConfig):
                     time.sleep(cfg["Telegram"]["timed_out_pause"])
                 # Telegram is not reachable
                 except telegram.error.NetworkError as error:
+                    # Edits leaving the message as it is are refused with a BadRequest, which retrying can't fix:
+                    # it happens when the page of a menu already displayed is selected again
+                    if isinstance(error, telegram.error.BadRequest) and \
+                            error.message.lower().startswith("message is not modified"):
+                        log.debug(f"{func.__name__}() didn't change the message, skipping.")
+                        break
                     log.error(f"Network error while calling {func.__name__}(),"
                               f" retrying in {cfg['Telegram']['error_pause']} secs...\n"
                               f"Full error: {error.message}")
@@ -88,6 +94,10 @@ def factory(cfg: nuconfig.NuConfig):
         def answer_callback_query(self, *args, **kwargs):
             return self.bot.answer_callback_query(*args, **kwargs)
 
+        @catch_telegram_errors
+        def answer_inline_query(self, *args, **kwargs):
+            return self.bot.answer_inline_query(*args, **kwargs)
+
         @catch_telegram_errors
         def answer_pre_checkout_query(self, *args, **kwargs):
             return self.bot.answer_pre_checkout_query(*args, **kwargs)
@@ -0,0 +1,333 @@
+"""A local stand-in for the Blockonomics API, to exercise and load test the bitcoin payments offline.
+
+It implements the endpoints used by greed:
+    GET  /api/price?currency=USD
+    POST /api/new_address
+    POST /api/searchhistory
+The payments to the addresses it gives out follow scripted timelines: every step of a timeline sets the status of
+the payment after a delay, so that it's seen unconfirmed first and confirmed later. Latency and errors can be
+injected in every endpoint, and the status changes can be notified to a callback URL like Blockonomics does.
+
+To use it, set api_url in the [Bitcoin] section of the configuration to its URL, for example
+http://127.0.0.1:8088/api
+
+Usage:
+    python fakeblockonomics.py [--port 8088] [--price 20000] [--script payments.json]
+                               [--pay-every SATOSHI] [--confirm-after SECONDS]
+                               [--latency SECONDS] [--error-rate RATE] [--callback-url URL --secret SECRET]
+
+The script is a JSON list of payments, each like {"address": 0, "satoshi": 100000, "timeline": [[0, 0], [60, 2]]}:
+address is either an address or the index of an address in the order they are given out, which is paid as soon as
+it's given out; the timeline is a list of [seconds after the payment, status] steps.
+"""
+import argparse
+import collections
+import hashlib
+import http.server
+import json
+import logging
+import random
+import threading
+import time
+import typing
+import urllib.parse
+
+import requests
+
+log = logging.getLogger(__name__)
+
+# Seen unconfirmed immediately, then confirmed a minute later
+DEFAULT_TIMELINE = ((0, 0), (30, 1), (60, 2))
+
+
+class Fault(typing.NamedTuple):
+    """The misbehaviour injected in an endpoint."""
+    # Seconds waited before answering, plus a random part up to jitter
+    latency: float = 0.0
+    jitter: float = 0.0
+    # Probability of answering with the error status instead
+    error_rate: float = 0.0
+    status: int = 500
+
+
+class Payment:
+    """A payment to an address, whose status changes along its timeline."""
+
+    def __init__(self, address: str, satoshi: int, txid: str, created: float,
+                 timeline: typing.Sequence[typing.Tuple[float, int]]):
+        self.address = address
+        self.satoshi = satoshi
+        self.txid = txid
+        self.created = created
+        self.timeline = sorted(timeline)
+        # The last status notified to the callback URL
+        self.notified: typing.Optional[int] = None
+
+    def status(self, now: float) -> typing.Optional[int]:
+        """Get the status of the payment at the time now, or None if it isn't visible yet."""
+        status = None
+        for delay, step in self.timeline:
+            if now - self.created < delay:
+                break
+            status = step
+        return status
+
+    def as_json(self, status: int) -> dict:
+        data = {"addr": [self.address], "txid": self.txid, "value": self.satoshi, "time": int(self.created)}
+        if status != 2:
+            data["status"] = status
+        return data
+
+
+class FakeBlockonomics:
+    """The fake API server. It's started in a thread, so that it can be used from the tests and the benchmarks;
+    the payments can be scripted while it's running."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, price: float = 20000.0,
+                 api_key: typing.Optional[str] = None, gap_limit: int = 20,
+                 callback_url: typing.Optional[str] = None, secret: str = "",
+                 clock: typing.Callable[[], float] = time.time, seed: typing.Optional[int] = None):
+        self.price = price
+        self.api_key = api_key
+        self.gap_limit = gap_limit
+        self.callback_url = callback_url
+        self.secret = secret
+        self.clock = clock
+        self._random = random.Random(seed)
+        # Different servers give out different addresses, the same ones for the same seed
+        self._salt = f"{self._random.getrandbits(64):016x}"
+        self._lock = threading.Lock()
+        # The addresses given out, in order
+        self.addresses: typing.List[str] = []
+        self.payments: typing.Dict[str, typing.List[Payment]] = collections.defaultdict(list)
+        # The payments to the addresses not given out yet, by index
+        self._scripted: typing.Dict[int, typing.List[typing.Tuple[int, typing.Sequence]]] = \
+            collections.defaultdict(list)
+        self._payment_count = 0
+        self._auto_pay: typing.Optional[typing.Tuple[int, typing.Sequence]] = None
+        self._faults: typing.Dict[typing.Optional[str], Fault] = {}
+        # Traffic counters, by endpoint
+        self.requests: typing.Counter[str] = collections.Counter()
+        self.errors: typing.Counter[str] = collections.Counter()
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self._server = http.server.ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="FakeBlockonomics", daemon=True)
+        self._stop = threading.Event()
+        self._notifier = threading.Thread(target=self._notify, name="FakeCallbacks", daemon=True)
+
+    @property
+    def url(self) -> str:
+        """The URL to use as api_url."""
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/api"
+
+    def start(self) -> "FakeBlockonomics":
+        self._thread.start()
+        if self.callback_url:
+            self._notifier.start()
+        log.info(f"Fake Blockonomics API listening at {self.url}")
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def set_fault(self, endpoint: typing.Optional[str] = None, **kwargs) -> None:
+        """Inject a Fault in an endpoint, such as "searchhistory", or in all of them if endpoint is None."""
+        self._faults[endpoint] = Fault(**kwargs)
+
+    def pay(self, address: typing.Union[str, int], satoshi: int,
+            timeline: typing.Sequence[typing.Tuple[float, int]] = DEFAULT_TIMELINE) -> typing.Optional[Payment]:
+        """Pay satoshi to an address, or to the address with that index as soon as it's given out.
+        Returns the payment, or None if it was scheduled for an address not given out yet."""
+        with self._lock:
+            if isinstance(address, int):
+                if address >= len(self.addresses):
+                    self._scripted[address].append((satoshi, timeline))
+                    return None
+                address = self.addresses[address]
+            return self._add_payment(address, satoshi, timeline)
+
+    def auto_pay(self, satoshi: int, timeline: typing.Sequence[typing.Tuple[float, int]] = DEFAULT_TIMELINE) -> None:
+        """Pay satoshi to every address given out from now on."""
+        self._auto_pay = (satoshi, timeline)
+
+    def load_script(self, script: typing.List[dict]) -> None:
+        for payment in script:
+            timeline = [tuple(step) for step in payment.get("timeline", DEFAULT_TIMELINE)]
+            self.pay(payment["address"], payment["satoshi"], timeline)
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        return {"requests": dict(self.requests), "errors": dict(self.errors),
+                "bytes_received": self.bytes_received, "bytes_sent": self.bytes_sent}
+
+    def _add_payment(self, address: str, satoshi: int, timeline) -> Payment:
+        self._payment_count += 1
+        txid = hashlib.sha256(f"{address}:{self._payment_count}".encode("utf8")).hexdigest()
+        payment = Payment(address, satoshi, txid, self.clock(), timeline)
+        self.payments[address].append(payment)
+        return payment
+
+    # The endpoints, each returning the HTTP status and the JSON body of the response
+
+    def price_endpoint(self, params: dict, body: bytes) -> typing.Tuple[int, dict]:
+        if "currency" not in params:
+            return 400, {"message": "currency is required"}
+        return 200, {"price": self.price}
+
+    def new_address_endpoint(self, params: dict, body: bytes) -> typing.Tuple[int, dict]:
+        with self._lock:
+            # Like Blockonomics, no more addresses are given out after gap_limit unused ones in a row
+            unused = 0
+            for address in reversed(self.addresses):
+                if self.payments.get(address):
+                    break
+                unused += 1
+            if self.gap_limit and unused >= self.gap_limit:
+                if params.get("reset") == "1":
+                    return 200, {"address": self.addresses[-1], "reset": 1}
+                return 400, {"message": "Gap limit exceeded, use the reset parameter to reuse an unused address"}
+            index = len(self.addresses)
+            address = "bc1qfake" + hashlib.sha256(f"{self._salt}:{index}".encode("utf8")).hexdigest()[:32]
+            self.addresses.append(address)
+            for satoshi, timeline in self._scripted.pop(index, []):
+                self._add_payment(address, satoshi, timeline)
+            if self._auto_pay is not None:
+                self._add_payment(address, *self._auto_pay)
+        return 200, {"address": address, "reset": 0}
+
+    def searchhistory_endpoint(self, params: dict, body: bytes) -> typing.Tuple[int, dict]:
+        try:
+            addresses = [address.strip() for address in json.loads(body)["addr"].split(",")]
+        except (ValueError, KeyError, AttributeError):
+            return 400, {"message": "addr is required"}
+        now = self.clock()
+        response = {"pending": [], "history": []}
+        with self._lock:
+            for address in addresses:
+                for payment in self.payments.get(address, []):
+                    status = payment.status(now)
+                    if status is None:
+                        continue
+                    response["history" if status == 2 else "pending"].append(payment.as_json(status))
+        return 200, response
+
+    def _respond(self, endpoint: str, method: str, params: dict, headers, body: bytes) -> typing.Tuple[int, dict]:
+        handler = {("GET", "price"): self.price_endpoint,
+                   ("POST", "new_address"): self.new_address_endpoint,
+                   ("POST", "searchhistory"): self.searchhistory_endpoint}.get((method, endpoint))
+        if handler is None:
+            return 404, {"message": "Not found"}
+        with self._lock:
+            self.requests[endpoint] += 1
+        fault = self._faults.get(endpoint) or self._faults.get(None)
+        if fault is not None:
+            delay = fault.latency + self._random.uniform(0, fault.jitter)
+            if delay > 0:
+                time.sleep(delay)
+            if self._random.random() < fault.error_rate:
+                with self._lock:
+                    self.errors[endpoint] += 1
+                return fault.status, {"message": "Injected error"}
+        if self.api_key is not None and endpoint != "price" and \
+                headers.get("Authorization") != f"Bearer {self.api_key}":
+            with self._lock:
+                self.errors[endpoint] += 1
+            return 401, {"message": "Invalid API key"}
+        return handler(params, body)
+
+    def _handler(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # The headers and the body are written separately: without this, every response waits for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def _handle(self, method: str):
+                url = urllib.parse.urlsplit(self.path)
+                params = {key: values[0] for key, values in urllib.parse.parse_qs(url.query).items()}
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                endpoint = url.path[len("/api/"):] if url.path.startswith("/api/") else ""
+                code, response = server._respond(endpoint, method, params, self.headers, body)
+                data = json.dumps(response).encode("utf8")
+                with server._lock:
+                    server.bytes_received += len(body)
+                    server.bytes_sent += len(data)
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+            def log_message(self, format, *args):
+                log.debug(f"{self.address_string()}: {format % args}")
+
+        return Handler
+
+    def _notify(self) -> None:
+        """Send the status changes of the payments to the callback URL, retrying the ones not answered with 200."""
+        while not self._stop.wait(0.1):
+            now = self.clock()
+            with self._lock:
+                changed = [(payment, status) for payments in self.payments.values() for payment in payments
+                           for status in [payment.status(now)] if status is not None and status != payment.notified]
+            for payment, status in changed:
+                try:
+                    r = requests.get(self.callback_url, timeout=10,
+                                     params={"secret": self.secret, "addr": payment.address, "status": status,
+                                             "value": payment.satoshi, "txid": payment.txid})
+                except requests.RequestException as e:
+                    log.warning(f"Callback for {payment.txid} failed: {e}")
+                    continue
+                if r.status_code == 200:
+                    payment.notified = status
+                else:
+                    log.warning(f"Callback for {payment.txid} answered {r.status_code}: {r.text}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8088)
+    parser.add_argument("--price", type=float, default=20000.0, help="the BTC price returned")
+    parser.add_argument("--api-key", help="the API key required by the endpoints, any if not given")
+    parser.add_argument("--script", metavar="FILE", help="JSON list of the payments to make")
+    parser.add_argument("--pay-every", type=int, metavar="SATOSHI", help="pay every address given out")
+    parser.add_argument("--confirm-after", type=float, default=60, help="seconds before the payments are confirmed")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds waited before every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random seconds added to the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of the requests failing with 500")
+    parser.add_argument("--callback-url", help="where to notify the status changes of the payments")
+    parser.add_argument("--secret", default="", help="the secret sent to the callback URL")
+    args = parser.parse_args()
+    logging.basicConfig(level="INFO", format="{levelname} {message}", style="{")
+    fake = FakeBlockonomics(host=args.host, port=args.port, price=args.price, api_key=args.api_key,
+                            callback_url=args.callback_url, secret=args.secret)
+    if args.latency or args.jitter or args.error_rate:
+        fake.set_fault(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+    if args.script:
+        with open(args.script, encoding="utf8") as file:
+            fake.load_script(json.load(file))
+    if args.pay_every:
+        fake.auto_pay(args.pay_every, timeline=((0, 0), (args.confirm_after, 2)))
+    fake.start()
+    try:
+        while True:
+            time.sleep(60)
+            log.info(f"Traffic: {fake.stats()}")
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""Answers to the inline queries (@bot words) sent from any chat, served from an in-memory index of the catalog."""
+import itertools
+import logging
+import threading
+import time
+import types
+import typing
+
+import sqlalchemy
+import telegram
+
+import cache
+import database as db
+import search
+
+log = logging.getLogger(__name__)
+
+# The maximum length of the indexed word prefixes; longer words are checked against the full words
+MAX_PREFIX = 16
+
+# The maximum number of results of an inline query accepted by Telegram
+MAX_RESULTS = 50
+
+# The fraction of the trigrams of a word that must be found in a product for a fuzzy match
+TRIGRAM_THRESHOLD = 0.5
+
+
+def trigrams(word: str) -> typing.Set[str]:
+    padded = f" {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class Entry:
+    """A product of the index, with its inline query result already built."""
+    __slots__ = ("id", "name", "name_words", "words", "result")
+
+    def __init__(self, id_: int, name: str, name_words: typing.Set[str], words: typing.Set[str], result):
+        self.id = id_
+        self.name = name
+        self.name_words = name_words
+        self.words = words
+        self.result = result
+
+
+class ProductIndex:
+    """A prefix and trigram index of the words of the names, descriptions and variations of the products for sale.
+    It's rebuilt as a whole and swapped atomically, so it can be searched from any thread without locking."""
+
+    def __init__(self, cache_ttl: float = 30, max_age: float = 300):
+        self.max_age = max_age
+        # Set when the catalog was changed since the last build
+        self.stale = True
+        self.built_at = 0.0
+        self.results = cache.TTLCache(ttl=cache_ttl, maxsize=1000)
+        # The entries by id, and the ids of the entries by word prefix and by trigram
+        self._data: typing.Tuple[dict, dict, dict] = ({}, {}, {})
+        self._build_lock = threading.Lock()
+        self._building = False
+
+    def __len__(self):
+        return len(self._data[0])
+
+    def needs_refresh(self) -> bool:
+        return self.stale or time.monotonic() - self.built_at > self.max_age
+
+    def build(self, session, render, bot_username: str) -> None:
+        """Load the products for sale with a single query and replace the index with a new one.
+        render must have the loc and Price attributes of a worker, and is used to format the results."""
+        with self._build_lock:
+            self.stale = False
+            started = time.perf_counter()
+            # Only the columns shown in the results: the images would be loaded for nothing
+            rows = session.query(db.Product, db.Variation.name) \
+                .options(sqlalchemy.orm.load_only(db.Product.name, db.Product.description, db.Product.price)) \
+                .outerjoin(db.ProductVariation, db.ProductVariation.product_id == db.Product.id) \
+                .outerjoin(db.Variation, db.Variation.id == db.ProductVariation.variation_id) \
+                .filter(db.Product.deleted == False, db.Product.price.isnot(None)) \
+                .order_by(db.Product.name, db.Product.id) \
+                .all()
+            entries: typing.Dict[int, Entry] = {}
+            prefixes: typing.Dict[str, typing.Set[int]] = {}
+            trigram_map: typing.Dict[str, typing.Set[int]] = {}
+            for product, group in itertools.groupby(rows, key=lambda row: row[0]):
+                variations = [name for _, name in group if name is not None]
+                name_words = set(search.words(product.name))
+                words = name_words | set(search.words(product.description or "")) | \
+                    set(search.words(" ".join(variations)))
+                entries[product.id] = Entry(product.id, product.name, name_words, words,
+                                            self._result(product, variations, render, bot_username))
+                for word in words:
+                    for length in range(1, min(len(word), MAX_PREFIX) + 1):
+                        prefixes.setdefault(word[:length], set()).add(product.id)
+                    for trigram in trigrams(word):
+                        trigram_map.setdefault(trigram, set()).add(product.id)
+            self._data = (entries, prefixes, trigram_map)
+            self.results.clear()
+            self.built_at = time.monotonic()
+            log.debug(f"Built the inline index of {len(entries)} products"
+                      f" in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+    def build_in_background(self, session_factory, render, bot_username: str) -> None:
+        """Build the index in a new thread with a session of session_factory, unless a build is already running.
+        The current index keeps being searched until the new one replaces it."""
+        if self._building:
+            return
+        self._building = True
+
+        def run():
+            session = session_factory()
+            try:
+                self.build(session, render, bot_username)
+            except Exception:
+                log.exception("Could not build the inline index")
+                self.stale = True
+            finally:
+                session.close()
+                self._building = False
+
+        threading.Thread(target=run, name="InlineIndex", daemon=True).start()
+
+    @staticmethod
+    def _result(product: db.Product, variations: typing.List[str], render, bot_username: str):
+        price = str(render.Price(product.price))
+        description = price if not variations else f"{price} | {', '.join(variations)}"
+        if product.description:
+            description += f"\n{product.description}"
+        keyboard = telegram.InlineKeyboardMarkup([[telegram.InlineKeyboardButton(
+            render.loc.get("menu_order"), url=f"https://t.me/{bot_username}?start=product_{product.id}"
+        )]])
+        return telegram.InlineQueryResultArticle(
+            id=str(product.id),
+            title=product.name,
+            description=description,
+            input_message_content=telegram.InputTextMessageContent(product.text(w=render), parse_mode="HTML"),
+            reply_markup=keyboard
+        )
+
+    @staticmethod
+    def _matches(data, term: str) -> typing.Dict[int, float]:
+        """Find the products containing a word starting with term, or failing that, a word similar to it."""
+        entries, prefixes, trigram_map = data
+        ids = prefixes.get(term[:MAX_PREFIX], set())
+        if len(term) > MAX_PREFIX:
+            ids = {id_ for id_ in ids if any(word.startswith(term) for word in entries[id_].words)}
+        if ids:
+            return {id_: 3.0 if any(word.startswith(term) for word in entries[id_].name_words) else 1.0
+                    for id_ in ids}
+        if len(term) < 3:
+            return {}
+        term_trigrams = trigrams(term)
+        counts: typing.Dict[int, int] = {}
+        for trigram in term_trigrams:
+            for id_ in trigram_map.get(trigram, ()):
+                counts[id_] = counts.get(id_, 0) + 1
+        return {id_: count / len(term_trigrams) for id_, count in counts.items()
+                if count / len(term_trigrams) >= TRIGRAM_THRESHOLD}
+
+    def search(self, text: str) -> list:
+        """Get the results of an inline query, ordered by relevance."""
+        terms = search.words(text)
+        key = " ".join(terms)
+        cached = self.results.get(key)
+        if cached is not None:
+            return cached
+        data = self._data
+        entries = data[0]
+        if not terms:
+            results = [entry.result for entry in itertools.islice(entries.values(), MAX_RESULTS)]
+        else:
+            # Every term must match, and the scores of the terms are added up
+            scores: typing.Optional[typing.Dict[int, float]] = None
+            for term in terms:
+                matches = self._matches(data, term)
+                if scores is None:
+                    scores = matches
+                else:
+                    scores = {id_: score + matches[id_] for id_, score in scores.items() if id_ in matches}
+                if not scores:
+                    break
+            ranked = sorted(scores.items(), key=lambda item: (-item[1], entries[item[0]].name))
+            results = [entries[id_].result for id_, _ in ranked[:MAX_RESULTS]]
+        self.results.set(key, results)
+        return results
+
+
+# The index used by the core to answer the inline queries
+index = ProductIndex()
+
+
+def renderer(cfg, loc):
+    """Create an object that formats prices and products like a worker using loc would."""
+    import worker
+    render = types.SimpleNamespace(cfg=cfg, loc=loc)
+    render.Price = worker.Worker.price_factory(render)
+    return render
+
+
+def _changes_catalog(instance) -> bool:
+    if isinstance(instance, (db.Variation, db.ProductVariation)):
+        return True
+    if not isinstance(instance, db.Product):
+        return False
+    # Deleted products aren't indexed, such as the variations of the products in the carts: only deleting one matters
+    return not instance.deleted or bool(sqlalchemy.inspect(instance).attrs.deleted.history.deleted)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_flush")
+def _record_changes(session, flush_context):
+    """Remember that the transaction edited the catalog, so that the index is rebuilt once it's committed."""
+    if session.info.get("inline_changed"):
+        return
+    if any(_changes_catalog(instance) for instance in itertools.chain(session.new, session.dirty, session.deleted)):
+        session.info["inline_changed"] = True
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_commit")
+def _mark_stale(session):
+    """Rebuild the index after the catalog is edited: a rebuild before the commit would still see the old catalog."""
+    if session.info.pop("inline_changed", False):
+        index.stale = True
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_rollback")
+def _forget_changes(session):
+    session.info.pop("inline_changed", None)
+
+
+def answer(bot, inline_query: telegram.InlineQuery, cache_time: int) -> None:
+    """Answer an inline query with the matching products."""
+    results = index.search(inline_query.query)
+    bot.answer_inline_query(inline_query.id, results, cache_time=cache_time)
@@ -0,0 +1,168 @@
+import argparse
+import datetime
+import logging
+import time
+import typing
+
+import sqlalchemy
+
+import database as db
+
+log = logging.getLogger(__name__)
+
+
+def checkpoint(session, min_transactions: int = 100, user_ids: typing.Optional[typing.Iterable[int]] = None,
+               margin: int = 1000) -> int:
+    """Advance the balance checkpoints of the users with at least min_transactions transactions after their current one,
+    so that recomputing their credit only has to sum the transactions made since, then commit.
+    The newest margin transactions are never included: on PostgreSQL a transaction can be committed after others with
+    higher ids, and a checkpoint past it would miss it forever.
+    Only the users in user_ids are considered, if given. Returns the number of checkpoints advanced."""
+    Checkpoint = db.BalanceCheckpoint
+    since = sqlalchemy.func.coalesce(Checkpoint.transaction_id, 0)
+    settled = sqlalchemy.select(sqlalchemy.func.max(db.Transaction.transaction_id) - margin).scalar_subquery()
+    count = sqlalchemy.func.count(db.Transaction.transaction_id)
+    # The transactions of every user after their checkpoint, summed in a single pass
+    query = session.query(db.Transaction.user_id,
+                          Checkpoint.transaction_id,
+                          Checkpoint.total,
+                          sqlalchemy.func.max(db.Transaction.transaction_id),
+                          sqlalchemy.func.sum(db.Transaction.value)) \
+        .outerjoin(Checkpoint, Checkpoint.user_id == db.Transaction.user_id) \
+        .filter(db.Transaction.transaction_id > since, db.Transaction.transaction_id <= settled) \
+        .group_by(db.Transaction.user_id, Checkpoint.transaction_id, Checkpoint.total) \
+        .having(count >= min_transactions)
+    if user_ids is not None:
+        query = query.filter(db.Transaction.user_id.in_(list(user_ids)))
+    now = datetime.datetime.now()
+    advanced = 0
+    for user_id, old_transaction_id, old_total, transaction_id, value in query.all():
+        if old_transaction_id is None:
+            db.upsert(session, Checkpoint,
+                      values={"user_id": user_id, "transaction_id": transaction_id, "total": value, "created_on": now},
+                      index_elements=["user_id"])
+        else:
+            # Skip the checkpoint if another process advanced it in the meantime
+            session.execute(sqlalchemy.update(Checkpoint)
+                            .where(Checkpoint.user_id == user_id, Checkpoint.transaction_id == old_transaction_id)
+                            .values(transaction_id=transaction_id, total=old_total + value, created_on=now)
+                            .execution_options(synchronize_session=False))
+        advanced += 1
+    session.commit()
+    log.debug(f"Advanced {advanced} balance checkpoints")
+    return advanced
+
+
+class Mismatch(typing.NamedTuple):
+    """A user whose stored credit differs from the one computed from their transactions."""
+    user_id: int
+    credit: int
+    expected: int
+    version: int
+
+    @property
+    def drift(self) -> int:
+        return self.credit - self.expected
+
+
+def mismatches(session) -> typing.Iterator[Mismatch]:
+    """Stream the users whose credit differs from the sum of the values of their non-refunded transactions.
+    The sums of all the users are computed by the database with a single grouped query,
+    starting from the balance checkpoints like db.wallet_balance does."""
+    Checkpoint = db.BalanceCheckpoint
+    since = sqlalchemy.func.coalesce(Checkpoint.transaction_id, 0)
+    refunded = sqlalchemy.func.coalesce(db.Transaction.refunded, False)
+    # Only the transactions changing the balance since the checkpoint are joined:
+    # the ones after it count, the refunded ones before it are taken away from its total
+    counted = sqlalchemy.or_(sqlalchemy.and_(db.Transaction.transaction_id > since, refunded == False),
+                             sqlalchemy.and_(db.Transaction.transaction_id <= since, db.Transaction.refunded == True))
+    change = sqlalchemy.case([(db.Transaction.transaction_id > since, db.Transaction.value)],
+                             else_=-db.Transaction.value)
+    expected = sqlalchemy.func.coalesce(Checkpoint.total, 0) + sqlalchemy.func.coalesce(sqlalchemy.func.sum(change), 0)
+    rows = session.query(db.User.user_id, db.User.credit, expected, db.User.version) \
+        .outerjoin(Checkpoint, Checkpoint.user_id == db.User.user_id) \
+        .outerjoin(db.Transaction, sqlalchemy.and_(db.Transaction.user_id == db.User.user_id, counted)) \
+        .group_by(db.User.user_id, db.User.credit, db.User.version, Checkpoint.total) \
+        .having(db.User.credit != expected) \
+        .yield_per(1000)
+    for row in rows:
+        yield Mismatch(*row)
+
+
+def repair(session, found: typing.Iterable[Mismatch], batch_size: int = 500) -> int:
+    """Set the credit of the mismatched users to the expected one, committing every batch_size users.
+    Users changed since they were checked are skipped: they will be checked again at the next reconciliation.
+    Returns the number of users repaired."""
+    repaired = 0
+    batch: typing.List[Mismatch] = []
+
+    def flush():
+        nonlocal repaired
+        # The version is incremented as well, so that the sessions holding the old credit can't overwrite it
+        result = session.execute(sqlalchemy.update(db.User.__table__)
+                                 .where(db.User.__table__.c.user_id == sqlalchemy.bindparam("b_user_id"),
+                                        db.User.__table__.c.version == sqlalchemy.bindparam("b_version"))
+                                 .values(credit=sqlalchemy.bindparam("b_expected"),
+                                         version=db.User.__table__.c.version + 1),
+                                 [{"b_user_id": m.user_id, "b_version": m.version, "b_expected": m.expected}
+                                  for m in batch])
+        session.commit()
+        repaired += result.rowcount
+        # The repair runs in another process than the bot: its cached profiles show the repaired credit
+        # once they expire, within the ttl of cache.profiles (10 seconds)
+        batch.clear()
+
+    for mismatch in found:
+        batch.append(mismatch)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return repaired
+
+
+def reconcile(session, fix: bool = False, batch_size: int = 500) -> typing.Dict[str, typing.Any]:
+    """Check the credit of every user against their transactions, logging the mismatches and repairing them if fix.
+    Returns a report with the number of mismatches, the total drift, the users repaired and the time taken."""
+    started = time.perf_counter()
+    found = []
+    for mismatch in mismatches(session):
+        log.warning(f"Credit of user {mismatch.user_id} is {mismatch.credit}, but their transactions sum up to "
+                    f"{mismatch.expected} (drift {mismatch.drift})")
+        found.append(mismatch)
+    # The mismatches are read completely before repairing, as committing closes the cursor they are streamed from
+    checked = time.perf_counter()
+    repaired = repair(session, found, batch_size=batch_size) if fix else 0
+    report = {
+        "mismatches": len(found),
+        "drift": sum(abs(m.drift) for m in found),
+        "repaired": repaired,
+        "check_seconds": checked - started,
+        "repair_seconds": time.perf_counter() - checked,
+    }
+    log.info(f"Ledger reconciliation: {report['mismatches']} mismatches, total drift {report['drift']}, "
+             f"{report['repaired']} repaired in {report['check_seconds']:.2f}s + {report['repair_seconds']:.2f}s")
+    return report
+
+
+def main() -> None:
+    import nuconfig
+
+    parser = argparse.ArgumentParser(description="Check the credit of the users against their transactions.")
+    parser.add_argument("--repair", action="store_true", help="set the mismatched credits to the computed ones")
+    parser.add_argument("--batch-size", type=int, default=500, help="users repaired in a single commit")
+    parser.add_argument("--engine", help="the database to use instead of the one in config/config.toml")
+    args = parser.parse_args()
+    logging.basicConfig(level="INFO", format="{levelname} {message}", style="{")
+    if args.engine is None:
+        with open("config/config.toml", encoding="utf8") as user_cfg_file:
+            args.engine = nuconfig.NuConfig(user_cfg_file)["Database"]["engine"]
+    engine = sqlalchemy.create_engine(args.engine)
+    session = sqlalchemy.orm.sessionmaker(bind=engine)()
+    report = reconcile(session, fix=args.repair, batch_size=args.batch_size)
+    session.close()
+    exit(1 if report["mismatches"] > report["repaired"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,376 @@
+"""Versioned upgrades of the database schema.
+
+The version of the schema of a database is the highest version recorded in its schema_version table;
+databases created before this module existed have no such table and are at version 0.
+Upgrading a database executes in order every migration with a higher version than its own,
+each in its own transaction together with the record of its version.
+
+Every migration spells out the tables and indexes of its own version instead of taking them from the models,
+which keep changing with the code: a new database goes through the same schemas as the ones upgraded over time.
+Databases created before this module existed may have some of the changes already, so every migration must still
+check whether its change is needed before applying it.
+Schema changes never go only in the models: add a migration at the end of MIGRATIONS, never change or reorder
+the ones already released.
+
+Usage:
+    python migrations.py [status|upgrade] [--engine URL]
+"""
+import argparse
+import datetime
+import logging
+import typing
+
+import sqlalchemy
+
+import search
+
+log = logging.getLogger(__name__)
+
+# The versions applied to the database, kept outside the metadata of the models
+_metadata = sqlalchemy.MetaData()
+schema_version = sqlalchemy.Table(
+    "schema_version", _metadata,
+    sqlalchemy.Column("version", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("description", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column("applied_on", sqlalchemy.DateTime, nullable=False),
+)
+
+
+class Migration(typing.NamedTuple):
+    version: int
+    description: str
+    upgrade: typing.Callable[[sqlalchemy.engine.Connection], None]
+
+
+def _columns(connection, table: str) -> typing.Set[str]:
+    return {column["name"] for column in sqlalchemy.inspect(connection).get_columns(table)}
+
+
+# The tables of version 1, the ones created by greed before the migrations existed
+_schema_1 = sqlalchemy.MetaData()
+sqlalchemy.Table(
+    "users", _schema_1,
+    sqlalchemy.Column("user_id", sqlalchemy.BigInteger, primary_key=True),
+    sqlalchemy.Column("first_name", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column("last_name", sqlalchemy.String),
+    sqlalchemy.Column("username", sqlalchemy.String),
+    sqlalchemy.Column("language", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column("credit", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("version", sqlalchemy.Integer, nullable=False, server_default="0"),
+)
+sqlalchemy.Table(
+    "category", _schema_1,
+    sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("name", sqlalchemy.String),
+)
+sqlalchemy.Table(
+    "subcategory", _schema_1,
+    sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("name", sqlalchemy.String),
+    sqlalchemy.Column("category_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("category.id")),
+)
+sqlalchemy.Table(
+    "products", _schema_1,
+    sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("name", sqlalchemy.String),
+    sqlalchemy.Column("description", sqlalchemy.Text),
+    sqlalchemy.Column("price", sqlalchemy.Float),
+    sqlalchemy.Column("image", sqlalchemy.LargeBinary),
+    sqlalchemy.Column("deleted", sqlalchemy.Boolean, nullable=False),
+    sqlalchemy.Column("category_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("category.id")),
+    sqlalchemy.Column("sub_category_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("subcategory.id")),
+)
+sqlalchemy.Table(
+    "variation", _schema_1,
+    sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("name", sqlalchemy.String),
+    sqlalchemy.Column("quantity", sqlalchemy.Integer),
+    sqlalchemy.Column("price_diff", sqlalchemy.Float),
+)
+sqlalchemy.Table(
+    "product_variation", _schema_1,
+    sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("product_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("products.id"), primary_key=True),
+    sqlalchemy.Column("variation_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("variation.id"), primary_key=True),
+    sqlalchemy.UniqueConstraint("product_id", "variation_id"),
+)
+sqlalchemy.Table(
+    "orders", _schema_1,
+    sqlalchemy.Column("order_id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("user_id", sqlalchemy.BigInteger, sqlalchemy.ForeignKey("users.user_id")),
+    sqlalchemy.Column("creation_date", sqlalchemy.DateTime, nullable=False),
+    sqlalchemy.Column("delivery_date", sqlalchemy.DateTime),
+    sqlalchemy.Column("refund_date", sqlalchemy.DateTime),
+    sqlalchemy.Column("refund_reason", sqlalchemy.Text),
+    sqlalchemy.Column("notes", sqlalchemy.Text),
+)
+sqlalchemy.Table(
+    "orderitems", _schema_1,
+    sqlalchemy.Column("item_id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("product_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("products.id"), nullable=False),
+    sqlalchemy.Column("order_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("orders.order_id"), nullable=False),
+)
+sqlalchemy.Table(
+    "transactions", _schema_1,
+    sqlalchemy.Column("transaction_id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("user_id", sqlalchemy.BigInteger, sqlalchemy.ForeignKey("users.user_id"), nullable=False),
+    sqlalchemy.Column("value", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("refunded", sqlalchemy.Boolean),
+    sqlalchemy.Column("notes", sqlalchemy.Text),
+    sqlalchemy.Column("provider", sqlalchemy.String),
+    sqlalchemy.Column("telegram_charge_id", sqlalchemy.String),
+    sqlalchemy.Column("provider_charge_id", sqlalchemy.String),
+    sqlalchemy.Column("payment_name", sqlalchemy.String),
+    sqlalchemy.Column("payment_phone", sqlalchemy.String),
+    sqlalchemy.Column("payment_email", sqlalchemy.String),
+    sqlalchemy.Column("order_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("orders.order_id")),
+    sqlalchemy.UniqueConstraint("provider", "provider_charge_id"),
+)
+sqlalchemy.Table(
+    "btc_transactions", _schema_1,
+    sqlalchemy.Column("transaction_id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("user_id", sqlalchemy.BigInteger, sqlalchemy.ForeignKey("users.user_id"), nullable=False),
+    sqlalchemy.Column("price", sqlalchemy.Float),
+    sqlalchemy.Column("value", sqlalchemy.Float),
+    sqlalchemy.Column("currency", sqlalchemy.Text),
+    sqlalchemy.Column("status", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("timestamp", sqlalchemy.Integer),
+    sqlalchemy.Column("address", sqlalchemy.Text),
+    sqlalchemy.Column("txid", sqlalchemy.Text),
+)
+sqlalchemy.Table(
+    "admins", _schema_1,
+    sqlalchemy.Column("user_id", sqlalchemy.BigInteger, sqlalchemy.ForeignKey("users.user_id"), primary_key=True),
+    sqlalchemy.Column("edit_products", sqlalchemy.Boolean),
+    sqlalchemy.Column("receive_orders", sqlalchemy.Boolean),
+    sqlalchemy.Column("create_transactions", sqlalchemy.Boolean),
+    sqlalchemy.Column("display_on_help", sqlalchemy.Boolean),
+    sqlalchemy.Column("is_owner", sqlalchemy.Boolean),
+    sqlalchemy.Column("live_mode", sqlalchemy.Boolean),
+)
+sqlalchemy.Table(
+    "sales_daily", _schema_1,
+    sqlalchemy.Column("day", sqlalchemy.Date, primary_key=True),
+    sqlalchemy.Column("orders", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("revenue", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("refunds", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("refunded", sqlalchemy.Integer, nullable=False),
+)
+sqlalchemy.Table(
+    "sales_hourly", _schema_1,
+    sqlalchemy.Column("hour", sqlalchemy.DateTime, primary_key=True),
+    sqlalchemy.Column("orders", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("revenue", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("refunds", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("refunded", sqlalchemy.Integer, nullable=False),
+)
+sqlalchemy.Table(
+    "sales_products", _schema_1,
+    sqlalchemy.Column("day", sqlalchemy.Date, primary_key=True),
+    sqlalchemy.Column("product_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("products.id"), primary_key=True),
+    sqlalchemy.Column("quantity", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("revenue", sqlalchemy.Integer, nullable=False),
+)
+
+
+def _create_tables(connection) -> None:
+    _schema_1.create_all(connection)
+
+
+def _add_users_version(connection) -> None:
+    if "version" not in _columns(connection, "users"):
+        connection.exec_driver_sql("ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+
+def _add_balance_checkpoints(connection) -> None:
+    schema = sqlalchemy.MetaData()
+    sqlalchemy.Table(
+        "balance_checkpoints", schema,
+        sqlalchemy.Column("user_id", sqlalchemy.BigInteger, sqlalchemy.ForeignKey("users.user_id"), primary_key=True),
+        sqlalchemy.Column("transaction_id", sqlalchemy.Integer, nullable=False),
+        sqlalchemy.Column("total", sqlalchemy.Integer, nullable=False),
+        sqlalchemy.Column("created_on", sqlalchemy.DateTime, nullable=False),
+    )
+    # Only the columns the indexes need
+    transactions = sqlalchemy.Table(
+        "transactions", schema,
+        sqlalchemy.Column("transaction_id", sqlalchemy.Integer, primary_key=True),
+        sqlalchemy.Column("user_id", sqlalchemy.BigInteger),
+        sqlalchemy.Column("refunded", sqlalchemy.Boolean),
+    )
+    sqlalchemy.Table("users", schema, sqlalchemy.Column("user_id", sqlalchemy.BigInteger, primary_key=True))
+    schema.tables["balance_checkpoints"].create(connection, checkfirst=True)
+    sqlalchemy.Index("transactions_user", transactions.c.user_id, transactions.c.transaction_id) \
+        .create(connection, checkfirst=True)
+    sqlalchemy.Index("transactions_user_refunded", transactions.c.user_id,
+                     sqlite_where=sqlalchemy.text("refunded = 1"), postgresql_where=sqlalchemy.text("refunded")) \
+        .create(connection, checkfirst=True)
+
+
+def _btc_transactions_timestamp(connection) -> None:
+    """Turn the timestamp of the btc transactions into a DateTime column, and index it together with the status.
+    The timestamps stored by the Integer column are already in the format used by DateTime on SQLite."""
+    schema = sqlalchemy.MetaData()
+    sqlalchemy.Table("users", schema, sqlalchemy.Column("user_id", sqlalchemy.BigInteger, primary_key=True))
+    btc_transactions = sqlalchemy.Table(
+        "btc_transactions", schema,
+        sqlalchemy.Column("transaction_id", sqlalchemy.Integer, primary_key=True),
+        sqlalchemy.Column("user_id", sqlalchemy.BigInteger, sqlalchemy.ForeignKey("users.user_id"), nullable=False),
+        sqlalchemy.Column("price", sqlalchemy.Float),
+        sqlalchemy.Column("value", sqlalchemy.Float),
+        sqlalchemy.Column("currency", sqlalchemy.Text),
+        sqlalchemy.Column("status", sqlalchemy.Integer, nullable=False),
+        sqlalchemy.Column("timestamp", sqlalchemy.DateTime),
+        sqlalchemy.Column("address", sqlalchemy.Text),
+        sqlalchemy.Column("txid", sqlalchemy.Text),
+        sqlalchemy.Index("btc_transactions_status", "status", "timestamp"),
+    )
+    columns = ", ".join(column.name for column in btc_transactions.columns)
+    if connection.dialect.name == "sqlite":
+        # pysqlite doesn't start the transaction before DDL statements: without it, the rebuild isn't atomic
+        if not connection.connection.in_transaction:
+            connection.exec_driver_sql("BEGIN")
+        inspector = sqlalchemy.inspect(connection)
+        if inspector.has_table("btc_transactions_old"):
+            # Finish a rebuild interrupted by a crash of a version of this migration that wasn't atomic
+            log.warning("Finishing the interrupted rebuild of the btc_transactions table")
+            if not inspector.has_table("btc_transactions"):
+                btc_transactions.create(connection)
+            if connection.exec_driver_sql("SELECT COUNT(*) FROM btc_transactions").scalar() == 0:
+                connection.exec_driver_sql(f"INSERT INTO btc_transactions ({columns}) "
+                                           f"SELECT {columns} FROM btc_transactions_old")
+            connection.exec_driver_sql("DROP TABLE btc_transactions_old")
+    timestamp = next(column for column in sqlalchemy.inspect(connection).get_columns("btc_transactions")
+                     if column["name"] == "timestamp")
+    if isinstance(timestamp["type"], sqlalchemy.Integer):
+        if connection.dialect.name == "sqlite":
+            # SQLite can't change the type of a column: the table is rebuilt
+            connection.exec_driver_sql("ALTER TABLE btc_transactions RENAME TO btc_transactions_old")
+            btc_transactions.create(connection)
+            connection.exec_driver_sql(f"INSERT INTO btc_transactions ({columns}) "
+                                       f"SELECT {columns} FROM btc_transactions_old")
+            connection.exec_driver_sql("DROP TABLE btc_transactions_old")
+        else:
+            # Keep the values: integers can only be turned into timestamps as seconds since the epoch
+            connection.exec_driver_sql("ALTER TABLE btc_transactions ALTER COLUMN timestamp TYPE TIMESTAMP "
+                                       "USING to_timestamp(timestamp)::timestamp")
+    for index in btc_transactions.indexes:
+        index.create(connection, checkfirst=True)
+
+
+def _add_btc_address_pool(connection) -> None:
+    schema = sqlalchemy.MetaData()
+    sqlalchemy.Table(
+        "btc_address_pool", schema,
+        sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+        sqlalchemy.Column("address", sqlalchemy.Text, nullable=False, unique=True),
+        sqlalchemy.Column("created_on", sqlalchemy.DateTime, nullable=False),
+    ).create(connection, checkfirst=True)
+
+
+def _unique_confirmed_txids(connection) -> None:
+    """Prevent a payment from being confirmed twice.
+    Payments credited twice before this can't be fixed automatically, as a user may have spent the credit already."""
+    btc_transactions = sqlalchemy.Table(
+        "btc_transactions", sqlalchemy.MetaData(),
+        sqlalchemy.Column("transaction_id", sqlalchemy.Integer, primary_key=True),
+        sqlalchemy.Column("status", sqlalchemy.Integer, nullable=False),
+        sqlalchemy.Column("address", sqlalchemy.Text),
+        sqlalchemy.Column("txid", sqlalchemy.Text),
+    )
+    btc = btc_transactions.c
+    duplicates = connection.execute(
+        sqlalchemy.select(btc.txid, btc.address, sqlalchemy.func.count())
+        .where(btc.status == 2)
+        .group_by(btc.txid, btc.address)
+        .having(sqlalchemy.func.count() > 1)
+    ).all()
+    if duplicates:
+        for txid, address, count in duplicates:
+            log.error(f"Payment {txid} on address {address} was credited {count} times")
+        raise RuntimeError("Some payments were credited more than once: refund the extra credit, "
+                           "set the status of the duplicate btc_transactions to -2, then upgrade again")
+    sqlalchemy.Index("btc_transactions_confirmed_txid", btc.txid, btc.address, unique=True,
+                     sqlite_where=sqlalchemy.text("status = 2"), postgresql_where=sqlalchemy.text("status = 2")) \
+        .create(connection, checkfirst=True)
+
+
+MIGRATIONS: typing.List[Migration] = [
+    Migration(1, "Create the missing tables", _create_tables),
+    Migration(2, "Add the version column to the users table", _add_users_version),
+    Migration(3, "Create the product search index", search.create_index),
+    Migration(4, "Add the balance checkpoints and index the transactions by user", _add_balance_checkpoints),
+    Migration(5, "Store the timestamps of the btc transactions as DateTime", _btc_transactions_timestamp),
+    Migration(6, "Add the pool of bitcoin addresses", _add_btc_address_pool),
+    Migration(7, "Allow every bitcoin payment to be confirmed only once", _unique_confirmed_txids),
+    Migration(8, "Search the variations of the products on PostgreSQL", search.create_documents),
+]
+
+# The version of the schema expected by the code
+HEAD = MIGRATIONS[-1].version
+
+
+class SchemaTooNewError(Exception):
+    """The database was upgraded by a newer version of greed."""
+
+
+def current_version(engine) -> int:
+    """Get the version of the schema of the database."""
+    with engine.connect() as connection:
+        if not sqlalchemy.inspect(connection).has_table("schema_version"):
+            return 0
+        return connection.execute(sqlalchemy.select(sqlalchemy.func.max(schema_version.c.version))).scalar() or 0
+
+
+def pending(engine) -> typing.List[Migration]:
+    """Get the migrations not applied to the database yet."""
+    version = current_version(engine)
+    if version > HEAD:
+        raise SchemaTooNewError(f"The database schema is at version {version}, "
+                                f"but this version of greed only knows up to {HEAD}")
+    return [migration for migration in MIGRATIONS if migration.version > version]
+
+
+def upgrade(engine) -> int:
+    """Apply the pending migrations to the database, returning how many were applied.
+    When the schema is already current this only reads its version."""
+    migrations = pending(engine)
+    if not migrations:
+        log.debug(f"The database schema is up to date (version {HEAD})")
+        return 0
+    _metadata.create_all(engine)
+    for migration in migrations:
+        log.info(f"Upgrading the database schema to version {migration.version}: {migration.description}...")
+        with engine.begin() as connection:
+            migration.upgrade(connection)
+            connection.execute(sqlalchemy.insert(schema_version).values(version=migration.version,
+                                                                        description=migration.description,
+                                                                        applied_on=datetime.datetime.now()))
+    log.info(f"The database schema was upgraded to version {HEAD}")
+    return len(migrations)
+
+
+def main() -> None:
+    import nuconfig
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", nargs="?", choices=["status", "upgrade"], default="status")
+    parser.add_argument("--engine", help="the database to use instead of the one in config/config.toml")
+    args = parser.parse_args()
+    logging.basicConfig(level="INFO", format="{levelname} {message}", style="{")
+    if args.engine is None:
+        with open("config/config.toml", encoding="utf8") as user_cfg_file:
+            args.engine = nuconfig.NuConfig(user_cfg_file)["Database"]["engine"]
+    engine = sqlalchemy.create_engine(args.engine)
+    if args.command == "upgrade":
+        upgrade(engine)
+        return
+    version = current_version(engine)
+    print(f"Schema version: {version} (latest: {HEAD})")
+    for migration in MIGRATIONS:
+        state = "applied" if migration.version <= version else "pending"
+        print(f"{migration.version:>4}  {state:<8} {migration.description}")
+
+
+if __name__ == "__main__":
+    main()
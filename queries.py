@@ -0,0 +1,85 @@
+"""The queries executed most often, built as lambda statements.
+
+A lambda statement is constructed and compiled only the first time it's executed:
+afterwards its SQL is taken from the cache using the code location of the lambda as the key,
+and only the values of the variables it references are extracted and bound as parameters.
+Keep the lambdas free of branches, as every variable they reference becomes a parameter of the same statement.
+"""
+import datetime
+import typing
+
+from sqlalchemy import lambda_stmt, select
+
+import database as db
+
+
+def products_for_sale(session) -> typing.List[db.Product]:
+    """Get all the products that haven't been deleted."""
+    return session.execute(
+        lambda_stmt(lambda: select(db.Product).where(db.Product.deleted == False))
+    ).scalars().all()
+
+
+def products_in_category(session, category_id: int) -> typing.List[db.Product]:
+    return session.execute(
+        lambda_stmt(lambda: select(db.Product).where(db.Product.category_id == category_id,
+                                                     db.Product.deleted == False))
+    ).scalars().all()
+
+
+def products_in_sub_category(session, sub_category_id: int) -> typing.List[db.Product]:
+    return session.execute(
+        lambda_stmt(lambda: select(db.Product).where(db.Product.sub_category_id == sub_category_id,
+                                                     db.Product.deleted == False))
+    ).scalars().all()
+
+
+def variations_of(session, product_id: int) -> typing.List[db.ProductVariation]:
+    """Get the links between a product and its variations."""
+    return session.execute(
+        lambda_stmt(lambda: select(db.ProductVariation).where(db.ProductVariation.product_id == product_id))
+    ).scalars().all()
+
+
+def variation_names(session) -> typing.List[typing.Tuple[db.ProductVariation, str, str]]:
+    """Get every link between a product and a variation, with the names of both."""
+    return session.execute(
+        lambda_stmt(lambda: select(db.ProductVariation, db.Product.name, db.Variation.name)
+                    .select_from(db.ProductVariation)
+                    .join(db.Product)
+                    .join(db.Variation))
+    ).all()
+
+
+def user(session, user_id: int) -> typing.Optional[db.User]:
+    return session.execute(
+        lambda_stmt(lambda: select(db.User).where(db.User.user_id == user_id))
+    ).scalar_one_or_none()
+
+
+def profile(session, user_id: int) -> typing.Optional[typing.Tuple[db.User, typing.Optional[db.Admin]]]:
+    """Get the user and, if they are an administrator, the admin rows of a user with a single query."""
+    row = session.execute(
+        lambda_stmt(lambda: select(db.User, db.Admin)
+                    .outerjoin(db.Admin, db.Admin.user_id == db.User.user_id)
+                    .where(db.User.user_id == user_id))
+    ).one_or_none()
+    return tuple(row) if row is not None else None
+
+
+def pending_payments(session) -> typing.List[typing.Tuple[str, int, datetime.datetime]]:
+    """Get the address, status and timestamp of the bitcoin payments that haven't been confirmed yet,
+    and whose address hasn't expired."""
+    return session.execute(
+        lambda_stmt(lambda: select(db.BtcTransaction.address, db.BtcTransaction.status, db.BtcTransaction.timestamp)
+                    .where(db.BtcTransaction.status.notin_([db.BtcTransaction.EXPIRED, db.BtcTransaction.CONFIRMED])))
+    ).all()
+
+
+def expired_payments(session, since: datetime.datetime) -> typing.List[typing.Tuple[str, int, datetime.datetime]]:
+    """Get the address, status and timestamp of the bitcoin addresses that expired without a payment,
+    given to the users after since."""
+    return session.execute(
+        lambda_stmt(lambda: select(db.BtcTransaction.address, db.BtcTransaction.status, db.BtcTransaction.timestamp)
+                    .where(db.BtcTransaction.status == db.BtcTransaction.EXPIRED, db.BtcTransaction.timestamp >= since))
+    ).all()
@@ -0,0 +1,168 @@
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import typing
+
+import sqlalchemy
+
+log = logging.getLogger(__name__)
+
+# Upper bounds in milliseconds of the buckets of the statement duration histograms
+BUCKETS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, float("inf")]
+
+# Prefix used to get the query plan of a statement on the engines that support it
+EXPLAIN = {
+    "sqlite": "EXPLAIN QUERY PLAN ",
+    "postgresql": "EXPLAIN ",
+    "mysql": "EXPLAIN ",
+}
+
+# Matches the expanded parameter lists of IN clauses, so that they are aggregated as the same statement
+_expanded_in = re.compile(r"\((?:\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*,)+\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*\)")
+
+# Directory of the sqlalchemy package, whose frames are skipped when looking for the origin of a statement
+_sqlalchemy_dir = os.path.dirname(sqlalchemy.__file__)
+
+
+class StatementStats:
+    """The aggregated timings of a single SQL statement."""
+
+    def __init__(self, statement: str):
+        self.statement = statement
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.histogram = [0] * len(BUCKETS)
+        self.origins: typing.Dict[str, int] = {}
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def add(self, duration: float, rows: int, origin: str) -> None:
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+        if rows > 0:
+            self.rows += rows
+        for index, bound in enumerate(BUCKETS):
+            if duration <= bound:
+                self.histogram[index] += 1
+                break
+        self.origins[origin] = self.origins.get(origin, 0) + 1
+
+    def percentile(self, fraction: float) -> float:
+        """Estimate a percentile of the durations, as the upper bound of the bucket it falls in."""
+        threshold = self.count * fraction
+        seen = 0
+        for index, amount in enumerate(self.histogram):
+            seen += amount
+            if seen >= threshold:
+                return min(BUCKETS[index], self.max)
+        return self.max
+
+
+class QueryStats:
+    """The aggregated timings of all the statements executed by the instrumented engines."""
+
+    def __init__(self, max_statements: int = 1000):
+        self.max_statements = max_statements
+        self.statements: typing.Dict[str, StatementStats] = {}
+        self.since = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, statement: str, duration: float, rows: int, origin: str) -> None:
+        key = _expanded_in.sub("(...)", statement) if "," in statement else statement
+        with self._lock:
+            stats = self.statements.get(key)
+            if stats is None:
+                # Stop tracking new statements if too many different ones were seen
+                if len(self.statements) >= self.max_statements:
+                    return
+                stats = self.statements[key] = StatementStats(key)
+            stats.add(duration, rows, origin)
+
+    def top(self, limit: int = 10) -> typing.List[StatementStats]:
+        """Get the statements that took the most total time."""
+        with self._lock:
+            return sorted(self.statements.values(), key=lambda s: s.total, reverse=True)[:limit]
+
+    def reset(self) -> None:
+        with self._lock:
+            self.statements.clear()
+            self.since = time.time()
+
+
+# The statistics of all the instrumented engines of this process
+stats = QueryStats()
+
+
+def origin() -> str:
+    """Find the code that executed the current statement.
+    For workers, this is the menu of the conversation, otherwise the first function outside sqlalchemy."""
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if not filename.startswith(_sqlalchemy_dir) and filename != __file__:
+            name = frame.f_code.co_name
+            if name.startswith("_Worker__"):
+                return f"Worker.{name[len('_Worker'):]}"
+            return f"{os.path.splitext(os.path.basename(filename))[0]}.{name}"
+        frame = frame.f_back
+    return threading.current_thread().name
+
+
+def explain(conn, statement: str, parameters) -> str:
+    """Get the query plan of a statement, using a separate cursor of the same connection."""
+    prefix = EXPLAIN.get(conn.dialect.name)
+    if prefix is None:
+        return "(query plans are not supported on this engine)"
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        return "\n".join(" | ".join(str(column) for column in row) for row in cursor.fetchall())
+    finally:
+        cursor.close()
+
+
+def instrument(engine, slow_threshold: float) -> None:
+    """Record the duration, the row count and the origin of every statement executed by engine.
+    Statements slower than slow_threshold milliseconds are logged with their parameters and query plan;
+    if slow_threshold is 0, no statement is logged."""
+
+    @sqlalchemy.event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @sqlalchemy.event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        # The failed statement never reaches after_cursor_execute, which would take its start time off the stack
+        if context.execution_context is not None and context.connection is not None:
+            starts = context.connection.info.get("query_start")
+            if starts:
+                starts.pop()
+
+    @sqlalchemy.event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        duration = (time.perf_counter() - conn.info["query_start"].pop()) * 1000
+        # Only some drivers report the number of rows returned by a SELECT
+        rows = cursor.rowcount
+        source = origin()
+        stats.add(statement, duration, rows, source)
+        if slow_threshold and duration >= slow_threshold:
+            plan = ""
+            if not executemany and statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE", "WITH")):
+                # noinspection PyBroadException
+                try:
+                    plan = "\nPlan:\n" + explain(conn, statement, parameters)
+                except Exception as e:
+                    plan = f"\nPlan unavailable: {e}"
+            rows_text = f", {rows} rows" if rows >= 0 else ""
+            log.warning(f"Slow query ({duration:.1f} ms{rows_text}) from {source}:\n"
+                        f"{statement}\n"
+                        f"Parameters: {parameters}"
+                        f"{plan}")
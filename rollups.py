@@ -0,0 +1,159 @@
+import datetime
+import logging
+import typing
+
+import sqlalchemy
+
+import database as db
+
+log = logging.getLogger(__name__)
+
+
+def _day(moment: datetime.datetime) -> datetime.date:
+    return moment.date()
+
+
+def _hour(moment: datetime.datetime) -> datetime.datetime:
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def _minimum_units(price: typing.Optional[float], currency_exp: int) -> int:
+    """Convert a product price to minimum currency units, the same way the Price class of the workers does."""
+    if price is None:
+        return 0
+    return int(price * (10 ** currency_exp))
+
+
+def _increment(session, model, keys: dict, **deltas) -> None:
+    """Add the deltas to the rollup row identified by keys, creating it if it doesn't exist yet."""
+    db.upsert(session, model,
+              values={**keys, **deltas},
+              index_elements=list(keys),
+              set_=lambda excluded: {column: getattr(model, column) + getattr(excluded, column)
+                                     for column in deltas})
+
+
+def record_order(session, creation_date: datetime.datetime, value: int,
+                 lines: typing.Iterable[typing.Tuple[int, int, typing.Optional[float]]], currency_exp: int) -> None:
+    """Add a newly placed order to the rollups; lines are the (product_id, quantity, price) of the ordered products.
+    Should be called in the same database transaction that creates the order, before committing it."""
+    _increment(session, db.DailySales, {"day": _day(creation_date)}, orders=1, revenue=value)
+    _increment(session, db.HourlySales, {"hour": _hour(creation_date)}, orders=1, revenue=value)
+    # The same product may appear in more than one line
+    quantities: typing.Dict[int, typing.List] = {}
+    for product_id, quantity, price in lines:
+        entry = quantities.setdefault(product_id, [0, 0])
+        entry[0] += quantity
+        entry[1] += _minimum_units(price, currency_exp) * quantity
+    for product_id, (quantity, revenue) in quantities.items():
+        _increment(session, db.ProductSales, {"day": _day(creation_date), "product_id": product_id},
+                   quantity=quantity, revenue=revenue)
+
+
+def record_refund(session, order: db.Order) -> None:
+    """Add a refunded order to the rollups.
+    Should be called in the same database transaction that refunds the order, before committing it."""
+    moment = order.refund_date
+    value = -order.transaction.value
+    _increment(session, db.DailySales, {"day": _day(moment)}, refunds=1, refunded=value)
+    _increment(session, db.HourlySales, {"hour": _hour(moment)}, refunds=1, refunded=value)
+
+
+def rebuild(session, since: datetime.date, currency_exp: int) -> None:
+    """Recompute the rollups of every day starting from since using the orders table.
+    Streams the orders instead of loading them all at once; it doesn't commit the session."""
+    start = datetime.datetime.combine(since, datetime.time())
+    log.debug(f"Rebuilding the sales rollups since {since}")
+    daily: typing.Dict[datetime.date, typing.List[int]] = {}
+    hourly: typing.Dict[datetime.datetime, typing.List[int]] = {}
+    products: typing.Dict[typing.Tuple[datetime.date, int], typing.List[int]] = {}
+    # Orders placed and refunded, indexed as [orders, revenue, refunds, refunded]
+    placed = session.query(db.Order.creation_date, db.Transaction.value) \
+        .join(db.Transaction, db.Transaction.order_id == db.Order.order_id) \
+        .filter(db.Order.creation_date >= start) \
+        .yield_per(1000)
+    for creation_date, value in placed:
+        for bucket in [daily.setdefault(_day(creation_date), [0, 0, 0, 0]),
+                       hourly.setdefault(_hour(creation_date), [0, 0, 0, 0])]:
+            bucket[0] += 1
+            bucket[1] += -value
+    refunded = session.query(db.Order.refund_date, db.Transaction.value) \
+        .join(db.Transaction, db.Transaction.order_id == db.Order.order_id) \
+        .filter(db.Order.refund_date >= start) \
+        .yield_per(1000)
+    for refund_date, value in refunded:
+        for bucket in [daily.setdefault(_day(refund_date), [0, 0, 0, 0]),
+                       hourly.setdefault(_hour(refund_date), [0, 0, 0, 0])]:
+            bucket[2] += 1
+            bucket[3] += -value
+    items = session.query(db.Order.creation_date, db.OrderItem.product_id, db.Product.price) \
+        .join(db.OrderItem, db.OrderItem.order_id == db.Order.order_id) \
+        .join(db.Product, db.Product.id == db.OrderItem.product_id) \
+        .join(db.Transaction, db.Transaction.order_id == db.Order.order_id) \
+        .filter(db.Order.creation_date >= start) \
+        .yield_per(1000)
+    for creation_date, product_id, price in items:
+        bucket = products.setdefault((_day(creation_date), product_id), [0, 0])
+        bucket[0] += 1
+        bucket[1] += _minimum_units(price, currency_exp)
+    # Replace the old rollups with the recomputed ones
+    session.query(db.DailySales).filter(db.DailySales.day >= since).delete(synchronize_session=False)
+    session.query(db.HourlySales).filter(db.HourlySales.hour >= start).delete(synchronize_session=False)
+    session.query(db.ProductSales).filter(db.ProductSales.day >= since).delete(synchronize_session=False)
+    session.bulk_insert_mappings(db.DailySales, [
+        {"day": day, "orders": o, "revenue": r, "refunds": n, "refunded": v}
+        for day, (o, r, n, v) in daily.items()
+    ])
+    session.bulk_insert_mappings(db.HourlySales, [
+        {"hour": hour, "orders": o, "revenue": r, "refunds": n, "refunded": v}
+        for hour, (o, r, n, v) in hourly.items()
+    ])
+    session.bulk_insert_mappings(db.ProductSales, [
+        {"day": day, "product_id": product_id, "quantity": q, "revenue": r}
+        for (day, product_id), (q, r) in products.items()
+    ])
+
+
+def catch_up(session, currency_exp: int) -> None:
+    """Bring the rollups up to date with the orders table, then commit.
+    The last rolled up day is always recomputed, as it may have been only partially recorded.
+    Must not run while the workers are placing orders, as it would race with the incremental updates."""
+    last_day = session.query(sqlalchemy.func.max(db.DailySales.day)).scalar()
+    if last_day is None:
+        first_order = session.query(sqlalchemy.func.min(db.Order.creation_date)).scalar()
+        if first_order is None:
+            return
+        last_day = first_order.date()
+    rebuild(session, since=last_day, currency_exp=currency_exp)
+    session.commit()
+
+
+def totals(session, since: datetime.date) -> typing.Dict[str, int]:
+    """Sum the daily rollups starting from the since day."""
+    row = session.query(sqlalchemy.func.coalesce(sqlalchemy.func.sum(db.DailySales.orders), 0),
+                        sqlalchemy.func.coalesce(sqlalchemy.func.sum(db.DailySales.revenue), 0),
+                        sqlalchemy.func.coalesce(sqlalchemy.func.sum(db.DailySales.refunds), 0),
+                        sqlalchemy.func.coalesce(sqlalchemy.func.sum(db.DailySales.refunded), 0)) \
+        .filter(db.DailySales.day >= since) \
+        .one()
+    return {"orders": row[0], "revenue": row[1], "refunds": row[2], "refunded": row[3]}
+
+
+def hours(session, since: datetime.datetime) -> typing.List[db.HourlySales]:
+    """Get the hourly rollups starting from the since hour."""
+    return session.query(db.HourlySales) \
+        .filter(db.HourlySales.hour >= _hour(since)) \
+        .order_by(db.HourlySales.hour) \
+        .all()
+
+
+def top_products(session, since: datetime.date, limit: int = 5) -> typing.List[typing.Tuple[str, int, int]]:
+    """Get the name, the copies sold and the revenue of the best selling products starting from the since day."""
+    quantity = sqlalchemy.func.sum(db.ProductSales.quantity)
+    return session.query(db.Product.name, quantity, sqlalchemy.func.sum(db.ProductSales.revenue)) \
+        .join(db.Product, db.Product.id == db.ProductSales.product_id) \
+        .filter(db.ProductSales.day >= since) \
+        .group_by(db.Product.id, db.Product.name) \
+        .order_by(quantity.desc()) \
+        .limit(limit) \
+        .all()
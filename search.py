@@ -0,0 +1,219 @@
+import logging
+import re
+import typing
+
+import sqlalchemy
+
+import database as db
+
+log = logging.getLogger(__name__)
+
+# The full-text search implementation available on the engine, detected by setup()
+# "fts5" on SQLite, "postgresql" on PostgreSQL, "like" everywhere else
+backend = "like"
+
+# The maximum number of words of a search that are used
+MAX_WORDS = 10
+
+# Statement refreshing the index entries of the products selected by the WHERE clause that follows it
+_SQLITE_REFRESH = """
+    INSERT INTO products_fts(rowid, name, description, variations)
+    SELECT products.id, products.name, products.description,
+           (SELECT group_concat(variation.name, ' ')
+            FROM product_variation JOIN variation ON variation.id = product_variation.variation_id
+            WHERE product_variation.product_id = products.id)
+    FROM products
+    WHERE products.deleted = 0 AND products.id"""
+
+# Index of the non-deleted products, kept in sync with the products and their variations by triggers
+_SQLITE_SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS products_fts
+       USING fts5(name, description, variations, tokenize = 'unicode61 remove_diacritics 2')""",
+    f"""CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+        {_SQLITE_REFRESH} = new.id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE ON products BEGIN
+        DELETE FROM products_fts WHERE rowid = old.id;
+        {_SQLITE_REFRESH} = new.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+        DELETE FROM products_fts WHERE rowid = old.id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS products_fts_link_insert AFTER INSERT ON product_variation BEGIN
+        DELETE FROM products_fts WHERE rowid = new.product_id;
+        {_SQLITE_REFRESH} = new.product_id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS products_fts_link_update AFTER UPDATE ON product_variation BEGIN
+        DELETE FROM products_fts WHERE rowid IN (old.product_id, new.product_id);
+        {_SQLITE_REFRESH} IN (old.product_id, new.product_id);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS products_fts_link_delete AFTER DELETE ON product_variation BEGIN
+        DELETE FROM products_fts WHERE rowid = old.product_id;
+        {_SQLITE_REFRESH} = old.product_id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS products_fts_variation_update AFTER UPDATE OF name ON variation BEGIN
+        DELETE FROM products_fts
+        WHERE rowid IN (SELECT product_id FROM product_variation WHERE variation_id = new.id);
+        {_SQLITE_REFRESH} IN (SELECT product_id FROM product_variation WHERE variation_id = new.id);
+    END""",
+]
+
+# Expression index used by the PostgreSQL text search up to version 7 of the schema, replaced by products_tsv
+_POSTGRESQL_DOCUMENT = "to_tsvector('simple', coalesce(products.name, '') || ' ' || coalesce(products.description, ''))"
+_POSTGRESQL_SCHEMA = [
+    f"CREATE INDEX IF NOT EXISTS products_search ON products USING gin (({_POSTGRESQL_DOCUMENT}))",
+]
+
+# Document of every non-deleted product, with its variations, kept in sync with the products by triggers like the
+# SQLite index; the words of the names weigh more than the ones of the variations, which weigh more than the description
+_POSTGRESQL_DOCUMENTS_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS products_tsv (
+        product_id INTEGER PRIMARY KEY,
+        document TSVECTOR NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS products_tsv_document ON products_tsv USING gin (document)",
+    """CREATE OR REPLACE FUNCTION products_tsv_refresh(ids INTEGER[]) RETURNS VOID AS $$
+    BEGIN
+        DELETE FROM products_tsv WHERE product_id = ANY(ids);
+        INSERT INTO products_tsv (product_id, document)
+        SELECT products.id,
+               setweight(to_tsvector('simple', coalesce(products.name, '')), 'A') ||
+               setweight(to_tsvector('simple', coalesce(
+                   (SELECT string_agg(variation.name, ' ')
+                    FROM product_variation JOIN variation ON variation.id = product_variation.variation_id
+                    WHERE product_variation.product_id = products.id), '')), 'B') ||
+               setweight(to_tsvector('simple', coalesce(products.description, '')), 'C')
+        FROM products
+        WHERE products.deleted = FALSE AND products.id = ANY(ids);
+    END
+    $$ LANGUAGE plpgsql""",
+    """CREATE OR REPLACE FUNCTION products_tsv_products() RETURNS TRIGGER AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            PERFORM products_tsv_refresh(ARRAY[NEW.id]);
+        ELSIF TG_OP = 'UPDATE' THEN
+            PERFORM products_tsv_refresh(ARRAY[OLD.id, NEW.id]);
+        ELSE
+            PERFORM products_tsv_refresh(ARRAY[OLD.id]);
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""",
+    """CREATE OR REPLACE FUNCTION products_tsv_links() RETURNS TRIGGER AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            PERFORM products_tsv_refresh(ARRAY[NEW.product_id]);
+        ELSIF TG_OP = 'UPDATE' THEN
+            PERFORM products_tsv_refresh(ARRAY[OLD.product_id, NEW.product_id]);
+        ELSE
+            PERFORM products_tsv_refresh(ARRAY[OLD.product_id]);
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""",
+    """CREATE OR REPLACE FUNCTION products_tsv_variations() RETURNS TRIGGER AS $$
+    BEGIN
+        PERFORM products_tsv_refresh(ARRAY(SELECT product_id FROM product_variation WHERE variation_id = NEW.id));
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""",
+    "DROP TRIGGER IF EXISTS products_tsv_products ON products",
+    """CREATE TRIGGER products_tsv_products AFTER INSERT OR UPDATE OR DELETE ON products
+       FOR EACH ROW EXECUTE FUNCTION products_tsv_products()""",
+    "DROP TRIGGER IF EXISTS products_tsv_links ON product_variation",
+    """CREATE TRIGGER products_tsv_links AFTER INSERT OR UPDATE OR DELETE ON product_variation
+       FOR EACH ROW EXECUTE FUNCTION products_tsv_links()""",
+    "DROP TRIGGER IF EXISTS products_tsv_variations ON variation",
+    """CREATE TRIGGER products_tsv_variations AFTER UPDATE OF name ON variation
+       FOR EACH ROW EXECUTE FUNCTION products_tsv_variations()""",
+    "SELECT products_tsv_refresh(ARRAY(SELECT id FROM products))",
+    # Replaced by the index of the documents
+    "DROP INDEX IF EXISTS products_search",
+]
+
+
+def create_index(connection) -> None:
+    """Create the full-text index of the products, if the engine supports one.
+    Executed by the migrations: the index is kept up to date by the database itself afterwards."""
+    dialect = connection.dialect.name
+    if dialect == "sqlite":
+        try:
+            for statement in _SQLITE_SCHEMA:
+                connection.exec_driver_sql(statement)
+        except sqlalchemy.exc.OperationalError as e:
+            log.warning(f"SQLite FTS5 is not available, product search will be slow: {e}")
+            return
+        log.info("Building the product search index...")
+        connection.exec_driver_sql("DELETE FROM products_fts")
+        connection.exec_driver_sql(f"{_SQLITE_REFRESH} IS NOT NULL")
+    elif dialect == "postgresql":
+        for statement in _POSTGRESQL_SCHEMA:
+            connection.exec_driver_sql(statement)
+
+
+def create_documents(connection) -> None:
+    """Index the variations of the products together with their name and description on PostgreSQL,
+    as the SQLite index already does. Executed by the migrations."""
+    if connection.dialect.name == "postgresql":
+        for statement in _POSTGRESQL_DOCUMENTS_SCHEMA:
+            connection.exec_driver_sql(statement)
+
+
+def setup(engine) -> None:
+    """Choose the search backend depending on the full-text index available on the engine."""
+    global backend
+    dialect = engine.dialect.name
+    if dialect == "sqlite":
+        with engine.connect() as connection:
+            if connection.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'products_fts'"
+            ).first() is not None:
+                backend = "fts5"
+    elif dialect == "postgresql":
+        backend = "postgresql"
+    log.debug(f"Product search is using the {backend} backend")
+
+
+def words(text: str) -> typing.List[str]:
+    """Split a search into the words that are looked up."""
+    return re.findall(r"\w+", text.lower())[:MAX_WORDS]
+
+
+def search(session, text: str, limit: int = 20) -> typing.List[db.Product]:
+    """Find the products for sale whose name, description or variations contain all the words of text.
+    Every word also matches the words it's a prefix of. The results are ordered by relevance."""
+    terms = words(text)
+    if not terms:
+        return []
+    if backend == "fts5":
+        # Words are quoted, so that they can't be interpreted as FTS5 operators
+        match = " ".join(f'"{term}"*' for term in terms)
+        # Matches in the name weigh more than the ones in the variations, which weigh more than the description
+        ids = [row[0] for row in session.execute(
+            sqlalchemy.text("SELECT rowid FROM products_fts WHERE products_fts MATCH :match "
+                            "ORDER BY bm25(products_fts, 10.0, 1.0, 5.0) LIMIT :limit"),
+            {"match": match, "limit": limit * 2}
+        )]
+    elif backend == "postgresql":
+        query = " & ".join(f"{term}:*" for term in terms)
+        # Every word can be in the name, the description or any variation of the product, like with FTS5
+        ids = [row[0] for row in session.execute(
+            sqlalchemy.text("SELECT product_id FROM products_tsv WHERE document @@ to_tsquery('simple', :query) "
+                            "ORDER BY ts_rank(document, to_tsquery('simple', :query)) DESC LIMIT :limit"),
+            {"query": query, "limit": limit * 2}
+        )]
+    else:
+        conditions = [sqlalchemy.or_(db.Product.name.ilike(f"%{term}%"),
+                                     db.Product.description.ilike(f"%{term}%"),
+                                     db.Product.variations.any(db.Variation.name.ilike(f"%{term}%")))
+                      for term in terms]
+        ids = [row[0] for row in session.query(db.Product.id)
+               .filter(*conditions)
+               .order_by(sqlalchemy.case([(db.Product.name.ilike(f"%{terms[0]}%"), 0)], else_=1), db.Product.name)
+               .limit(limit * 2)]
+    if not ids:
+        return []
+    # Load the matching products, keeping only the ones for sale in the order of relevance
+    products = {product.id: product for product in session.query(db.Product)
+                .filter(db.Product.id.in_(ids), db.Product.deleted == False, db.Product.price.isnot(None))}
+    return [products[id_] for id_ in ids if id_ in products][:limit]
@@ -68,6 +68,58 @@ csv_caption = "A 📄 .csv file containing all transactions stored in the bot da
               "You can open this file with other programs, such as LibreOffice Calc, to process" \
               " the data."
 
+# Statistics page is loading
+loading_statistics = "<i>Loading statistics...\n" \
+                     "Please wait a few seconds.</i>"
+
+# Statistics page
+statistics_page = "📊 <b>Last {days} day(s)</b>\n" \
+                  "\n" \
+                  "Orders: <b>{orders}</b>\n" \
+                  "Revenue: <b>{revenue}</b>\n" \
+                  "Refunds: <b>{refunds}</b> ({refunded})\n" \
+                  "\n" \
+                  "<b>Top products</b>\n" \
+                  "{products}\n" \
+                  "\n" \
+                  "{hours}"
+
+# Statistics: best selling product
+statistics_product_format_string = "{quantity}x {name} - {revenue}"
+
+# Statistics: sales of a single hour
+statistics_hour_format_string = "{hour} | {orders} | {revenue}"
+
+# catalog.csv caption
+catalog_caption = "A 📄 .csv file containing the whole catalog was generated.\n" \
+                  "You can edit it and upload it again with the Import catalog option."
+
+# Query statistics page
+query_stats_page = "🩺 <b>Slowest queries since {since}</b>\n" \
+                   "{sessions}\n" \
+                   "{prices}\n" \
+                   "{history}\n" \
+                   "\n" \
+                   "{statements}"
+
+# Query statistics: the objects held by the sessions of the workers
+session_stats_format_string = "👥 {workers} conversations holding {objects} objects" \
+                              " (largest {largest}, peak {peak}, {released} released)"
+
+# Query statistics: the use of the cache of the BTC prices
+price_stats_format_string = "₿ BTC prices: {hits} cached, {misses} fetched, {shared} shared," \
+                            " {stale} stale, {errors} errors"
+
+# Query statistics: the latencies of the requests of the history of the pending bitcoin addresses
+history_stats_format_string = "🔎 Payment checks: {count} requests, {mean} ms avg, p95 {p95} ms, max {max} ms," \
+                              " {retries} retries, {failed} failed"
+
+# Query statistics: a single statement
+query_stats_format_string = "<code>{statement}</code>\n" \
+                            "{count}x, {total} ms total, {mean} ms avg, p95 ≤{p95} ms, max {max} ms\n" \
+                            "ms: {histogram}\n" \
+                            "from: {origins}"
+
 # Conversation: the start command was sent and the bot should welcome the user
 conversation_after_start = "Hello!\n" \
                            "Welcome to greed!\n" \
@@ -169,6 +221,9 @@ menu_order = "🛒 Order products"
 # User menu: categoris
 menu_products_categories = "📂 Products By Category/Subcategory"
 
+# User menu: search
+menu_search = "🔎 Search products"
+
 # User menu: order status
 menu_order_status = "🛍 My orders"
 
@@ -211,6 +266,12 @@ menu_add_product = "✨ New product"
 # Admin menu: delete product
 menu_delete_product = "❌ Delete product"
 
+# Admin menu: import catalog
+menu_import_catalog = "📥 Import catalog"
+
+# Admin menu: export catalog
+menu_export_catalog = "📤 Export catalog"
+
 # Admin menu: add variance
 menu_add_variance = "✨ New variance"
 
@@ -289,6 +350,27 @@ menu_contact_shopkeeper = "👨‍💼 Contact the store"
 # Menu: generate transactions .csv file
 menu_csv = "📄 .csv"
 
+# Menu: sales statistics
+menu_statistics = "📊 Statistics"
+
+# Menu: statistics of today
+menu_today = "Today"
+
+# Menu: statistics of the last week
+menu_week = "7 days"
+
+# Menu: statistics of the last month
+menu_month = "30 days"
+
+# Menu: query statistics
+menu_query_stats = "🩺 Query statistics"
+
+# Menu: refresh
+menu_refresh = "🔄 Refresh"
+
+# Menu: reset
+menu_reset = "🗑 Reset"
+
 # Menu: edit admins list
 menu_edit_admins = "🏵 Edit Managers"
 
@@ -319,9 +401,19 @@ text_completed = "completed"
 # Text: refunded order
 text_refunded = "refunded"
 
+# Import catalog: file?
+ask_catalog_file = "📄 Send the catalog as a .csv or .json document.\n" \
+                   "The columns are: category, subcategory, product, description, price, variation," \
+                   " price_diff, quantity.\n" \
+                   "Products are matched by name: existing ones are updated, new ones are created."
+
 # Add product: name?
 ask_product_name = "What should the product name be?"
 
+# Search: ask for the words to look for
+ask_search_text = "🔎 What are you looking for?\n" \
+                  "<i>Send one or more words of the name or the description of a product.</i>"
+
 # Add variation: name?
 ask_variation_name = "What should the variation name be?"
 
@@ -502,6 +594,12 @@ success_order_created = "✅ The order was sent successfully!\n" \
                         "\n" \
                         "{order}"
 
+# Success: catalog was imported
+success_catalog_imported = "✅ The catalog has been imported!\n" \
+                           "{report}\n" \
+                           "\n" \
+                           "{errors}"
+
 # Success: order was marked as completed
 success_order_completed = "✅ You marked the order #{order_id} as completed."
 
@@ -546,6 +644,13 @@ error_duplicate_cat_name = "️⚠️ A category with the same name already exis
 # Error: a subcategory with that name already exists
 error_duplicate_sub_cat_name = "️⚠️ A subcategory with the same name already exists."
 
+# Error: the catalog file has an unsupported format
+error_catalog_format = "⚠️ Only .csv and .json catalog files are supported."
+
+# Error: the catalog couldn't be imported
+error_catalog_import = "⚠️ The catalog couldn't be imported, no changes were made:\n" \
+                       "{error}"
+
 # Error: not enough credit to order
 error_not_enough_credit = "⚠️ You do not have enough credit to place the order."
 
@@ -555,6 +660,15 @@ error_order_already_cleared = "⚠️  This order has already been processed."
 # Error: no orders have been placed, so none can be shown
 error_no_orders = "⚠️  You haven't placed any order yet, so there is nothing to display."
 
+# Error: the search didn't match any product
+error_no_search_results = "⚠️  No product matches your search."
+
+# Error: the bitcoin exchange rate couldn't be fetched
+error_btc_price_unavailable = "⚠️  The bitcoin exchange rate is not available at the moment. Please try again later."
+
+# Error: no bitcoin address could be obtained
+error_btc_address_unavailable = "⚠️  A bitcoin address can't be created at the moment. Please try again later."
+
 # Error: selected user does not exist
 error_user_does_not_exist = "⚠️  The selected user does not exist."
 
@@ -0,0 +1,170 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import sqlalchemy
+import sqlalchemy.orm
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import database as db  # noqa: E402
+import writequeue  # noqa: E402
+
+
+class WriteQueueTest(unittest.TestCase):
+    """The sessions of the conversations write through the writer thread on a file-based SQLite database,
+    set up like core.py does."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        # Created by the main thread, and used by the conversations and the writer
+        self.engine = writequeue.create_engine(f"sqlite:///{os.path.join(self.directory, 'test.sqlite')}")
+        # A short timeout, so that unserialized writes would fail instead of waiting
+        writequeue.configure_sqlite(self.engine, busy_timeout=100)
+        db.TableDeclarativeBase.metadata.create_all(self.engine)
+        with self.engine.begin() as connection:
+            connection.execute(sqlalchemy.insert(db.User.__table__),
+                               [{"user_id": i, "first_name": "User", "language": "en", "credit": 0} for i in range(2)])
+        self.queue = writequeue.start(self.engine, max_batch=10, max_delay=0.001)
+        self.Session = sqlalchemy.orm.sessionmaker(bind=self.engine, class_=writequeue.Session)
+        self.writers = []
+        sqlalchemy.event.listen(self.engine, "before_cursor_execute", self._record_writer)
+
+    def tearDown(self):
+        self.queue.stop(timeout=5)
+        writequeue.queue = None
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def _record_writer(self, conn, cursor, statement, parameters, context, executemany):
+        if not statement.lstrip().upper().startswith(("SELECT", "PRAGMA")):
+            self.writers.append(threading.current_thread().name)
+
+    def _in_thread(self, function):
+        errors = []
+
+        def run():
+            try:
+                function()
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=run, name="Conversation")
+        thread.start()
+        return thread, errors
+
+    def test_commit_from_another_thread(self):
+        def conversation():
+            session = self.Session()
+            user = session.query(db.User).filter_by(user_id=0).one()
+            user.credit += 100
+            # The pending credit is flushed automatically before the query
+            session.add(db.Transaction(user_id=0, value=100, provider="Test"))
+            self.assertEqual(session.query(db.Transaction).count(), 1)
+            session.commit()
+            session.close()
+
+        thread, errors = self._in_thread(conversation)
+        thread.join(10)
+        self.assertEqual(errors, [])
+        with self.engine.connect() as connection:
+            self.assertEqual(connection.exec_driver_sql("SELECT credit FROM users WHERE user_id = 0").scalar(), 100)
+        self.assertTrue(self.writers)
+        self.assertEqual(set(self.writers), {"Writer"})
+
+    def test_writes_are_serialized(self):
+        first_wrote = threading.Event()
+        release_first = threading.Event()
+        order = []
+
+        def first():
+            session = self.Session()
+            session.execute(sqlalchemy.update(db.User.__table__).where(db.User.__table__.c.user_id == 0)
+                            .values(credit=1))
+            first_wrote.set()
+            # Holding the write transaction longer than the busy timeout of SQLite
+            release_first.wait(5)
+            order.append("first")
+            session.commit()
+            session.close()
+
+        def second():
+            first_wrote.wait(5)
+            session = self.Session()
+            session.execute(sqlalchemy.update(db.User.__table__).where(db.User.__table__.c.user_id == 1)
+                            .values(credit=2))
+            order.append("second")
+            session.commit()
+            session.close()
+
+        first_thread, first_errors = self._in_thread(first)
+        second_thread, second_errors = self._in_thread(second)
+        first_wrote.wait(5)
+        time.sleep(0.3)
+        release_first.set()
+        first_thread.join(10)
+        second_thread.join(10)
+        self.assertEqual(first_errors + second_errors, [])
+        self.assertEqual(order, ["first", "second"])
+        with self.engine.connect() as connection:
+            self.assertEqual(connection.exec_driver_sql("SELECT credit FROM users ORDER BY user_id").scalars().all(),
+                             [1, 2])
+
+    def test_bulk_and_textual_writes(self):
+        def conversation():
+            session = self.Session()
+            session.bulk_insert_mappings(db.Category, [{"id": 1, "name": "Shirts"}])
+            session.bulk_update_mappings(db.Category, [{"id": 1, "name": "T-shirts"}])
+            session.execute(sqlalchemy.text("UPDATE users SET credit = credit + 1 WHERE user_id = :id"), {"id": 1})
+            session.commit()
+            session.close()
+
+        thread, errors = self._in_thread(conversation)
+        thread.join(10)
+        self.assertEqual(errors, [])
+        with self.engine.connect() as connection:
+            self.assertEqual(connection.exec_driver_sql("SELECT name FROM category").scalar(), "T-shirts")
+            self.assertEqual(connection.exec_driver_sql("SELECT credit FROM users WHERE user_id = 1").scalar(), 1)
+        self.assertTrue(self.writers)
+        self.assertEqual(set(self.writers), {"Writer"})
+
+    def test_end_writes_before_waiting(self):
+        waiting = threading.Event()
+        release = threading.Event()
+
+        def first():
+            session = self.Session()
+            session.query(db.User).filter_by(user_id=0).one().credit = 1
+            session.flush()
+            # Waiting for the user, for longer than the busy timeout of SQLite
+            session.end_writes()
+            waiting.set()
+            release.wait(5)
+            session.close()
+
+        def second():
+            waiting.wait(5)
+            session = self.Session()
+            session.query(db.User).filter_by(user_id=1).one().credit = 2
+            session.commit()
+            session.close()
+
+        first_thread, first_errors = self._in_thread(first)
+        second_thread, second_errors = self._in_thread(second)
+        # The second conversation doesn't wait for the first one to end
+        second_thread.join(5)
+        self.assertFalse(second_thread.is_alive())
+        release.set()
+        first_thread.join(10)
+        self.assertEqual(first_errors + second_errors, [])
+        with self.engine.connect() as connection:
+            self.assertEqual(connection.exec_driver_sql("SELECT credit FROM users ORDER BY user_id").scalars().all(),
+                             [1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
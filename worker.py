@@ -1,27 +1,66 @@
 import os
 import sys
+import csv
 import datetime
+import io
 import logging
 import queue as queuem
 import re
 import threading
 import traceback
 import uuid
+import weakref
 from html import escape
 from typing import *
 
 import requests
-from blockonomics import Blockonomics
+import blockonomics
+from blockonomics import Blockonomics, history_stats, price_cache
 import sqlalchemy
 import telegram
 
+import cache
+import catalog
 import database as db
+import inline
 import localization
 import nuconfig
+import queries
+import querylog
+import rollups
+import search
+import writequeue
 from utils import get_value_inside_brackets
 
 log = logging.getLogger(__name__)
 
+# Detached copies of the users and admins loaded by the workers, absorbing repeated /start commands
+profile_cache = cache.profiles
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_flush")
+def _invalidate_profiles(session, flush_context):
+    """Remove from the profile cache every user or admin changed by any session of this process."""
+    for instance in [*session.dirty, *session.new, *session.deleted]:
+        if isinstance(instance, (db.User, db.Admin)):
+            profile_cache.invalidate(instance.user_id)
+
+
+# The workers of this process that haven't been garbage collected yet, used to report the size of their sessions
+workers: "weakref.WeakSet[Worker]" = weakref.WeakSet()
+
+
+def session_stats() -> Dict[str, int]:
+    """Sum up the objects held by the sessions of the running workers."""
+    alive = [w for w in list(workers) if w.is_alive()]
+    return {
+        "workers": len(alive),
+        "objects": sum(w.session_stats["objects"] for w in alive),
+        "largest": max((w.session_stats["objects"] for w in alive), default=0),
+        "peak": max((w.session_stats["peak"] for w in alive), default=0),
+        "released": sum(w.session_stats["released"] for w in alive),
+    }
+
 
 class StopSignal:
     """A data class that should be sent to the worker when the conversation has to be stopped abnormally."""
@@ -45,6 +84,7 @@ class Worker(threading.Thread):
                  cfg: nuconfig.NuConfig,
                  engine,
                  *args,
+                 start_payload: str = "",
                  **kwargs):
         # Initialize the thread
         super().__init__(name=f"Worker {chat.id}", *args, **kwargs)
@@ -54,9 +94,14 @@ class Worker(threading.Thread):
         self.telegram_user: telegram.User = telegram_user
         self.cfg = cfg
         self.loc = None
+        # The parameter of the /start command, set when the bot is opened from a deep link
+        self.start_payload = start_payload
         # Open a new database session
         log.debug(f"Opening new database session for {self.name}")
-        self.session = sqlalchemy.orm.sessionmaker(bind=engine)()
+        self.session = sqlalchemy.orm.sessionmaker(bind=engine, class_=writequeue.Session)()
+        # The objects held by the session now, the most it ever held, and how many were released because of the cap
+        self.session_stats = {"objects": 0, "peak": 0, "released": 0}
+        workers.add(self)
         # Get the user db data from the users and admin tables
         self.user: Optional[db.User] = None
         self.admin: Optional[db.Admin] = None
@@ -78,7 +123,6 @@ class Worker(threading.Thread):
 
             def __init__(self, value: Union[int, float, str, "Price"]):
                 if isinstance(value, int):
-                    print(value)
                     # Keep the value as it is
                     self.value = int(value)
                 elif isinstance(value, float):
@@ -166,33 +210,7 @@ class Worker(threading.Thread):
         """The conversation code."""
         log.debug("Starting conversation")
         # Get the user db data from the users and admin tables
-        self.user = self.session.query(db.User).filter(db.User.user_id == self.chat.id).one_or_none()
-        self.admin = self.session.query(db.Admin).filter(db.Admin.user_id == self.chat.id).one_or_none()
-        # If the user isn't registered, create a new record and add it to the db
-        if self.user is None:
-            # Check if there are other registered users: if there aren't any, the first user will be owner of the bot
-            will_be_owner = (self.session.query(db.Admin).first() is None)
-            # Create the new record
-            self.user = db.User(w=self)
-            # Add the new record to the db
-            self.session.add(self.user)
-            # If the will be owner flag is set
-            if will_be_owner:
-                # Become owner
-                self.admin = db.Admin(user=self.user,
-                                      edit_products=True,
-                                      receive_orders=True,
-                                      create_transactions=True,
-                                      display_on_help=True,
-                                      is_owner=True,
-                                      live_mode=False)
-                # Add the admin to the transaction
-                self.session.add(self.admin)
-            # Commit the transaction
-            self.session.commit()
-            log.info(f"Created new user: {self.user}")
-            if will_be_owner:
-                log.warning(f"User was auto-promoted to Admin as no other admins existed: {self.user}")
+        self.__load_profile()
         # Create the localization object
         self.__create_localization()
         # Capture exceptions that occour during the conversation
@@ -203,13 +221,16 @@ class Worker(threading.Thread):
                 self.bot.send_message(self.chat.id, self.loc.get("conversation_after_start"))
             # If the user is not an admin, send him to the user menu
             if self.admin is None:
+                # If the bot was opened from the link of a product, show it first
+                self.__open_start_payload()
                 self.__user_menu()
             # If the user is an admin, send him to the admin menu
             else:
                 # Clear the live orders flag
-                self.admin.live_mode = False
-                # Commit the change
-                self.session.commit()
+                if self.admin.live_mode:
+                    self.admin.live_mode = False
+                    # Commit the change
+                    self.session.commit()
                 # Open the admin menu
                 self.__admin_menu()
         except Exception as e:
@@ -222,6 +243,81 @@ class Worker(threading.Thread):
             log.error(f"Exception in {self}: {e}")
             traceback.print_exception(*sys.exc_info())
 
+    def __recycle_session(self):
+        """End the transaction of the session, which returns its connection to the pool and expires the loaded objects,
+        so that the next menu doesn't display stale data.
+        If the session holds more objects than allowed, release all of them except the user and the admin,
+        so that the identity map doesn't keep growing for the whole conversation."""
+        objects = len(self.session.identity_map)
+        self.session_stats["peak"] = max(self.session_stats["peak"], objects)
+        # Nothing should be pending at the top of a menu, but never discard changes
+        if self.session.new or self.session.dirty or self.session.deleted:
+            self.session.commit()
+        else:
+            self.session.rollback()
+        if objects > self.cfg["Database"]["session_max_objects"]:
+            keep = [self.user, self.admin]
+            for instance in list(self.session.identity_map.values()):
+                if not any(instance is kept for kept in keep):
+                    self.session.expunge(instance)
+            self.session_stats["released"] += objects - len(self.session.identity_map)
+            log.debug(f"Released {objects - len(self.session.identity_map)} objects from the session")
+        self.session_stats["objects"] = len(self.session.identity_map)
+
+    def __open_start_payload(self):
+        """Open the product linked by the /start parameter, such as product_123, if it's for sale."""
+        match = re.fullmatch(r"product_([0-9]+)", self.start_payload)
+        if match is None:
+            return
+        product = self.session.query(db.Product) \
+            .filter_by(id=int(match.group(1)), deleted=False) \
+            .filter(db.Product.price.isnot(None)) \
+            .one_or_none()
+        if product is None:
+            return
+        self.__order_menu(products=[product])
+
+    def __load_profile(self):
+        """Load the user and admin records of this chat, registering the user if they are new."""
+        # Use the copies loaded by a recent /start, if there are any
+        profile = profile_cache.get(self.chat.id)
+        if profile is not None:
+            log.debug("Using the cached user profile")
+            self.user = self.session.merge(profile[0], load=False)
+            self.admin = self.session.merge(profile[1], load=False) if profile[1] is not None else None
+            return
+        # Get the user and the admin rows with a single query
+        profile = self.__query_profile()
+        # If the user isn't registered, create a new record and add it to the db
+        if profile is None:
+            # Insert the new record, doing nothing if a concurrent /start has already inserted it
+            db.upsert(self.session, db.User, values=db.User.telegram_values(self), index_elements=["user_id"])
+            # If there are no admins, the first user becomes the owner of the bot
+            # The check and the insertion are a single statement, so two new users can't both become owners
+            will_be_owner = self.session.execute(
+                sqlalchemy.insert(db.Admin).from_select(
+                    ["user_id", "edit_products", "receive_orders", "create_transactions", "display_on_help",
+                     "is_owner", "live_mode"],
+                    sqlalchemy.select(sqlalchemy.literal(self.chat.id), sqlalchemy.true(), sqlalchemy.true(),
+                                      sqlalchemy.true(), sqlalchemy.true(), sqlalchemy.true(), sqlalchemy.false())
+                    .where(~sqlalchemy.exists(sqlalchemy.select(db.Admin.user_id)))
+                )
+            ).rowcount > 0
+            # Commit the transaction
+            self.session.commit()
+            profile = self.__query_profile()
+            log.info(f"Created new user: {profile[0]}")
+            if will_be_owner:
+                log.warning(f"User was auto-promoted to Admin as no other admins existed: {profile[0]}")
+        self.user, self.admin = profile
+        # Cache copies of the loaded records for the next /start
+        profile_cache.set(self.chat.id,
+                          (db.detached_copy(self.user), db.detached_copy(self.admin) if self.admin else None),
+                          ttl=self.cfg["Database"]["profile_cache_ttl"])
+
+    def __query_profile(self) -> Optional[Tuple[db.User, Optional[db.Admin]]]:
+        return queries.profile(self.session, self.chat.id)
+
     def is_ready(self):
         # Change this if more parameters are added!
         return self.loc is not None
@@ -236,7 +332,7 @@ class Worker(threading.Thread):
     def update_user(self) -> db.User:
         """Update the user data."""
         log.debug("Fetching updated user data from the database")
-        self.user = self.session.query(db.User).filter(db.User.user_id == self.chat.id).one_or_none()
+        self.user = queries.user(self.session, self.chat.id)
         return self.user
 
     # noinspection PyUnboundLocalVariable
@@ -244,6 +340,8 @@ class Worker(threading.Thread):
         """Get the next update from the queue.
         If no update is found, block the process until one is received.
         If a stop signal is sent, try to gracefully stop the thread."""
+        # Don't keep the database locked while waiting for the user
+        self.session.end_writes()
         # Pop data from the queue
         try:
             data = self.queue.get(timeout=self.cfg["Telegram"]["conversation_timeout"])
@@ -394,6 +492,30 @@ class Worker(threading.Thread):
             # Return the photo array
             return update.message.photo
 
+    def __wait_for_document(self, cancellable: bool = False) -> Union[telegram.Document, CancelSignal]:
+        """Continue getting updates until a document is received, then return it."""
+        log.debug("Waiting for a document...")
+        while True:
+            # Get the next update
+            update = self.__receive_next_update()
+            # If a CancelSignal is received...
+            if isinstance(update, CancelSignal):
+                # And the wait is cancellable...
+                if cancellable:
+                    # Return the CancelSignal
+                    return update
+                else:
+                    # Ignore the signal
+                    continue
+            # Ensure the update contains a message
+            if update.message is None:
+                continue
+            # Ensure the message contains a document
+            if update.message.document is None:
+                continue
+            # Return the document
+            return update.message.document
+
     def __wait_for_inlinekeyboard_callback(self, cancellable: bool = False) \
             -> Union[telegram.CallbackQuery, CancelSignal]:
         """Continue getting updates until an inline keyboard callback is received, then return it."""
@@ -453,9 +575,12 @@ class Worker(threading.Thread):
         log.debug("Displaying __user_menu")
         # Loop used to returning to the menu after executing a command
         while True:
+            # Release what was loaded by the previous command
+            self.__recycle_session()
             # Create a keyboard with the user main menu
             keyboard = [[telegram.KeyboardButton(self.loc.get("menu_order"))],
                         [telegram.KeyboardButton(self.loc.get("menu_products_categories"))],
+                        [telegram.KeyboardButton(self.loc.get("menu_search"))],
                         [telegram.KeyboardButton(self.loc.get("menu_order_status"))],
                         [telegram.KeyboardButton(self.loc.get("menu_add_credit"))],
                         [telegram.KeyboardButton(self.loc.get("menu_language"))],
@@ -470,6 +595,7 @@ class Worker(threading.Thread):
             selection = self.__wait_for_specific_message([
                 self.loc.get("menu_order"),
                 self.loc.get("menu_products_categories"),
+                self.loc.get("menu_search"),
                 self.loc.get("menu_order_status"),
                 self.loc.get("menu_add_credit"),
                 self.loc.get("menu_language"),
@@ -486,6 +612,10 @@ class Worker(threading.Thread):
             if selection == self.loc.get("menu_products_categories"):
                 # Open the order menu
                 self.__show_categories()
+            # If the user has selected the Search option...
+            elif selection == self.loc.get("menu_search"):
+                # Open the search menu
+                self.__search_menu()
             # If the user has selected the Order Status option...
             elif selection == self.loc.get("menu_order_status"):
                 # Display the order(s) status
@@ -578,16 +708,40 @@ class Worker(threading.Thread):
         self.__order_menu(sub_category=subcategory)
         
         
-    def __order_menu(self, category = None, sub_category = None):
-        """User menu to order products from the shop."""
+    def __search_menu(self):
+        """User menu to find products by the words of their name, description or variations."""
+        log.debug("Displaying __search_menu")
+        # Create an inline keyboard with a single cancel button
+        cancel = telegram.InlineKeyboardMarkup([[telegram.InlineKeyboardButton(self.loc.get("menu_cancel"),
+                                                                               callback_data="cmd_cancel")]])
+        # Keep asking until the search matches something
+        while True:
+            self.bot.send_message(self.chat.id, self.loc.get("ask_search_text"), reply_markup=cancel)
+            text = self.__wait_for_regex(r"(.*)", cancellable=True)
+            # Allow the cancellation of the operation
+            if isinstance(text, CancelSignal):
+                return
+            # Find the matching products, ordered by relevance
+            products = search.search(self.session, text)
+            if products:
+                break
+            self.bot.send_message(self.chat.id, self.loc.get("error_no_search_results"))
+        # Let the user order from the results
+        self.__order_menu(products=products)
+
+    def __order_menu(self, category = None, sub_category = None, products = None):
+        """User menu to order products from the shop.
+        If products is given, only those products are displayed, in the same order."""
         log.debug("Displaying __order_menu")
-        # Get the products list from the db
-        if category:
-            products = self.session.query(db.Product).filter_by(category=category, deleted=False).all()
+        # Get the products list from the db, unless it was given
+        if products is not None:
+            log.debug(f"Displaying {len(products)} given products")
+        elif category:
+            products = queries.products_in_category(self.session, category.id)
         elif sub_category:
-            products = self.session.query(db.Product).filter_by(sub_category=sub_category, deleted=False).all()
+            products = queries.products_in_sub_category(self.session, sub_category.id)
         else:
-            products = self.session.query(db.Product).filter_by(deleted=False).all()            
+            products = queries.products_for_sale(self.session)
 
         # Create a dict to be used as 'cart'
         # The key is the message id of the product list
@@ -618,7 +772,7 @@ class Worker(threading.Thread):
                                               caption=product.text(w=self),
                                               reply_markup=inline_keyboard)
             # # Show variants if there is any
-            product_variations = self.session.query(db.ProductVariation).filter_by(product_id=product.id).all()
+            product_variations = queries.variations_of(self.session, product.id)
             for variation in product_variations:
                 message = variation.send_as_message(w=self, chat_id=self.chat.id)
                 
@@ -761,19 +915,6 @@ class Worker(threading.Thread):
         self.bot.send_message(self.chat.id, self.loc.get("ask_order_notes"), reply_markup=cancel)
         # Wait for user input
         notes = self.__wait_for_regex(r"(.*)", cancellable=True)
-        # Create a new Order
-        order = db.Order(user=self.user,
-                         creation_date=datetime.datetime.now(),
-                         notes=notes if not isinstance(notes, CancelSignal) else "")
-        # Add the record to the session and get an ID
-        self.session.add(order)
-        # For each product added to the cart, create a new OrderItem
-        for product in cart:
-            # Create {quantity} new OrderItems
-            for i in range(0, cart[product][1]):
-                order_item = db.OrderItem(product=cart[product][0],
-                                          order=order)
-                self.session.add(order_item)
         # Ensure the user has enough credit to make the purchase
         credit_required = self.__get_cart_value(cart) - self.user.credit
         # Notify user in case of insufficient credit
@@ -786,13 +927,15 @@ class Worker(threading.Thread):
                     credit_required <= \
                     self.Price(self.cfg["Payments"]["CreditCard"]["max_amount"]):
                 self.__make_payment(self.Price(credit_required))
-        # If afer requested payment credit is still insufficient (either payment failure or cancel)
-        if self.user.credit < self.__get_cart_value(cart):
-            # Rollback all the changes
-            self.session.rollback()
-        else:
-            # User has credit and valid order, perform transaction now
-            self.__order_transaction(order=order, value=-int(self.__get_cart_value(cart)))
+        # Place the order, if the credit is still sufficient (the payment may have failed or been cancelled)
+        order = self.__checkout(cart, notes=notes if not isinstance(notes, CancelSignal) else "")
+        if order is None:
+            # Notify the user, unless it was already done above
+            if credit_required <= 0:
+                self.bot.send_message(self.chat.id, self.loc.get("error_not_enough_credit"))
+            return
+        # Notify admins about new transation
+        self.__order_notify_admins(order=order)
 
     def __get_cart_value(self, cart):
         # Calculate total items value in cart
@@ -812,20 +955,47 @@ class Worker(threading.Thread):
                                                          cart_qty=cart[product_id][1]) + "\n"
         return product_list
 
-    def __order_transaction(self, order, value):
-        # Create a new transaction and add it to the session
-        transaction = db.Transaction(user=self.user,
-                                     value=value,
-                                     order=order)
-        self.session.add(transaction)
-        # Commit all the changes
-        self.session.commit()
-        # Update the user's credit
-        self.user.recalculate_credit()
+    def __checkout(self, cart, notes: str) -> Optional[db.Order]:
+        """Place the order of the cart in a single database transaction:
+        the cart value is subtracted from the credit only if it's sufficient, then the order, all its items
+        and the wallet transaction are inserted with a single statement each, and everything is committed at once.
+        Returns None without changing anything if the credit isn't sufficient."""
+        value = int(self.__get_cart_value(cart))
+        lines = [(product, quantity) for product, quantity in cart.values() if quantity > 0]
+        # Decrement the credit in the database, where no concurrent change can be missed
+        # The version is incremented too, so that sessions that loaded the user before will retry their updates
+        decremented = self.session.execute(
+            sqlalchemy.update(db.User)
+            .where(db.User.user_id == self.user.user_id, db.User.credit >= value)
+            .values(credit=db.User.credit - value, version=db.User.version + 1)
+        ).rowcount
+        if not decremented:
+            self.session.rollback()
+            return None
+        # Variations are ordered as new products, which have to be inserted before they can be referenced
+        for product, _ in lines:
+            if product.id is None:
+                self.session.add(product)
+        self.session.flush()
+        creation_date = datetime.datetime.now()
+        order_id = self.session.execute(
+            sqlalchemy.insert(db.Order).values(user_id=self.user.user_id, creation_date=creation_date, notes=notes)
+        ).inserted_primary_key[0]
+        # Every copy of a product is a separate item
+        self.session.execute(sqlalchemy.insert(db.OrderItem), [{"product_id": product.id, "order_id": order_id}
+                                                              for product, quantity in lines
+                                                              for _ in range(quantity)])
+        self.session.execute(sqlalchemy.insert(db.Transaction).values(user_id=self.user.user_id, value=-value,
+                                                                     refunded=False, order_id=order_id))
+        # Add the order to the sales rollups
+        rollups.record_order(self.session, creation_date, value=value,
+                             lines=[(product.id, quantity, product.price) for product, quantity in lines],
+                             currency_exp=self.cfg["Payments"]["currency_exp"])
         # Commit all the changes
         self.session.commit()
-        # Notify admins about new transation
-        self.__order_notify_admins(order=order)
+        # The credit was changed without the ORM, so the cached profile must be dropped explicitly
+        profile_cache.invalidate(self.user.user_id)
+        return self.session.query(db.Order).get(order_id)
 
     def __order_notify_admins(self, order):
         # Notify the user of the order result
@@ -988,21 +1158,24 @@ class Worker(threading.Thread):
         self.bot.answer_pre_checkout_query(precheckoutquery.id, ok=True)
         # Wait for the payment
         successfulpayment = self.__wait_for_successfulpayment(cancellable=False)
-        # Create a new database transaction
-        transaction = db.Transaction(user=self.user,
-                                     value=int(amount),
-                                     provider="Credit Card",
-                                     telegram_charge_id=successfulpayment.telegram_payment_charge_id,
-                                     provider_charge_id=successfulpayment.provider_payment_charge_id)
-
-        if successfulpayment.order_info is not None:
-            transaction.payment_name = successfulpayment.order_info.name
-            transaction.payment_email = successfulpayment.order_info.email
-            transaction.payment_phone = successfulpayment.order_info.phone_number
-        # Update the user's credit
-        self.user.recalculate_credit()
-        # Commit all the changes
-        self.session.commit()
+
+        def add_payment():
+            # Create a new database transaction
+            transaction = db.Transaction(user=self.user,
+                                         value=int(amount),
+                                         provider="Credit Card",
+                                         telegram_charge_id=successfulpayment.telegram_payment_charge_id,
+                                         provider_charge_id=successfulpayment.provider_payment_charge_id)
+
+            if successfulpayment.order_info is not None:
+                transaction.payment_name = successfulpayment.order_info.name
+                transaction.payment_email = successfulpayment.order_info.email
+                transaction.payment_phone = successfulpayment.order_info.phone_number
+            # Update the user's credit
+            self.user.recalculate_credit()
+
+        # Commit all the changes, retrying if the credit was changed concurrently
+        db.retry_on_conflict(self.session, add_payment)
 
     def __add_credit_btc(self):
         """Add money to the wallet through a bitcoin payment."""
@@ -1038,18 +1211,31 @@ class Worker(threading.Thread):
         self.invoice_payload = str(uuid.uuid4())
         # The amount is valid, fetch btc amount and address
         btc_price = Blockonomics.fetch_new_btc_price()
+        if btc_price is None:
+            self.bot.send_message(self.chat.id, self.loc.get("error_btc_price_unavailable"))
+            return
         satoshi_amount = int(1.0e8*float(raw_value)/float(btc_price))
         btc_amount = satoshi_amount/1.0e8
         # Check to re-use address
-        transaction = self.session.query(db.BtcTransaction).filter(db.BtcTransaction.user_id == self.user.user_id).filter(db.BtcTransaction.status == -1).one_or_none()
+        # Addresses that expired without a payment are recycled, so that unused addresses don't pile up
+        transaction = self.session.query(db.BtcTransaction) \
+            .filter(db.BtcTransaction.user_id == self.user.user_id) \
+            .filter(db.BtcTransaction.status.in_([-1, db.BtcTransaction.EXPIRED])) \
+            .order_by(db.BtcTransaction.status.desc(), db.BtcTransaction.timestamp.desc()) \
+            .first()
         if transaction:
             btc_address = transaction.address
             # Update btc_price, satoshi, currency, timestamp
-            transaction.btc_price = btc_price
+            transaction.price = btc_price
             transaction.currency = self.cfg["Payments"]["currency"]
+            transaction.status = -1
             transaction.timestamp = datetime.datetime.now()
         else:
-            btc_address = Blockonomics.new_address().json()["address"]
+            btc_address = blockonomics.new_address(self.session)
+            if btc_address is None:
+                self.session.rollback()
+                self.bot.send_message(self.chat.id, self.loc.get("error_btc_address_unavailable"))
+                return
             # Create a new database btc transaction
             new_transaction = db.BtcTransaction(user=self.user,
                                          price = btc_price,
@@ -1086,6 +1272,8 @@ class Worker(threading.Thread):
         log.debug("Displaying __admin_menu")
         # Loop used to return to the menu after executing a command
         while True:
+            # Release what was loaded by the previous command
+            self.__recycle_session()
             # Create a keyboard with the admin main menu based on the admin permissions specified in the db
             keyboard = []
             if self.admin.edit_products:
@@ -1097,8 +1285,10 @@ class Worker(threading.Thread):
             if self.admin.create_transactions:
                 keyboard.append([self.loc.get("menu_edit_credit")])
                 keyboard.append([self.loc.get("menu_transactions"), self.loc.get("menu_csv")])
+                keyboard.append([self.loc.get("menu_statistics")])
             if self.admin.is_owner:
                 keyboard.append([self.loc.get("menu_edit_admins")])
+                keyboard.append([self.loc.get("menu_query_stats")])
             keyboard.append([self.loc.get("menu_user_mode")])
             # Send the previously created keyboard to the user (ensuring it can be clicked only 1 time)
             self.bot.send_message(self.chat.id, self.loc.get("conversation_open_admin_menu"),
@@ -1114,6 +1304,8 @@ class Worker(threading.Thread):
                                                           self.loc.get("menu_edit_credit"),
                                                           self.loc.get("menu_transactions"),
                                                           self.loc.get("menu_csv"),
+                                                          self.loc.get("menu_statistics"),
+                                                          self.loc.get("menu_query_stats"),
                                                           self.loc.get("menu_edit_admins")])
             # If the user has selected the Products option...
             if selection == self.loc.get("menu_products"):
@@ -1159,18 +1351,28 @@ class Worker(threading.Thread):
             elif selection == self.loc.get("menu_csv"):
                 # Generate the .csv file
                 self.__transactions_file()
+            # If the user has selected the Statistics option...
+            elif selection == self.loc.get("menu_statistics"):
+                # Open the statistics view
+                self.__statistics_menu()
+            # If the user has selected the Query statistics option...
+            elif selection == self.loc.get("menu_query_stats"):
+                # Open the query statistics view
+                self.__query_stats_menu()
 
     def __products_menu(self):
         """Display the admin menu to select a product to edit."""
         log.debug("Displaying __products_menu")
         # Get the products list from the db
-        products = self.session.query(db.Product).filter_by(deleted=False).all()
+        products = queries.products_for_sale(self.session)
         # Create a list of product names
         product_names = [product.name for product in products]
         # Insert at the start of the list the add product option, the remove product option and the Cancel option
         product_names.insert(0, self.loc.get("menu_cancel"))
         product_names.insert(1, self.loc.get("menu_add_product"))
         product_names.insert(2, self.loc.get("menu_delete_product"))
+        product_names.insert(3, self.loc.get("menu_import_catalog"))
+        product_names.insert(4, self.loc.get("menu_export_catalog"))
         # Create a keyboard using the product names
         keyboard = [[telegram.KeyboardButton(product_name)] for product_name in product_names]
         # Send the previously created keyboard to the user (ensuring it can be clicked only 1 time)
@@ -1190,6 +1392,14 @@ class Worker(threading.Thread):
         elif selection == self.loc.get("menu_delete_product"):
             # Open the delete product menu
             self.__delete_product_menu()
+        # If the user has selected the Import Catalog option...
+        elif selection == self.loc.get("menu_import_catalog"):
+            # Ask for the catalog file
+            self.__import_catalog()
+        # If the user has selected the Export Catalog option...
+        elif selection == self.loc.get("menu_export_catalog"):
+            # Generate the catalog file
+            self.__export_catalog()
         # If the user has selected a product
         else:
             # Find the selected product
@@ -1197,15 +1407,67 @@ class Worker(threading.Thread):
             # Open the edit menu for that specific product
             self.__edit_product_menu(product=product)
 
+    def __import_catalog(self):
+        """Import products, categories and variations in bulk from an uploaded .csv or .json file."""
+        log.debug("Displaying __import_catalog")
+        # Create an inline keyboard with a single cancel button
+        cancel = telegram.InlineKeyboardMarkup([[telegram.InlineKeyboardButton(self.loc.get("menu_cancel"),
+                                                                               callback_data="cmd_cancel")]])
+        # Keep asking until a file with a supported format is sent
+        while True:
+            self.bot.send_message(self.chat.id, self.loc.get("ask_catalog_file"), reply_markup=cancel)
+            document = self.__wait_for_document(cancellable=True)
+            # Allow the cancellation of the operation
+            if isinstance(document, CancelSignal):
+                return
+            fmt = catalog.format_of(document.file_name or "")
+            if fmt in ["csv", "json"]:
+                break
+            self.bot.send_message(self.chat.id, self.loc.get("error_catalog_format"))
+        # Download the file from Telegram
+        self.bot.send_chat_action(self.chat.id, action="typing")
+        r = requests.get(self.bot.get_file(document.file_id).file_path)
+        # Import the rows in a single transaction
+        try:
+            report = catalog.import_catalog(self.session,
+                                            catalog.read_rows(io.StringIO(r.content.decode("utf-8-sig")), fmt))
+        except (ValueError, UnicodeDecodeError, csv.Error, sqlalchemy.exc.SQLAlchemyError) as e:
+            log.error(f"Catalog import failed: {e}")
+            self.bot.send_message(self.chat.id, self.loc.get("error_catalog_import", error=escape(str(e))))
+            return
+        # The bulk statements of the import don't go through the flush that marks the inline index as stale
+        inline.index.stale = True
+        # Notify the user, listing the first rejected rows
+        errors = "\n".join([escape(str(error)) for error in report.errors[:20]])
+        if len(report.errors) > 20:
+            errors += "\n..."
+        self.bot.send_message(self.chat.id, self.loc.get("success_catalog_imported",
+                                                         report=escape(str(report)),
+                                                         errors=errors))
+
+    def __export_catalog(self):
+        """Generate a .csv file containing the whole catalog, in the same format accepted by the import."""
+        log.debug("Generating __export_catalog")
+        # Write the catalog on the file one row at a time
+        with open(f"catalog_{self.chat.id}.csv", "w", encoding="utf8", newline="") as file:
+            catalog.export_catalog(self.session, file, "csv")
+        # Describe the file to the user
+        self.bot.send_message(self.chat.id, self.loc.get("catalog_caption"))
+        # Reopen the file for reading
+        with open(f"catalog_{self.chat.id}.csv", "rb") as file:
+            # Send the file via a manual request to Telegram
+            requests.post(f"https://api.telegram.org/bot{self.cfg['Telegram']['token']}/sendDocument",
+                          files={"document": file},
+                          params={"chat_id": self.chat.id,
+                                  "parse_mode": "HTML"})
+        # Delete the created file
+        os.remove(f"catalog_{self.chat.id}.csv")
+
     def __product_variation_menu(self):
         """Display the admin menu to select a product variation to edit."""
         log.debug("Displaying __product_variation_menu")   
         # Get the products list from the db
-        variations = self.session.query(db.ProductVariation, db.Product.name, db.Variation.name)\
-                        .select_from(db.ProductVariation)\
-                        .join(db.Product)\
-                        .join(db.Variation)\
-                        .all()
+        variations = queries.variation_names(self.session)
 
         # # Create a list of product names
         variation_names = [f"[{variation[0].id}] {variation[1]} ({variation[2]})" for variation in variations]
@@ -1818,7 +2080,7 @@ class Worker(threading.Thread):
     def __delete_product_menu(self):
         log.debug("Displaying __delete_product_menu")
         # Get the products list from the db
-        products = self.session.query(db.Product).filter_by(deleted=False).all()
+        products = queries.products_for_sale(self.session)
         # Create a list of product names
         product_names = [product.name for product in products]
         # Insert at the start of the list the Cancel button
@@ -2021,6 +2283,8 @@ class Worker(threading.Thread):
         # Commit the change to the database
         self.session.commit()
         while True:
+            # Release the orders handled so far
+            self.__recycle_session()
             # Wait for any message to stop the listening mode
             update = self.__wait_for_inlinekeyboard_callback(cancellable=True)
             # If the user pressed the stop button, exit listening mode
@@ -2061,16 +2325,21 @@ class Worker(threading.Thread):
                     # Delete the message asking for the refund reason
                     self.bot.delete_message(self.chat.id, reason_msg.message_id)
                     continue
-                # Mark the order as refunded
-                order.refund_date = datetime.datetime.now()
-                # Save the refund reason
-                order.refund_reason = reply
-                # Refund the credit, reverting the old transaction
-                order.transaction.refunded = True
-                # Update the user's credit
-                order.user.recalculate_credit()
-                # Commit the changes
-                self.session.commit()
+
+                def refund():
+                    # Mark the order as refunded
+                    order.refund_date = datetime.datetime.now()
+                    # Save the refund reason
+                    order.refund_reason = reply
+                    # Refund the credit, reverting the old transaction
+                    order.transaction.refunded = True
+                    # Update the user's credit
+                    order.user.recalculate_credit()
+                    # Add the refund to the sales rollups
+                    rollups.record_refund(self.session, order)
+
+                # Commit the changes, retrying if the credit of the user was changed concurrently
+                db.retry_on_conflict(self.session, refund)
                 # Update the order message
                 self.bot.edit_message_text(order.text(w=self),
                                            chat_id=self.chat.id,
@@ -2109,16 +2378,20 @@ class Worker(threading.Thread):
         # Allow the cancellation of the operation
         if isinstance(reply, CancelSignal):
             return
-        # Create a new transaction
-        transaction = db.Transaction(user=user,
-                                     value=int(price),
-                                     provider="Manual",
-                                     notes=reply)
-        self.session.add(transaction)
-        # Change the user credit
-        user.recalculate_credit()
-        # Commit the changes
-        self.session.commit()
+
+        def add_transaction():
+            # Create a new transaction
+            transaction = db.Transaction(user=user,
+                                         value=int(price),
+                                         provider="Manual",
+                                         notes=reply)
+            self.session.add(transaction)
+            # Change the user credit
+            user.recalculate_credit()
+            return transaction
+
+        # Commit the changes, retrying if the credit of the user was changed concurrently
+        transaction = db.retry_on_conflict(self.session, add_transaction)
         # Notify the user of the credit/debit
         self.bot.send_message(user.user_id,
                               self.loc.get("notification_transaction_created",
@@ -2166,6 +2439,8 @@ class Worker(threading.Thread):
         message = self.bot.send_message(self.chat.id, self.loc.get("loading_transactions"))
         # Loop used to move between pages
         while True:
+            # Release the transactions of the previous page
+            self.__recycle_session()
             # Retrieve the 10 transactions in that page
             transactions = self.session.query(db.Transaction) \
                 .order_by(db.Transaction.transaction_id.desc()) \
@@ -2258,6 +2533,108 @@ class Worker(threading.Thread):
         # Delete the created file
         os.remove(f"transactions_{self.chat.id}.csv")
 
+    def __statistics_menu(self):
+        """Display the sales statistics, reading them only from the rollup tables."""
+        log.debug("Displaying __statistics_menu")
+        # Number of days displayed by every option
+        periods = {"cmd_today": 1, "cmd_week": 7, "cmd_month": 30}
+        # Create the inline keyboard to switch between periods
+        inline_keyboard = telegram.InlineKeyboardMarkup([
+            [telegram.InlineKeyboardButton(self.loc.get("menu_today"), callback_data="cmd_today"),
+             telegram.InlineKeyboardButton(self.loc.get("menu_week"), callback_data="cmd_week"),
+             telegram.InlineKeyboardButton(self.loc.get("menu_month"), callback_data="cmd_month")],
+            [telegram.InlineKeyboardButton(self.loc.get("menu_done"), callback_data="cmd_done")]
+        ])
+        # Create and send a placeholder message to be populated
+        message = self.bot.send_message(self.chat.id, self.loc.get("loading_statistics"))
+        selection = "cmd_today"
+        # Loop used to move between periods
+        while True:
+            days = periods[selection]
+            since = datetime.date.today() - datetime.timedelta(days=days - 1)
+            totals = rollups.totals(self.session, since=since)
+            # List the best selling products of the period
+            products_string = "\n".join([self.loc.get("statistics_product_format_string",
+                                                       name=escape(name),
+                                                       quantity=quantity,
+                                                       revenue=str(self.Price(int(revenue))))
+                                         for name, quantity, revenue in rollups.top_products(self.session,
+                                                                                             since=since)])
+            # List the hourly sales, only if today is being displayed
+            hours_string = ""
+            if days == 1:
+                hours_string = "\n".join([self.loc.get("statistics_hour_format_string",
+                                                       hour=hour.hour.strftime("%H:%M"),
+                                                       orders=hour.orders,
+                                                       revenue=str(self.Price(hour.revenue)))
+                                          for hour in rollups.hours(self.session,
+                                                                    since=datetime.datetime.now().replace(hour=0))
+                                          if hour.orders > 0])
+            text = self.loc.get("statistics_page",
+                                days=days,
+                                orders=totals["orders"],
+                                revenue=str(self.Price(int(totals["revenue"]))),
+                                refunds=totals["refunds"],
+                                refunded=str(self.Price(int(totals["refunded"]))),
+                                products=products_string,
+                                hours=hours_string)
+            # Update the previously sent message
+            self.bot.edit_message_text(chat_id=self.chat.id, message_id=message.message_id, text=text,
+                                       reply_markup=inline_keyboard)
+            # Wait for user input
+            callback = self.__wait_for_inlinekeyboard_callback()
+            # If Done was selected...
+            if callback.data == "cmd_done":
+                # Break the loop
+                break
+            # Otherwise, display the selected period
+            elif callback.data in periods:
+                selection = callback.data
+
+    def __query_stats_menu(self):
+        """Display the slowest SQL statements executed by the bot, with their duration histograms."""
+        log.debug("Displaying __query_stats_menu")
+        # Create the inline keyboard
+        inline_keyboard = telegram.InlineKeyboardMarkup([
+            [telegram.InlineKeyboardButton(self.loc.get("menu_refresh"), callback_data="cmd_refresh"),
+             telegram.InlineKeyboardButton(self.loc.get("menu_reset"), callback_data="cmd_reset")],
+            [telegram.InlineKeyboardButton(self.loc.get("menu_done"), callback_data="cmd_done")]
+        ])
+        message = self.bot.send_message(self.chat.id, self.loc.get("loading_statistics"))
+        while True:
+            # Describe the statements that took the most total time
+            statements = []
+            for stats in querylog.stats.top(10):
+                histogram = " ".join(f"≤{bound:g}:{amount}" for bound, amount in zip(querylog.BUCKETS, stats.histogram)
+                                     if amount)
+                origins = ", ".join(sorted(stats.origins, key=stats.origins.get, reverse=True)[:3])
+                # On a single line, so that the text can be cut between lines without breaking the tags
+                statement = " ".join(stats.statement.split())[:300]
+                statements.append(self.loc.get("query_stats_format_string",
+                                               statement=escape(statement),
+                                               count=stats.count,
+                                               total=f"{stats.total:.0f}",
+                                               mean=f"{stats.mean:.1f}",
+                                               p95=f"{stats.percentile(0.95):g}",
+                                               max=f"{stats.max:.1f}",
+                                               histogram=histogram.replace("≤inf", "&gt;1000"),
+                                               origins=escape(origins)))
+            since = datetime.datetime.fromtimestamp(querylog.stats.since).strftime("%Y-%m-%d %H:%M")
+            text = self.loc.get("query_stats_page", since=since, statements="\n\n".join(statements),
+                                sessions=self.loc.get("session_stats_format_string", **session_stats()),
+                                prices=self.loc.get("price_stats_format_string", **price_cache.stats()),
+                                history=self.loc.get("history_stats_format_string", **history_stats.snapshot()))
+            # Telegram messages can't be longer than 4096 characters: cut the text at the last line that fits
+            if len(text) > 4096:
+                text = text[:text.rfind("\n", 0, 4096)]
+            self.bot.edit_message_text(chat_id=self.chat.id, message_id=message.message_id, text=text,
+                                       reply_markup=inline_keyboard)
+            callback = self.__wait_for_inlinekeyboard_callback()
+            if callback.data == "cmd_done":
+                break
+            elif callback.data == "cmd_reset":
+                querylog.stats.reset()
+
     def __add_admin(self):
         """Add an administrator to the bot."""
         log.debug("Displaying __add_admin")
@@ -2378,10 +2755,8 @@ class Worker(threading.Thread):
                               reply_markup=telegram.ReplyKeyboardMarkup(keyboard, one_time_keyboard=True))
         # Wait for an answer
         response = self.__wait_for_specific_message(list(options.keys()))
-        # Set the language to the corresponding value
-        self.user.language = options[response]
-        # Commit the edit to the database
-        self.session.commit()
+        # Set the language to the corresponding value and commit, retrying if the user was changed concurrently
+        db.retry_on_conflict(self.session, lambda: setattr(self.user, "language", options[response]))
         # Recreate the localization object
         self.__create_localization()
 
@@ -2389,8 +2764,8 @@ class Worker(threading.Thread):
         # Check if the user's language is enabled; if it isn't, change it to the default
         if self.user.language not in self.cfg["Language"]["enabled_languages"]:
             log.debug(f"User's language '{self.user.language}' is not enabled, changing it to the default")
-            self.user.language = self.cfg["Language"]["default_language"]
-            self.session.commit()
+            db.retry_on_conflict(self.session,
+                                 lambda: setattr(self.user, "language", self.cfg["Language"]["default_language"]))
         # Create a new Localization object
         self.loc = localization.Localization(
             language=self.user.language,
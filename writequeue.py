@@ -0,0 +1,349 @@
+"""Serialization of the database writes of the whole process through a single writer thread.
+
+SQLite allows a single writer at a time: when workers commit concurrently from their own sessions,
+they wait for each other and eventually fail with "database is locked".
+When the queue is started, every write of a Session of this module is executed by the writer thread: the flushes,
+including the automatic ones, the INSERT, UPDATE and DELETE statements, and the commit. Once a session has written,
+the writer serves only that session until it commits or rolls back, so the writes of different sessions never wait
+for each other's locks. Write jobs submitted with WriteQueue.submit are grouped into a single transaction with a
+single commit. When the queue isn't started, Session behaves exactly like a normal sqlalchemy session.
+
+Writes not done through the session aren't serialized: the writes of a Connection or of the engine, and the changes
+of the SQL functions and triggers executed by a SELECT. A session that waits for something with uncommitted writes,
+such as a conversation waiting for the user, blocks all the other writes: Session.end_writes commits them first.
+
+The connection of a session is used both by its own thread and by the writer, one at a time, as the thread of the
+session waits for the writer: SQLite engines must be created with check_same_thread disabled, as create_engine does.
+"""
+import collections
+import concurrent.futures
+import logging
+import queue as queuem
+import threading
+import time
+import typing
+
+import sqlalchemy
+import sqlalchemy.orm
+
+log = logging.getLogger(__name__)
+
+
+class _Job:
+    """A function writing to the database with the session of the writer, committed together with other jobs."""
+    __slots__ = ("function", "future")
+
+    def __init__(self, function: typing.Callable, future: concurrent.futures.Future):
+        self.function = function
+        self.future = future
+
+
+class _Call:
+    """A write of a session of another thread, executed by the writer; commit tells if it ends the transaction."""
+    __slots__ = ("session", "function", "future", "commit")
+
+    def __init__(self, session: "Session", function: typing.Callable, future: concurrent.futures.Future,
+                 commit: bool = False):
+        self.session = session
+        self.function = function
+        self.future = future
+        self.commit = commit
+
+
+class _Release:
+    """The end of the transaction of a session, rolled back or closed by its own thread."""
+    __slots__ = ("session",)
+
+    def __init__(self, session: "Session"):
+        self.session = session
+
+
+class WriteQueue:
+    """A thread executing all the writes to the database of the process, grouping them into as few commits as possible.
+    A batch is started by the first write received, and includes the writes received in the next max_delay seconds,
+    up to max_batch writes.
+    A session that wrote without committing owns the writer: the writes of the others are deferred until it commits
+    or rolls back, or until it stays idle for owner_timeout seconds."""
+
+    def __init__(self, engine, max_batch: int = 100, max_delay: float = 0.005, owner_timeout: float = 30):
+        self.engine = engine
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.owner_timeout = owner_timeout
+        self.batches = 0
+        self.writes = 0
+        self._queue = queuem.Queue()
+        # The session with an open write transaction, and when it was last served
+        self._owner: typing.Optional["Session"] = None
+        self._owner_seen = 0.0
+        # The writes of the other sessions, received while the owner was being served
+        self._deferred: typing.Deque = collections.deque()
+        self._sessionmaker = sqlalchemy.orm.sessionmaker(bind=engine)
+        self._thread = threading.Thread(target=self._run, name="Writer", daemon=True)
+        self._stopped = False
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self, timeout: typing.Optional[float] = None) -> None:
+        """Stop the writer after the writes already queued are done."""
+        self._stopped = True
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def in_writer(self) -> bool:
+        return threading.current_thread() is self._thread
+
+    def submit(self, function: typing.Callable[[sqlalchemy.orm.Session], typing.Any]) -> concurrent.futures.Future:
+        """Execute function(session) in the writer thread, then commit.
+        The returned future contains the value returned by function once it's committed, or the exception raised.
+        Instances returned by function are detached when the future completes."""
+        if self._stopped:
+            raise RuntimeError("The write queue is stopped")
+        future = concurrent.futures.Future()
+        self._queue.put(_Job(function, future))
+        return future
+
+    def run(self, session: "Session", function: typing.Callable, commit: bool = False):
+        """Execute a write of session in the writer thread, waiting for it and returning its result.
+        If commit is False, the session owns the writer until it commits or rolls back."""
+        if self._stopped:
+            raise RuntimeError("The write queue is stopped")
+        future = concurrent.futures.Future()
+        self._queue.put(_Call(session, function, future, commit=commit))
+        return future.result()
+
+    def commit(self, session: "Session") -> None:
+        """Flush and commit session in the writer thread, waiting for the commit to be complete."""
+        self.run(session, lambda: sqlalchemy.orm.Session.commit(session), commit=True)
+
+    def release(self, session: "Session") -> None:
+        """Let the writer serve the other sessions, as the transaction of session was ended by its own thread."""
+        if not self._stopped:
+            self._queue.put(_Release(session))
+
+    def _waiting(self, item) -> bool:
+        """Whether item has to wait for the owner of the writer to end its transaction."""
+        return self._owner is not None and isinstance(item, (_Job, _Call)) and \
+            getattr(item, "session", None) is not self._owner
+
+    def _get(self, deadline: typing.Optional[float]):
+        """Get the next item that can be served now, waiting until deadline at most; None stops the writer.
+        Raises queue.Empty at the deadline."""
+        while True:
+            if self._owner is None and self._deferred:
+                return self._deferred.popleft()
+            timeout = None if deadline is None else deadline - time.monotonic()
+            if self._owner is not None:
+                # Don't wait for the owner forever: a session may never end its transaction
+                expiry = self._owner_seen + self.owner_timeout - time.monotonic()
+                if expiry <= 0:
+                    log.warning("A session kept its write transaction open for too long, serving the other writes")
+                    self._owner = None
+                    continue
+                timeout = expiry if timeout is None else min(timeout, expiry)
+            if timeout is not None and timeout <= 0:
+                item = self._queue.get_nowait()
+            else:
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queuem.Empty:
+                    if deadline is not None and time.monotonic() >= deadline:
+                        raise
+                    continue
+            if self._waiting(item):
+                self._deferred.append(item)
+                continue
+            return item
+
+    def _next_batch(self) -> typing.List[typing.Union[_Job, _Call, _Release, None]]:
+        batch = [self._get(None)]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch and batch[-1] is not None and not isinstance(batch[-1], _Call):
+            try:
+                batch.append(self._get(deadline))
+            except queuem.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        log.debug("Starting the writer")
+        while True:
+            batch = self._next_batch()
+            jobs = [item for item in batch if isinstance(item, _Job)]
+            if jobs:
+                self._run_jobs(jobs)
+            for item in batch:
+                if isinstance(item, _Release):
+                    if self._owner is item.session:
+                        self._owner = None
+                elif isinstance(item, _Call):
+                    self._run_call(item)
+            self.batches += 1
+            self.writes += sum(isinstance(item, (_Job, _Call)) for item in batch)
+            if None in batch:
+                # The writes deferred for an owner that never ended its transaction are still done
+                self._owner = None
+                for item in self._deferred:
+                    if isinstance(item, _Job):
+                        self._run_jobs([item])
+                    else:
+                        self._run_call(item)
+                log.debug("Stopping the writer")
+                return
+
+    def _run_call(self, call: _Call) -> None:
+        """Execute a write of another session, one at a time: the writes of a session are all in its transaction."""
+        try:
+            result = call.function()
+        except BaseException as e:
+            call.future.set_exception(e)
+        else:
+            call.future.set_result(result)
+        if call.commit:
+            # After a failed commit the transaction was rolled back, and the session has to be rolled back too
+            self._owner = None
+        else:
+            self._owner = call.session
+            self._owner_seen = time.monotonic()
+
+    def _run_jobs(self, jobs: typing.List[_Job]) -> None:
+        """Run all the jobs in a single transaction.
+        If any of them fails, the transaction is rolled back and the jobs are retried one at a time,
+        so that a single failing job doesn't make the others fail."""
+        session = self._sessionmaker()
+        try:
+            results = [job.function(session) for job in jobs]
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            session.close()
+            if len(jobs) == 1:
+                jobs[0].future.set_exception(e)
+            else:
+                for job in jobs:
+                    self._run_jobs([job])
+            return
+        # Detach the returned instances, so that they can be used by the thread that submitted the job
+        session.expunge_all()
+        session.close()
+        for job, result in zip(jobs, results):
+            job.future.set_result(result)
+
+
+# The write queue of this process, if the serialization of the writes is enabled
+queue: typing.Optional[WriteQueue] = None
+
+
+def start(engine, max_batch: int, max_delay: float) -> WriteQueue:
+    """Start serializing the writes of all the sessions of this module through a single writer thread."""
+    global queue
+    queue = WriteQueue(engine, max_batch=max_batch, max_delay=max_delay)
+    queue.start()
+    return queue
+
+
+class Session(sqlalchemy.orm.Session):
+    """A session whose writes and commits are executed by the writer thread, if the write queue is started."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Whether the session wrote through the writer in its current transaction
+        self._writing = False
+
+    @staticmethod
+    def _queued() -> bool:
+        return queue is not None and not queue.in_writer()
+
+    @staticmethod
+    def _is_write(statement) -> bool:
+        """Whether statement may write: textual statements are writes unless they are a SELECT."""
+        if isinstance(statement, str):
+            statement = sqlalchemy.text(statement)
+        if isinstance(statement, sqlalchemy.sql.expression.TextClause):
+            return not statement.text.lstrip().upper().startswith("SELECT")
+        return getattr(statement, "is_dml", False)
+
+    def _write(self, function: typing.Callable):
+        self._writing = True
+        return queue.run(self, function)
+
+    def flush(self, objects=None) -> None:
+        # Flushes with nothing to write, such as most automatic ones, don't need the writer
+        if self._queued() and (self.new or self.dirty or self.deleted):
+            self._write(lambda: super(Session, self).flush(objects))
+        else:
+            super().flush(objects)
+
+    def execute(self, statement, *args, **kwargs):
+        if self._queued() and self._is_write(statement):
+            return self._write(lambda: super(Session, self).execute(statement, *args, **kwargs))
+        return super().execute(statement, *args, **kwargs)
+
+    def bulk_save_objects(self, *args, **kwargs) -> None:
+        if self._queued():
+            self._write(lambda: super(Session, self).bulk_save_objects(*args, **kwargs))
+        else:
+            super().bulk_save_objects(*args, **kwargs)
+
+    def bulk_insert_mappings(self, *args, **kwargs) -> None:
+        if self._queued():
+            self._write(lambda: super(Session, self).bulk_insert_mappings(*args, **kwargs))
+        else:
+            super().bulk_insert_mappings(*args, **kwargs)
+
+    def bulk_update_mappings(self, *args, **kwargs) -> None:
+        if self._queued():
+            self._write(lambda: super(Session, self).bulk_update_mappings(*args, **kwargs))
+        else:
+            super().bulk_update_mappings(*args, **kwargs)
+
+    def commit(self) -> None:
+        self._writing = False
+        if self._queued():
+            queue.commit(self)
+        else:
+            super().commit()
+
+    def rollback(self) -> None:
+        self._writing = False
+        super().rollback()
+        if self._queued():
+            queue.release(self)
+
+    def close(self) -> None:
+        self._writing = False
+        super().close()
+        if self._queued():
+            queue.release(self)
+
+    def end_writes(self) -> None:
+        """Commit the writes of the session before waiting for something that may take long, such as the user input.
+        A session with uncommitted writes owns the writer and keeps SQLite locked: all the other writes of the process
+        would wait for it, and fail once the writer stops waiting, as the database is still locked."""
+        if self._queued() and self._writing:
+            log.debug("Committing the writes of a session before waiting")
+            self.commit()
+
+
+def create_engine(url: str, **kwargs):
+    """Create an engine whose sessions can use the write queue.
+    The SQLite connections of the sessions are also used by the writer thread, so they must not be bound to the
+    thread that created them; they are never used by two threads at the same time."""
+    if url.startswith("sqlite"):
+        kwargs.setdefault("connect_args", {})["check_same_thread"] = False
+    return sqlalchemy.create_engine(url, **kwargs)
+
+
+def configure_sqlite(engine, busy_timeout: int) -> None:
+    """Set up SQLite for concurrent access: readers don't block the writer in WAL mode,
+    and every connection waits busy_timeout milliseconds for the database to be unlocked instead of failing."""
+
+    @sqlalchemy.event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        # Commits in WAL mode are durable after a checkpoint, which is safe against application crashes
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(busy_timeout)}")
+        cursor.close()